@@ -166,7 +166,18 @@ class SidebandApp(MDApp):
 
     PKGNAME  = "io.unsigned.sideband"
 
-    SERVICE_TIMEOUT = 30
+    SERVICE_TIMEOUT   = 30
+    LIVENESS_INTERVAL = 5
+    REFRESH_INTERVAL  = 1.5
+
+    # State properties that the UI jobs act on. Changes to
+    # these are pushed by the core, and run the jobs. Only
+    # views showing progress that is not pushed, such as
+    # outbound message transfers and the sync dialog, are
+    # refreshed periodically while they are displayed.
+    JOB_STATES = ["app.flags.unread_conversations", "app.flags.lxmf_sync_dialog_open", "app.flags.new_announces",
+                  "app.flags.last_telemetry", "app.flags.new_conversations", "wants.viewupdate.conversations",
+                  "lxm_uri_ingest.result", "hardware_operation.error", "app.flags.last_message"]
 
     EINK_BG_STR = "1,0,0,1"
     EINK_BG_ARR = [1,0,0,1]
@@ -220,6 +231,9 @@ class SidebandApp(MDApp):
 
         self.final_load_completed = False
         self.service_last_available = 0
+        self.job_states = None
+        self.jobs_trigger = Clock.create_trigger(self.jobs)
+        self.jobs_refresh = Clock.create_trigger(self.jobs, SidebandApp.REFRESH_INTERVAL)
 
         self.attach_path = None
         self.attach_type = None
@@ -240,7 +254,7 @@ class SidebandApp(MDApp):
 
     def update_loading_text(self):
         if self.sideband:
-            loadingstate = self.sideband.getstate("init.loadingstate")
+            loadingstate = self.sideband.getstate("init.loadingstate", allow_cache=True)
             if loadingstate:
                 self.root.ids.connecting_status.text = loadingstate
 
@@ -258,7 +272,7 @@ class SidebandApp(MDApp):
         self.check_bluetooth_permissions()
         self.start_service()
         
-        Clock.schedule_interval(self.jobs, 1.5)
+        Clock.schedule_interval(self.liveness_jobs, SidebandApp.LIVENESS_INTERVAL)
 
         def dismiss_splash(dt):
             from android import loadingscreen
@@ -289,6 +303,7 @@ class SidebandApp(MDApp):
     def start_final(self):
         # Start local core instance
         self.sideband.start()
+        self.sideband.subscribe_states(SidebandApp.JOB_STATES, self.job_states_changed)
 
         # Pre-load announce stream widgets
         self.update_loading_text()
@@ -710,7 +725,17 @@ class SidebandApp(MDApp):
     def _state_jobs(self):
         props = []
 
-    def jobs(self, delta_time):
+    def job_states_changed(self, changes):
+        # Called by the core whenever any of the job state
+        # properties change. Flags being cleared need no
+        # action, but anything else runs the jobs at once.
+        states = dict(self.job_states or {})
+        states.update(changes)
+        self.job_states = states
+        if any(changes.values()):
+            self.jobs_trigger()
+
+    def liveness_jobs(self, delta_time):
         if self.final_load_completed:
             if RNS.vendor.platformutils.is_android() and not self.sideband.service_available():
                 if time.time() - self.service_last_available > SidebandApp.SERVICE_TIMEOUT:
@@ -737,19 +762,40 @@ class SidebandApp(MDApp):
             else:
                 self.service_last_available = time.time()
 
+        if self.root.ids.screen_manager.current == "map_screen":
+            if self.map_screen and hasattr(self.map_screen.ids.map_layout, "map") and self.map_screen.ids.map_layout.map != None:
+                self.sideband.config["map_lat"] = self.map_screen.ids.map_layout.map.lat
+                self.sideband.config["map_lon"] = self.map_screen.ids.map_layout.map.lon
+                self.sideband.config["map_zoom"] = self.map_screen.ids.map_layout.map.zoom
+
+        # Until the state subscription is in place, the
+        # jobs are run here instead.
+        if self.job_states == None:
+            self.jobs_trigger()
 
+    def jobs(self, delta_time):
+        if self.job_states != None:
+            states = self.job_states
+        else:
+            states = self.sideband.getstates(SidebandApp.JOB_STATES, allow_cache=True)
+
+        refresh = False
         if self.root.ids.screen_manager.current == "messages_screen":
             self.messages_view.update()
+            if self.messages_view.has_pending():
+                refresh = True
 
             if not self.messages_view.ids.messages_scrollview.dest_known:
                 self.message_area_detect()
+                refresh = True
 
         elif self.root.ids.screen_manager.current == "conversations_screen":
-            if self.sideband.getstate("app.flags.unread_conversations", allow_cache=True):
+            if states["app.flags.unread_conversations"]:
                 if self.conversations_view != None:
                     self.conversations_view.update()
 
-            if self.sideband.getstate("app.flags.lxmf_sync_dialog_open", allow_cache=True) and self.sync_dialog != None:
+            if states["app.flags.lxmf_sync_dialog_open"] and self.sync_dialog != None:
+                refresh = True
                 state = self.sideband.message_router.propagation_transfer_state
 
                 dlg_sp = self.sideband.get_sync_progress()*100; dlg_ss = self.sideband.get_sync_status()
@@ -766,30 +812,25 @@ class SidebandApp(MDApp):
                     self.widget_hide(self.sync_dialog.stop_button, True)
 
         elif self.root.ids.screen_manager.current == "announces_screen":
-            if self.sideband.getstate("app.flags.new_announces", allow_cache=True):
+            if states["app.flags.new_announces"]:
                 if self.announces_view != None:
                     self.announces_view.update()
 
         elif self.root.ids.screen_manager.current == "map_screen":
-            if self.map_screen and hasattr(self.map_screen.ids.map_layout, "map") and self.map_screen.ids.map_layout.map != None:
-                self.sideband.config["map_lat"] = self.map_screen.ids.map_layout.map.lat
-                self.sideband.config["map_lon"] = self.map_screen.ids.map_layout.map.lon
-                self.sideband.config["map_zoom"] = self.map_screen.ids.map_layout.map.zoom
-
-            self.last_telemetry_received = self.sideband.getstate("app.flags.last_telemetry", allow_cache=True) or 0
+            self.last_telemetry_received = states["app.flags.last_telemetry"] or 0
             if self.last_telemetry_received > self.last_map_update:
                 self.map_update_markers()
 
-        if self.sideband.getstate("app.flags.new_conversations", allow_cache=True):
+        if states["app.flags.new_conversations"]:
             if self.conversations_view != None:
                 self.conversations_view.update()
 
-        if self.sideband.getstate("wants.viewupdate.conversations", allow_cache=True):
+        if states["wants.viewupdate.conversations"]:
             if self.conversations_view != None:
                 self.conversations_view.update()
 
         invalid_values = ["None", "False", "True", True, False, None]
-        imr = self.sideband.getstate("lxm_uri_ingest.result", allow_cache=True)
+        imr = states["lxm_uri_ingest.result"]
         if imr:
             if imr in invalid_values:
                 self.sideband.setstate("lxm_uri_ingest.result", False)
@@ -810,7 +851,7 @@ class SidebandApp(MDApp):
                 dialog.open()
 
         invalid_values = ["None", "False", "True", True, False, None]
-        hwe = self.sideband.getstate("hardware_operation.error", allow_cache=True)
+        hwe = states["hardware_operation.error"]
         if hwe:
             if hwe in invalid_values:
                 self.sideband.setstate("hardware_operation.error", False)
@@ -830,6 +871,9 @@ class SidebandApp(MDApp):
                 ok_button.bind(on_release=dl_ok)
                 dialog.open()
 
+        if refresh:
+            self.jobs_refresh()
+
     def on_start(self):
         self.last_exit_event = time.time()
         self.root.ids.screen_manager.transition = self.slide_transition
@@ -1554,7 +1598,7 @@ class SidebandApp(MDApp):
         try:
             connectivity_status = ""
             if RNS.vendor.platformutils.get_platform() == "android":
-                connectivity_status = str(self.sideband.getstate("service.connectivity_status"))
+                connectivity_status = str(self.sideband.getstate("service.connectivity_status", allow_cache=True))
 
             else:
                 if self.sideband.reticulum.is_connected_to_shared_instance:
@@ -3657,7 +3701,7 @@ class SidebandApp(MDApp):
 
         self.root.ids.nav_drawer.set_state("closed")
         
-        if self.sideband.getstate("app.flags.new_announces"):
+        if self.sideband.getstate("app.flags.new_announces", allow_cache=True):
             self.announces_view.update()
 
         self.root.ids.screen_manager.current = "announces_screen"
@@ -3673,6 +3717,10 @@ class SidebandApp(MDApp):
         pass
 
     def screen_transition_complete(self, sender):
+        # Flags that were set while another screen was displayed
+        # are acted on as soon as the relevant screen is shown.
+        self.jobs_trigger()
+
         if self.root.ids.screen_manager.current == "announces_screen":
             pass
         if self.root.ids.screen_manager.current == "conversations_screen":
@@ -4478,6 +4526,42 @@ class SidebandApp(MDApp):
 
         Clock.schedule_once(update_cache_size, 0.35)
 
+    def settings_metrics_action(self, sender=None):
+        metrics = self.sideband.get_metrics()
+        sections = [("App", metrics)]
+        if "service" in metrics:
+            sections.append(("Service", metrics["service"]))
+
+        text = ""
+        for title, section in sections:
+            text += "[b]"+title+"[/b]\n"
+            if section == None:
+                text += "Metrics could not be retrieved from the service\n\n"
+            elif not section["enabled"]:
+                text += "Metrics are only collected while debug logging is enabled\n\n"
+            elif len(section["operations"]) == 0:
+                text += "No operations recorded yet\n\n"
+            else:
+                text += "\n".join(self.sideband.metrics.format(section))+"\n\n"
+
+        reset_button = MDRectangleFlatButton(text="Reset",font_size=dp(18))
+        ok_button = MDRectangleFlatButton(text="OK",font_size=dp(18))
+        dialog = MDDialog(
+            title="Performance Metrics",
+            text=text.strip(),
+            buttons=[ reset_button, ok_button ],
+        )
+        def dl_reset(s):
+            dialog.dismiss()
+            self.sideband.get_metrics(reset=True)
+
+        def dl_ok(s):
+            dialog.dismiss()
+
+        reset_button.bind(on_release=dl_reset)
+        ok_button.bind(on_release=dl_ok)
+        dialog.open()
+
     def map_clear_cache(self, sender=None):
         yes_button = MDRectangleFlatButton(text="Yes",font_size=dp(18), theme_text_color="Custom", line_color=self.color_reject, text_color=self.color_reject)
         no_button = MDRectangleFlatButton(text="No",font_size=dp(18))
@@ -4662,7 +4746,7 @@ class SidebandApp(MDApp):
     def map_update_markers(self, sender=None):
         RNS.log("Updating map markers", RNS.LOG_DEBUG)
         earliest = time.time() - self.sideband.config["map_history_limit"]
-        telemetry_entries = self.sideband.list_telemetry(after=earliest)
+        telemetry_entries = self.sideband.list_latest_locations(after=earliest)
         own_address = self.sideband.lxmf_destination.hash
         changes = False
 
@@ -4738,44 +4822,31 @@ class SidebandApp(MDApp):
         for telemetry_source in telemetry_entries:
             try:
                 skip = False
+                l = telemetry_entries[telemetry_source]
                 if telemetry_source == own_address:
                     skip = True
                 elif telemetry_source in self.map_markers:
                     marker = self.map_markers[telemetry_source]
-                    newest_timestamp = telemetry_entries[telemetry_source][0][0]
-                    if newest_timestamp <= marker.location_time:
+                    if l["last_update"] <= marker.location_time:
                         skip = True
 
-                latest_viewable = None
                 if not skip:
-                    for telemetry_entry in telemetry_entries[telemetry_source]:
-                        telemetry_timestamp = telemetry_entry[0]
-                        telemetry_data = telemetry_entry[1]
-                        t = Telemeter.from_packed(telemetry_data)
-                        if t != None:
-                            telemetry = t.read_all()
-                            if "location" in telemetry and telemetry["location"] != None and telemetry["location"]["latitude"] != None and telemetry["location"]["longitude"] != None:
-                                latest_viewable = telemetry
-                                break
-
-                    if latest_viewable != None:
-                        l = latest_viewable["location"]
-                        if not telemetry_source in self.map_markers:
-                            marker = self.map_create_marker(telemetry_source, latest_viewable, self.sideband.peer_appearance(telemetry_source))
-                            if marker != None:
-                                self.map_markers[telemetry_source] = marker
-                                self.map_screen.ids.map_layout.map.add_marker(marker)
-                                changes = True
-                        else:
-                            marker = self.map_markers[telemetry_source]
-                            marker.location_time = latest_viewable["time"]["utc"]
-                            marker.lat = l["latitude"]
-                            marker.lon = l["longitude"]
-                            appearance = self.sideband.peer_appearance(telemetry_source)
-                            marker.icon.icon = appearance[0]
-                            marker.icon.icon_color = appearance[1]
-                            marker.icon.md_bg_color = appearance[2]
+                    if not telemetry_source in self.map_markers:
+                        marker = self.map_create_marker(telemetry_source, {"location": l}, self.sideband.peer_appearance(telemetry_source))
+                        if marker != None:
+                            self.map_markers[telemetry_source] = marker
+                            self.map_screen.ids.map_layout.map.add_marker(marker)
                             changes = True
+                    else:
+                        marker = self.map_markers[telemetry_source]
+                        marker.location_time = l["last_update"]
+                        marker.lat = l["latitude"]
+                        marker.lon = l["longitude"]
+                        appearance = self.sideband.peer_appearance(telemetry_source)
+                        marker.icon.icon = appearance[0]
+                        marker.icon.icon_color = appearance[1]
+                        marker.icon.md_bg_color = appearance[2]
+                        changes = True
 
             except Exception as e:
                 RNS.log("Error while updating map entry for "+RNS.prettyhexrep(telemetry_source)+": "+str(e), RNS.LOG_ERROR)
@@ -4975,6 +5046,29 @@ if not args.daemon:
             else:
                 return ExceptionManager.RAISE
 
+DAEMON_STATUS_INTERVAL = 60*60
+DAEMON_METRICS_LIMIT   = 20
+def log_daemon_status(sideband):
+    try:
+        stats = sideband.get_db_stats()
+        last_maintenance = stats["last_maintenance"]
+        maintenance_str = RNS.prettytime(time.time()-last_maintenance)+" ago" if last_maintenance != None else "never"
+        integrity_str = {True: "ok", False: "failed", None: "unknown"}[stats["integrity_ok"]]
+        RNS.log("Database is "+RNS.prettysize(stats["db_size"])+" with "+RNS.prettysize(stats["wal_size"])+" WAL, "+str(round(stats["fragmentation"]*100, 1))+"% free pages, integrity "+integrity_str+", last maintenance "+maintenance_str, RNS.LOG_INFO)
+        if stats["tables"] != None:
+            RNS.log("Database rows: "+", ".join([t+" "+str(c) for t, c in sorted(stats["tables"].items())]), RNS.LOG_VERBOSE)
+    except Exception as e:
+        RNS.log("Could not get database status: "+str(e), RNS.LOG_ERROR)
+
+    try:
+        metrics = sideband.get_metrics()
+        if metrics["enabled"] and len(metrics["operations"]) > 0:
+            RNS.log("Operation metrics since "+RNS.prettytime(time.time()-metrics["since"])+" ago:", RNS.LOG_INFO)
+            for line in sideband.metrics.format(metrics, limit=DAEMON_METRICS_LIMIT):
+                RNS.log("  "+line, RNS.LOG_INFO)
+    except Exception as e:
+        RNS.log("Could not get operation metrics: "+str(e), RNS.LOG_ERROR)
+
 def run():
     if args.daemon:
         RNS.log("Starting Sideband in daemon mode")
@@ -4987,8 +5081,12 @@ def run():
         )
 
         sideband.start()
+        last_status = 0
         while True:
             time.sleep(5)
+            if time.time() > last_status+DAEMON_STATUS_INTERVAL:
+                last_status = time.time()
+                log_daemon_status(sideband)
     else:
         ExceptionManager.add_handler(SidebandExceptionHandler())
         SidebandApp().run()
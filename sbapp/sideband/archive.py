@@ -0,0 +1,75 @@
+import os
+import RNS
+import zlib
+import struct
+import RNS.vendor.umsgpack as msgpack
+
+class ArchiveWriter():
+    MAGIC             = b"SBARCHV\x01"
+    COMPRESSION_LEVEL = 6
+    FRAME_HEADER      = struct.Struct("!I")
+    MAX_FRAME_SIZE    = 64*1024*1024
+
+    # A Sideband archive is a sequence of independently compressed
+    # frames following a magic header. Each frame holds one msgpack
+    # encoded record, so archives can be written and read in a single
+    # pass, holding no more than one frame in memory at any time. The
+    # archive is written to a temporary file, and only moved to its
+    # final path once complete.
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path+".part"
+        self.file = open(self.part_path, "wb")
+        self.file.write(ArchiveWriter.MAGIC)
+        self.frames = 0
+
+    def write(self, record):
+        frame = zlib.compress(msgpack.packb(record), ArchiveWriter.COMPRESSION_LEVEL)
+        self.file.write(ArchiveWriter.FRAME_HEADER.pack(len(frame)))
+        self.file.write(frame)
+        self.frames += 1
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        try:
+            self.file.close()
+            os.unlink(self.part_path)
+        except Exception as e:
+            RNS.log("Could not remove incomplete archive "+str(self.part_path)+": "+str(e), RNS.LOG_ERROR)
+
+class ArchiveReader():
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        if self.file.read(len(ArchiveWriter.MAGIC)) != ArchiveWriter.MAGIC:
+            self.file.close()
+            raise ValueError("The file "+str(path)+" is not a Sideband archive")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        header = self.file.read(ArchiveWriter.FRAME_HEADER.size)
+        if len(header) == 0:
+            raise StopIteration
+        elif len(header) < ArchiveWriter.FRAME_HEADER.size:
+            raise ValueError("The archive "+str(self.path)+" is truncated")
+
+        length = ArchiveWriter.FRAME_HEADER.unpack(header)[0]
+        if length > ArchiveWriter.MAX_FRAME_SIZE:
+            raise ValueError("Invalid frame length "+str(length)+" in archive "+str(self.path))
+
+        frame = self.file.read(length)
+        if len(frame) < length:
+            raise ValueError("The archive "+str(self.path)+" is truncated")
+
+        return msgpack.unpackb(zlib.decompress(frame))
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import pickle
+import threading
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing.connection
+
+import RNS
+import LXMF
+import RNS.vendor.umsgpack as msgpack
+
+from .core import SidebandCore
+from .sense import Telemeter, Sensor
+from .rpc import RPCClient, RPCServer, RPCProtocol
+
+class Benchmark():
+    NAME = None
+    DEFAULTS = {}
+
+    def __init__(self, **params):
+        self.params = dict(self.DEFAULTS)
+        for key in params:
+            if params[key] != None:
+                self.params[key] = params[key]
+
+        self.rng = random.Random(self.params["seed"])
+        self.results = {}
+
+    def run(self):
+        started = time.time()
+        try:
+            self.setup()
+            self.populate()
+            self.measure()
+        finally:
+            self.teardown()
+
+        return {
+            "benchmark": self.NAME,
+            "commit": self.commit(),
+            "created": started,
+            "duration": time.time()-started,
+            "environment": {
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+            },
+            "params": self.params,
+            "results": self.results,
+        }
+
+    def setup(self):
+        pass
+
+    def populate(self):
+        pass
+
+    def measure(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def random_bytes(self, length):
+        return self.rng.getrandbits(length*8).to_bytes(length, "big")
+
+    def time(self, name, runs, function, items=1):
+        timings = []
+        for n in range(runs):
+            started = time.time()
+            function()
+            timings.append(time.time()-started)
+        self.record(name, timings, items)
+
+    def record(self, name, timings, items=1):
+        ordered = sorted(timings)
+        total = sum(timings)
+        self.results[name] = {
+            "runs": len(timings),
+            "items": items,
+            "total_ms": total*1000,
+            "mean_ms": total/len(timings)*1000,
+            "median_ms": ordered[len(ordered)//2]*1000,
+            "p95_ms": ordered[min(len(ordered)-1, int(len(ordered)*0.95))]*1000,
+            "min_ms": ordered[0]*1000,
+            "max_ms": ordered[-1]*1000,
+            "items_per_second": len(timings)*items/total if total > 0 else None,
+        }
+
+    def record_total(self, name, duration, items):
+        self.record(name, [duration], items)
+
+    def commit(self):
+        try:
+            path = os.path.dirname(os.path.abspath(__file__))
+            result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True, timeout=5)
+            if result.returncode == 0:
+                return result.stdout.decode("utf-8").strip()
+        except Exception:
+            pass
+        return None
+
+class StorageBenchmark(Benchmark):
+    NAME = "storage"
+    DEFAULTS = {
+        "conversations": 50,
+        "messages": 200,
+        "peers": 50,
+        "telemetry_depth": 500,
+        "announces": 2000,
+        "ingest": 200,
+        "runs": 20,
+        "page_size": 8,
+        "attachment_ratio": 0.02,
+        "seed": 1,
+    }
+
+    WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliett",
+             "kilo", "lima", "mike", "november", "oscar", "papa", "quebec", "romeo", "sierra", "tango",
+             "uniform", "victor", "whiskey", "xray", "yankee", "zulu", "relay", "node", "mesh", "link"]
+
+    # Builds a database with synthetic conversations, messages, telemetry
+    # and announces in a temporary Sideband configuration directory, and
+    # times the storage operations used by the UI, the telemetry collector
+    # and message ingest against it. Reticulum is never started, so no
+    # interfaces or network access are needed. The generated content is
+    # determined by the seed, so runs on different commits operate on
+    # equivalent data.
+
+    def __init__(self, path=None, keep=False, **params):
+        super().__init__(**params)
+        self.keep = keep or path != None
+        self.path = path if path != None else tempfile.mkdtemp(prefix="sideband_benchmark_")
+        self.core = None
+
+    def setup(self):
+        # A new configuration is saved in the background while it is
+        # being loaded, so the configuration directory is created first,
+        # and then loaded again, as on any later start of the app.
+        if not os.path.isfile(os.path.join(self.path, "app_storage", "sideband_config")):
+            initial = SidebandCore(None, config_path=self.path, is_client=True)
+            while initial.saving_configuration or not os.path.isfile(initial.config_path):
+                time.sleep(0.1)
+            initial.db_writer.stop()
+
+        self.core = SidebandCore(None, config_path=self.path, is_client=False)
+
+        self.local = RNS.Destination(self.core.identity, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+        self.core.lxmf_destination = self.local
+        self.peers = []
+        for n in range(self.params["conversations"]):
+            identity = RNS.Identity()
+            self.peers.append(RNS.Destination(identity, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery"))
+
+        self.telemetry_sources = [self.random_bytes(RNS.Reticulum.TRUNCATED_HASHLENGTH//8) for n in range(self.params["peers"])]
+
+    def teardown(self):
+        if self.core != None:
+            self.core.db_flush()
+        if not self.keep:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def populate(self):
+        started = time.time()
+        for peer in self.peers:
+            self.core._db_create_conversation(peer.hash)
+        self.record_total("populate.conversations", time.time()-started, len(self.peers))
+
+        started = time.time(); count = 0
+        for n in range(self.params["messages"]):
+            for peer in self.peers:
+                self.save_message(peer)
+                count += 1
+        self.record_total("populate.messages", time.time()-started, count)
+
+        started = time.time(); count = 0
+        now = time.time(); interval = 60
+        for source in self.telemetry_sources:
+            stream = []
+            for n in range(self.params["telemetry_depth"]):
+                timestamp = int(now-(self.params["telemetry_depth"]-n)*interval)
+                stream.append([source, timestamp, self.packed_telemetry(timestamp), None])
+            count += self.core._db_save_telemetry_stream(stream)
+        self.record_total("populate.telemetry", time.time()-started, count)
+
+        started = time.time()
+        self.announce_burst(self.params["announces"])
+        self.record_total("populate.announces", time.time()-started, self.params["announces"])
+
+        self.core.db_flush()
+
+    def measure(self):
+        runs = self.params["runs"]
+        page_size = self.params["page_size"]
+
+        self.time("conversations.list", runs, lambda: self.core.list_conversations())
+        self.time("messages.count", runs, lambda: self.core.count_messages(self.rng.choice(self.peers).hash))
+        self.time("messages.first_page", runs, lambda: self.decode(self.core.list_messages(self.rng.choice(self.peers).hash, limit=page_size)))
+
+        # Pages backwards through a whole conversation, the same way
+        # the conversation view loads earlier messages.
+        peer = self.rng.choice(self.peers)
+        pages = []
+        cursor = None
+        while True:
+            started = time.time()
+            if cursor == None:
+                messages = self.core.list_messages(peer.hash, limit=page_size)
+            else:
+                messages = self.core.list_messages(peer.hash, before_cursor=cursor, limit=page_size)
+            self.decode(messages)
+            pages.append(time.time()-started)
+            if len(messages) == 0:
+                break
+            cursor = messages[0]["cursor"]
+        self.record("messages.paginate", pages)
+
+        window = self.params["telemetry_depth"]*60
+        self.time("telemetry.list", runs, lambda: self.core.list_telemetry(after=time.time()-window))
+        self.time("telemetry.list_recent", runs, lambda: self.core.list_telemetry(after=time.time()-window/10))
+        self.time("telemetry.list_source", runs, lambda: self.core.list_telemetry(context_dest=self.rng.choice(self.telemetry_sources)))
+        self.time("telemetry.list_latest", runs, lambda: self.core.list_latest_telemetry())
+        self.time("telemetry.collector_response", max(1, runs//4), lambda: self.core.telemetry_collector_stream(self.rng.choice(self.peers).hash, 0))
+
+        streams = []
+        for n in range(max(1, runs//4)):
+            source = self.random_bytes(RNS.Reticulum.TRUNCATED_HASHLENGTH//8)
+            now = int(time.time())
+            streams.append([[source, now-n, self.packed_telemetry(now-n), None] for n in range(100)])
+        self.time("telemetry.stream_ingest", len(streams), lambda: self.core._db_save_telemetry_stream(streams.pop()), items=100)
+
+        self.time("ingest.save_lxm", self.params["ingest"], lambda: self.save_message(self.rng.choice(self.peers)))
+
+        burst = max(1, self.params["announces"]//4)
+        self.time("announces.burst", 4, lambda: self.announce_burst(burst), items=burst)
+
+    def save_message(self, peer):
+        inbound = self.rng.random() < 0.5
+        words = self.rng.randint(3, 60)
+        content = " ".join([self.rng.choice(StorageBenchmark.WORDS) for n in range(words)])
+        fields = {}
+        if self.rng.random() < self.params["attachment_ratio"]:
+            fields[LXMF.FIELD_IMAGE] = ["webp", self.random_bytes(40*1024)]
+
+        if inbound:
+            lxm = LXMF.LXMessage(self.local, peer, content, "", fields=fields, desired_method=LXMF.LXMessage.DIRECT)
+            lxm.state = LXMF.LXMessage.DELIVERED
+        else:
+            lxm = LXMF.LXMessage(peer, self.local, content, "", fields=fields, desired_method=LXMF.LXMessage.DIRECT)
+            lxm.state = LXMF.LXMessage.SENT
+
+        lxm.pack()
+        if lxm.method == None:
+            lxm.method = LXMF.LXMessage.DIRECT
+
+        self.core._db_save_lxm(lxm, peer.hash, originator=not inbound)
+
+    def announce_burst(self, count):
+        for n in range(count):
+            destination_hash = self.random_bytes(RNS.Reticulum.TRUNCATED_HASHLENGTH//8)
+            app_data = msgpack.packb([("Peer "+str(n)).encode("utf-8"), None])
+            self.core._db_save_announce(destination_hash, app_data)
+        self.core.db_flush()
+
+    def packed_telemetry(self, timestamp):
+        telemeter = Telemeter()
+        telemeter.synthesize("location")
+        location = telemeter.sensors["location"]
+        location.latitude = 55.0+self.rng.random()
+        location.longitude = 12.0+self.rng.random()
+        location.altitude = self.rng.random()*100
+        location.set_update_time(timestamp)
+        location.update_data()
+        telemeter.synthesize("battery")
+        telemeter.sensors["battery"].data = {"charge_percent": self.rng.randint(1, 100), "charging": False}
+
+        packed = msgpack.unpackb(telemeter.packed())
+        packed[Sensor.SID_TIME] = timestamp
+        return msgpack.packb(packed)
+
+    def decode(self, messages):
+        for message in messages:
+            message["content"]
+        return messages
+
+class RPCBenchmark(Benchmark):
+    NAME = "rpc"
+    DEFAULTS = {
+        "states": 40,
+        "runs": 2000,
+        "roundtrips": 500,
+        "seed": 1,
+    }
+
+    # Compares the msgpack wire format of the service RPC with
+    # pickled dictionaries, as sent by earlier versions, both for
+    # encoding and decoding alone, and for round trips over local
+    # connections, using representative messages of each kind.
+
+    AUTHKEY = b"sideband_benchmark"
+
+    def setup(self):
+        self.server = RPCServer(("127.0.0.1", 0), RPCBenchmark.AUTHKEY, lambda opcode, payload, connection: payload)
+        self.server.start()
+        self.client = RPCClient(self.server.listener.address, RPCBenchmark.AUTHKEY, pool_size=1)
+
+        self.pickle_listener = multiprocessing.connection.Listener(("127.0.0.1", 0), authkey=RPCBenchmark.AUTHKEY)
+        threading.Thread(target=self.pickle_server, daemon=True).start()
+        self.pickle_client = multiprocessing.connection.Client(self.pickle_listener.address, authkey=RPCBenchmark.AUTHKEY)
+
+    def teardown(self):
+        self.client.close()
+        self.pickle_client.close()
+
+    def pickle_server(self):
+        connection = self.pickle_listener.accept()
+        try:
+            while True:
+                call = connection.recv()
+                connection.send(call)
+        except EOFError:
+            pass
+
+    def populate(self):
+        states = {}
+        for n in range(self.params["states"]):
+            value = self.rng.choice([True, False, None, time.time(), self.random_bytes(16), "state value "+str(n)])
+            states["app.flags.state_"+str(n)] = value
+
+        telemeter = Telemeter()
+        telemeter.synthesize("location")
+        location = telemeter.sensors["location"]
+        location.latitude = 55.0+self.rng.random()
+        location.longitude = 12.0+self.rng.random()
+        location.altitude = self.rng.random()*100
+        location.update_data()
+        telemeter.synthesize("battery")
+        telemeter.sensors["battery"].data = {"charge_percent": 42, "charging": False}
+        telemeter.synthesize("information")
+        telemeter.sensors["information"].data = {"contents": "Benchmark"}
+
+        self.messages = {
+            "get_changes": (RPCProtocol.GET_CHANGES, [self.random_bytes(8), 1234, states]),
+            "set_states": (RPCProtocol.SET_STATES, {"app.foreground": True, "app.displaying": "conversations_screen"}),
+            "latest_telemetry": (RPCProtocol.LATEST_TELEMETRY, [telemeter.read_all(), telemeter.packed()]),
+        }
+
+    def measure(self):
+        runs = self.params["runs"]
+        for name in self.messages:
+            opcode, payload = self.messages[name]
+            pickled = pickle.dumps({"id": 1, name: payload}, protocol=pickle.HIGHEST_PROTOCOL)
+            packed = RPCProtocol.pack(opcode, 1, payload)
+
+            self.time("encode.pickle."+name, runs, lambda: pickle.dumps({"id": 1, name: payload}, protocol=pickle.HIGHEST_PROTOCOL))
+            self.time("encode.msgpack."+name, runs, lambda: RPCProtocol.pack(opcode, 1, payload))
+            self.time("decode.pickle."+name, runs, lambda: pickle.loads(pickled))
+            self.time("decode.msgpack."+name, runs, lambda: RPCProtocol.unpack(packed))
+            self.results["encode.pickle."+name]["message_bytes"] = len(pickled)
+            self.results["encode.msgpack."+name]["message_bytes"] = len(packed)
+
+        roundtrips = self.params["roundtrips"]
+        for name in self.messages:
+            opcode, payload = self.messages[name]
+            def pickle_roundtrip():
+                self.pickle_client.send({"id": 1, name: payload})
+                self.pickle_client.recv()
+            self.time("roundtrip.pickle."+name, roundtrips, pickle_roundtrip)
+            self.time("roundtrip.msgpack."+name, roundtrips, lambda: self.client.call(opcode, payload))
+
+BENCHMARKS = {
+    "storage": StorageBenchmark,
+    "rpc": RPCBenchmark,
+}
+
+def compare(baseline, current):
+    lines = []
+    lines.append("%-32s %12s %12s %9s" % ("Benchmark", "Baseline", "Current", "Change"))
+    for name in sorted(current["results"]):
+        if name in baseline["results"]:
+            before = baseline["results"][name]["median_ms"]
+            after = current["results"][name]["median_ms"]
+            change = (after-before)/before*100 if before > 0 else 0.0
+            lines.append("%-32s %10.3fms %10.3fms %+8.1f%%" % (name, before, after, change))
+    return "\n".join(lines)
+
+def main():
+    # The parameters depend on the selected benchmark, so it
+    # is determined before the remaining arguments are added
+    if len(sys.argv) > 1 and sys.argv[1] in BENCHMARKS:
+        benchmark = BENCHMARKS[sys.argv[1]]
+    else:
+        benchmark = StorageBenchmark
+
+    parser = argparse.ArgumentParser(description="Sideband benchmarks")
+    parser.add_argument("benchmark", nargs="?", choices=list(BENCHMARKS), default="storage", help="benchmark to run, default is storage")
+    for key in benchmark.DEFAULTS:
+        default = benchmark.DEFAULTS[key]
+        parser.add_argument("--"+key.replace("_", "-"), type=type(default), default=None, help="default is "+str(default))
+    parser.add_argument("-o", "--output", action="store", default=None, help="write results as JSON to this file")
+    parser.add_argument("--compare", action="store", default=None, help="compare results with an earlier JSON result file")
+    if benchmark == StorageBenchmark:
+        parser.add_argument("--path", action="store", default=None, help="build the database in this directory, and keep it")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help="show log output")
+    args = parser.parse_args()
+
+    RNS.loglevel = RNS.LOG_DEBUG if args.verbose else RNS.LOG_CRITICAL
+    params = {key: getattr(args, key) for key in benchmark.DEFAULTS}
+    if benchmark == StorageBenchmark:
+        results = StorageBenchmark(path=args.path, **params).run()
+    else:
+        results = benchmark(**params).run()
+
+    output = json.dumps(results, indent=2)
+    if args.output != None:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    if args.compare != None:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        print(compare(baseline, results), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
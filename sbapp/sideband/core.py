@@ -14,10 +14,15 @@ import RNS.Interfaces.Interface as Interface
 
 import multiprocessing.connection
 
-from threading import Lock
+from threading import Lock, RLock
 from .res import sideband_fb_data
-from .sense import Telemeter, Commands
+from .sense import Telemeter, Commands, Battery
 from .plugins import SidebandCommandPlugin, SidebandServicePlugin, SidebandTelemetryPlugin
+from .archive import ArchiveWriter, ArchiveReader
+from .rpc import RPCClient, RPCServer, RPCProtocol
+from .status import StatusBlock
+from .metrics import Metrics
+from .database import DatabaseWriter, DatabaseReaders, DatabaseMaintenance, DatabaseMigrator, ConversationCache, PersistentCache, MessageRecord, AttachmentStore
 
 if RNS.vendor.platformutils.get_platform() == "android":
     from jnius import autoclass, cast
@@ -91,6 +96,39 @@ class SidebandCore():
     SERVICE_JOB_INTERVAL   = 1
     PERIODIC_JOBS_INTERVAL = 60
     PERIODIC_SYNC_RETRY = 360
+
+    # Telemetry compaction tiers, as [max_age, resolution] pairs. Entries
+    # younger than max_age are kept at one point per resolution seconds,
+    # a resolution of 0 keeps everything, and a max_age of None covers
+    # all remaining older entries.
+    DEFAULT_COMPACTION_TIERS = [[24*60*60, 0], [30*24*60*60, 5*60], [None, 60*60]]
+    COMPACTION_CHUNK_SIZE = 500
+    TEMP_APPEARANCE_TTL = 14*24*60*60
+    PREVIEW_LENGTH = 96
+    DB_MAINTENANCE_MIN_CHARGE = 50
+    DB_MAINTENANCE_OVERDUE = 7*24*60*60
+    ARCHIVE_VERSION = 1
+    ARCHIVE_CHUNK_SIZE = 500
+    ARCHIVE_TABLES = ["conv", "lxm", "telemetry", "telemetry_latest"]
+    ARCHIVE_RESUME_TTL = 30*24*60*60
+    ATTACHMENT_SWEEP_GRACE = 60*60
+
+    # How long, in seconds, cached state values may be used by
+    # clients without checking the service for changes. Values
+    # that change frequently, or that are waited on, get shorter
+    # times than the default, and zero disables caching.
+    STATE_CACHE_TTL = 1.0
+    STATE_RPC_TIMEOUT = 2.5
+    STATUS_BLOCK_RETRY = 5
+    STATUS_BLOCK_STALE = 4.0
+    STATE_CACHE_TTLS = {
+        "service.connectivity_status": 5.0,
+        "init.loadingstate": 0.25,
+        "executing.bt_on": 0,
+        "executing.bt_off": 0,
+        "executing.bt_pair": 0,
+    }
+
     TELEMETRY_INTERVAL = 60
     SERVICE_TELEMETRY_INTERVAL = 300
 
@@ -110,13 +148,26 @@ class SidebandCore():
         self.is_service = is_service
         self.is_client = is_client
         self.is_daemon = is_daemon
-        self.db = None
+        self.db_readers = None
+        self.db_writer = None
+        self.db_maintenance = None
+        self.message_search_available = False
 
         if not self.is_service and not self.is_client:
             self.is_standalone = True
         else:
             self.is_standalone = False
 
+        # When the service and UI run as separate processes, both may
+        # change conversations and persistent values, so the caches
+        # must check for changes made by the other process.
+        if self.is_standalone:
+            self.conversation_cache = ConversationCache()
+            self.persistent_cache = PersistentCache()
+        else:
+            self.conversation_cache = ConversationCache(check_interval=ConversationCache.CHECK_INTERVAL)
+            self.persistent_cache = PersistentCache(check_interval=PersistentCache.CHECK_INTERVAL)
+
         self.log_verbose = verbose
         self.owner_app = owner_app
         self.reticulum = None
@@ -134,7 +185,25 @@ class SidebandCore():
         self.telemetry_request_max_history = 7*24*60*60
         self.state_db = {}
         self.state_lock = Lock()
-        self.rpc_connection = None
+        self.state_notify_lock = RLock()
+        self.state_subscriptions = []
+        self.state_epoch = RNS.Identity.get_random_hash()[:8]
+        self.state_version = 0
+        self.state_versions = {}
+        self.state_stable_version = 0
+        self.state_cache = {}
+        self.state_cache_lock = Lock()
+        self.state_cache_epoch = None
+        self.state_cache_version = 0
+        self.state_cache_validated = 0
+        self.rpc_client = None
+        self.rpc_server = None
+        self.status_block = None
+        self.status_block_retry = 0
+        self.rpc_handlers = {}
+        self.metrics = Metrics()
+        self.metrics.instrument(self, {"getstates": "state.get", "setstates": "state.set"})
+        self.metrics.instrument(self, {name: "db."+name[4:] for name in dir(SidebandCore) if name.startswith("_db_")})
         self.service_stopped = False
         self.service_context = service_context
         self.owner_service = owner_service
@@ -184,11 +253,19 @@ class SidebandCore():
         self.config_path   = self.app_dir+"/app_storage/sideband_config"
         self.identity_path = self.app_dir+"/app_storage/primary_identity"
         self.db_path       = self.app_dir+"/app_storage/sideband.db"
+        self.status_path   = self.app_dir+"/app_storage/status"
         self.lxmf_storage  = self.app_dir+"/app_storage/"
         self.log_dir       = self.app_dir+"/app_storage/"
         self.tmp_dir       = self.app_dir+"/app_storage/tmp"
         self.exports_dir   = self.app_dir+"/exports"
+        self.attachment_store = AttachmentStore(self.app_dir+"/app_storage/attachments")
         self.webshare_dir  = "./share/"
+
+        if self.is_service:
+            self.status_block = StatusBlock.create(self.status_path)
+            if self.status_block != None:
+                with self.state_lock:
+                    self.status_block.write(self.state_epoch, self.state_stable_version, self.state_db)
         
         self.first_run     = True
         self.saving_configuration = False
@@ -212,6 +289,8 @@ class SidebandCore():
             if self.config["debug"]:
                 self.log_verbose = True
 
+            self.metrics.set_enabled(self.log_verbose)
+
             if not os.path.isdir(self.tmp_dir):
                 os.makedirs(self.tmp_dir)
             else:
@@ -372,13 +451,8 @@ class SidebandCore():
         self.config["telemetry_send_to_trusted"] = False
         self.config["telemetry_send_to_collector"] = False
 
-        if not os.path.isfile(self.db_path):
-            self.__db_init()
-        else:
-            self._db_initstate()
-            self._db_initpersistent()
-            self._db_inittelemetry()
-            self._db_upgradetables()
+        self.__db_migrate()
+        self._db_initstate()
 
         self.__save_config()
 
@@ -407,6 +481,7 @@ class SidebandCore():
 
         self.rpc_addr = ("127.0.0.1", 48165)
         self.rpc_key  = RNS.Identity.full_hash(self.identity.get_private_key())
+        self.rpc_client = RPCClient(self.rpc_addr, self.rpc_key, metrics=self.metrics)
 
         RNS.log("Loading Sideband configuration... "+str(self.config_path), RNS.LOG_DEBUG)
         config_file = open(self.config_path, "rb")
@@ -622,6 +697,25 @@ class SidebandCore():
 
         if not "map_history_limit" in self.config:
             self.config["map_history_limit"] = 7*24*60*60
+
+        if not "max_announces" in self.config:
+            self.config["max_announces"] = SidebandCore.MAX_ANNOUNCES
+
+        if not "telemetry_compaction_enabled" in self.config:
+            self.config["telemetry_compaction_enabled"] = False
+        if not "telemetry_compaction_interval" in self.config:
+            self.config["telemetry_compaction_interval"] = 6*60*60
+        if not "telemetry_compaction_tiers" in self.config:
+            self.config["telemetry_compaction_tiers"] = [list(t) for t in SidebandCore.DEFAULT_COMPACTION_TIERS]
+        if not "telemetry_compaction_vacuum" in self.config:
+            self.config["telemetry_compaction_vacuum"] = False
+
+        if not "db_maintenance_enabled" in self.config:
+            self.config["db_maintenance_enabled"] = True
+        if not "db_maintenance_interval" in self.config:
+            self.config["db_maintenance_interval"] = 24*60*60
+        if not "db_vacuum_threshold" in self.config:
+            self.config["db_vacuum_threshold"] = DatabaseMaintenance.VACUUM_THRESHOLD
         if not "map_lat" in self.config:
             self.config["map_lat"] = 0.0
         if not "map_lon" in self.config:
@@ -643,14 +737,8 @@ class SidebandCore():
             self.config["map_storage_file"] = None
 
         # Make sure we have a database
-        if not os.path.isfile(self.db_path):
-            self.__db_init()
-        else:
-            self._db_initstate()
-            self._db_initpersistent()
-            self._db_inittelemetry()
-            self._db_upgradetables()
-            self.__db_indices()
+        self.__db_migrate()
+        self._db_initstate()
 
     def __reload_config(self):
         RNS.log("Reloading Sideband configuration... ", RNS.LOG_DEBUG)
@@ -1008,12 +1096,19 @@ class SidebandCore():
         self._db_conversation_set_name(context_dest, name)
 
     def count_messages(self, context_dest):
+        summary = self._db_conversation_summary(context_dest)
+        if summary != None:
+            return summary["messages"]
+
         result = self._db_message_count(context_dest)
         if result != None:
             return result
         else:
             return None
 
+    def conversation_summary(self, context_dest):
+        return self._db_conversation_summary(context_dest)
+
     def outbound_telemetry_finished(self, message):
         if message.state == LXMF.LXMessage.FAILED and hasattr(message, "try_propagation_on_fail") and message.try_propagation_on_fail:
             RNS.log("Direct delivery of telemetry update "+str(message)+" failed. Retrying as propagated message.", RNS.LOG_VERBOSE)
@@ -1228,30 +1323,46 @@ class SidebandCore():
                 RNS.log("Error while getting own location: "+str(e), RNS.LOG_ERROR)
 
         after_time = time.time()-3*30*24*60*60
-        pts = self.peer_telemetry(context_dest, after=after_time)
-        for pt in pts:
-            try:
-                t = Telemeter.from_packed(pt[1]).read_all()
-                if "location" in t and t["location"] != None:
-                    l = t["location"]
-                    if "latitude" in l and "longitude" in l:
-                        if l["latitude"] != None and l["longitude"] != None:
-                            return l
-            except:
-                pass
+        try:
+            locations = self._db_telemetry_locations(context_dest=context_dest, after=after_time)
+            if context_dest in locations:
+                return locations[context_dest]
+        except Exception as e:
+            RNS.log("An error occurred while retrieving peer location from the database: "+str(e), RNS.LOG_ERROR)
 
         return None
 
-    def list_messages(self, context_dest, after = None, before = None, limit = None):
-        result = self._db_messages(context_dest, after, before, limit)
+    def list_latest_telemetry(self, after = None):
+        try:
+            return self._db_latest_telemetry(after=after)
+        except Exception as e:
+            RNS.log("An error occurred while retrieving latest telemetry from the database: "+str(e), RNS.LOG_ERROR)
+            return {}
+
+    def list_latest_locations(self, after = None):
+        try:
+            return self._db_telemetry_locations(after=after)
+        except Exception as e:
+            RNS.log("An error occurred while retrieving locations from the database: "+str(e), RNS.LOG_ERROR)
+            return {}
+
+    def list_messages(self, context_dest, after = None, before = None, limit = None, before_cursor = None, after_cursor = None):
+        result = self._db_messages(context_dest, after, before, limit, before_cursor=before_cursor, after_cursor=after_cursor)
         if result != None:
             return result
         else:
             return []
 
+    def search_messages(self, query, context_dest = None, limit = 50, cursor = None):
+        try:
+            return self._db_search_messages(query, context_dest=context_dest, limit=limit, cursor=cursor)
+        except Exception as e:
+            RNS.log("An error occurred while searching messages: "+str(e), RNS.LOG_ERROR)
+            return []
+
     def service_available(self):
         now = time.time()
-        service_heartbeat = self.getstate("service.heartbeat")
+        service_heartbeat = self.getstate("service.heartbeat", allow_cache=True)
         if not service_heartbeat:
             RNS.log("No service heartbeat available at "+str(now), RNS.LOG_DEBUG)
             return False
@@ -1277,32 +1388,41 @@ class SidebandCore():
         return self.getstate("app.active_conversation")
 
     def setstate(self, prop, val):
-        with self.state_lock:
-            if not self.service_stopped:
-                if not RNS.vendor.platformutils.is_android():
-                    self.state_db[prop] = val
-                    return True
-                else:
-                    if self.is_service:
-                        self.state_db[prop] = val
-                        return True
-                    else:
-                        def set():
-                            if self.rpc_connection == None:
-                                self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, authkey=self.rpc_key)
-                            self.rpc_connection.send({"setstate": (prop, val)})
-                            response = self.rpc_connection.recv()
-                            return response
+        return self.setstates({prop: val})
+
+    def setstates(self, states):
+        if not self.service_stopped:
+            if not RNS.vendor.platformutils.is_android() or self.is_service:
+                with self.state_notify_lock:
+                    with self.state_lock:
+                        changes = {prop: states[prop] for prop in states if self.state_db.get(prop) != states[prop]}
+                        self.state_db.update(states)
+                        if len(changes) > 0:
+                            self.state_version += 1
+                            for prop in changes:
+                                self.state_versions[prop] = self.state_version
+
+                            # Changes to values held in the status block
+                            # don't advance the version it publishes, so
+                            # clients can keep using their cached state
+                            if any(not prop in StatusBlock.PROPERTIES for prop in changes):
+                                self.state_stable_version = self.state_version
+                            if self.status_block != None:
+                                self.status_block.write(self.state_epoch, self.state_stable_version, self.state_db)
+
+                    if len(changes) > 0 and len(self.state_subscriptions) > 0:
+                        self.__notify_state_changes(changes)
 
-                        try:
-                            set()
-                        except Exception as e:
-                            RNS.log("Error while setting state over RPC: "+str(e)+". Retrying once.", RNS.LOG_DEBUG)
-                            try:
-                                set()
-                            except Exception as e:
-                                RNS.log("Error on retry as well: "+str(e)+". Giving up.", RNS.LOG_DEBUG)
-                                return False
+                return True
+            else:
+                try:
+                    result = self.__rpc_call(RPCProtocol.SET_STATES, states, timeout=SidebandCore.STATE_RPC_TIMEOUT, retry=True)
+                    with self.state_cache_lock:
+                        self.state_cache.update(states)
+                    return result
+                except Exception as e:
+                    RNS.log("Error while setting state over RPC: "+str(e), RNS.LOG_DEBUG)
+                    return False
 
     def service_set_latest_telemetry(self, latest_telemetry, latest_packed_telemetry):
         if not RNS.vendor.platformutils.is_android():
@@ -1314,11 +1434,7 @@ class SidebandCore():
                 return True
             else:
                 try:
-                    if self.rpc_connection == None:
-                        self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, authkey=self.rpc_key)
-                    self.rpc_connection.send({"latest_telemetry": (latest_telemetry, latest_packed_telemetry)})
-                    response = self.rpc_connection.recv()
-                    return response
+                    return self.__rpc_call(RPCProtocol.LATEST_TELEMETRY, [latest_telemetry, latest_packed_telemetry])
                 except Exception as e:
                     RNS.log("Error while setting telemetry over RPC: "+str(e), RNS.LOG_DEBUG)
                     return False
@@ -1332,49 +1448,153 @@ class SidebandCore():
                     RNS.loglevel = 6
                 else:
                     RNS.loglevel = 2
+                self.metrics.set_enabled(debug)
                 return True
             else:
                 try:
-                    if self.rpc_connection == None:
-                        self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, authkey=self.rpc_key)
-                    self.rpc_connection.send({"set_debug": debug})
-                    response = self.rpc_connection.recv()
-                    return response
+                    return self.__rpc_call(RPCProtocol.SET_DEBUG, debug)
                 except Exception as e:
                     RNS.log("Error while setting log level over RPC: "+str(e), RNS.LOG_DEBUG)
                     return False
 
     def getstate(self, prop, allow_cache=False):
+        return self.getstates([prop], allow_cache=allow_cache)[prop]
+
+    def getstates(self, props, allow_cache=False):
+        # Returns a dictionary with the values of all requested
+        # state properties. In client mode, the heartbeat and flags
+        # are read from the status block shared by the service, and
+        # other values from a local copy of the service state. The
+        # copy is up to date as long as the status block shows no
+        # newer version. Otherwise it is first brought up to date in
+        # a single RPC round trip, unless allow_cache is set and the
+        # copy was checked recently enough for all requested values.
+        if self.service_stopped:
+            return dict.fromkeys(props)
+
+        if not RNS.vendor.platformutils.is_android() or self.is_service:
+            with self.state_lock:
+                return {prop: self.state_db.get(prop) for prop in props}
+        else:
+            status = self.__read_status_block()
+            if status != None:
+                epoch, version, values = status
+                with self.state_cache_lock:
+                    if all(prop in values or version <= self.state_cache_version for prop in props):
+                        return {prop: values[prop] if prop in values else self.state_cache.get(prop) for prop in props}
+
+            if allow_cache:
+                with self.state_cache_lock:
+                    age = time.time()-self.state_cache_validated
+                    if all(age < SidebandCore.STATE_CACHE_TTLS.get(prop, SidebandCore.STATE_CACHE_TTL) for prop in props):
+                        return {prop: self.state_cache.get(prop) for prop in props}
+
+            try:
+                self.__sync_state_cache()
+                with self.state_cache_lock:
+                    return {prop: self.state_cache.get(prop) for prop in props}
+            except Exception as e:
+                RNS.log("Error while retrieving state "+str(props)+" over RPC: "+str(e), RNS.LOG_DEBUG)
+                return dict.fromkeys(props)
+
+    def __read_status_block(self):
+        # The status block is only used once its epoch matches the
+        # one of the cached state, which is received from the service
+        # over RPC, and while the service keeps its heartbeat fresh.
+        # Otherwise it may be an old block, and is opened again, since
+        # the file may have been replaced by a restarted service.
+        if self.status_block == None:
+            if time.time() < self.status_block_retry:
+                return None
+            self.status_block = StatusBlock.open(self.status_path)
+            if self.status_block == None:
+                self.status_block_retry = time.time()+SidebandCore.STATUS_BLOCK_RETRY
+                return None
+
+        status = self.status_block.read()
+        if status == None or status[0] != self.state_cache_epoch or not self.__status_block_alive(status):
+            if status != None and self.state_cache_epoch != None and time.time() >= self.status_block_retry:
+                self.status_block.close()
+                self.status_block = None
+                self.status_block_retry = time.time()+SidebandCore.STATUS_BLOCK_RETRY
+            return None
+
+        return status
+
+    def __status_block_alive(self, status):
+        heartbeat = status[2][StatusBlock.HEARTBEAT]
+        return heartbeat != None and time.time()-heartbeat < SidebandCore.STATUS_BLOCK_STALE
+
+    def __sync_state_cache(self):
+        # Fetches all state properties that changed on the service
+        # since the cached version. The service epoch changes when
+        # the service is restarted, in which case the whole state
+        # is sent, and the cache rebuilt.
+        requested = time.time()
+        epoch, version, changes = self.__rpc_call(RPCProtocol.GET_CHANGES, [self.state_cache_epoch, self.state_cache_version], timeout=SidebandCore.STATE_RPC_TIMEOUT)
+        with self.state_cache_lock:
+            if epoch != self.state_cache_epoch:
+                self.state_cache = {}
+                self.state_cache_epoch = epoch
+                self.state_cache_version = 0
+
+            if version >= self.state_cache_version:
+                self.state_cache.update(changes)
+                self.state_cache_version = version
+                self.state_cache_validated = max(self.state_cache_validated, requested)
+
+    def __state_changes(self, epoch, version):
         with self.state_lock:
-            if not self.service_stopped:
-                # TODO: remove
-                # us = time.time()
+            if epoch != self.state_epoch:
+                version = 0
+            changes = {prop: self.state_db.get(prop) for prop in self.state_versions if self.state_versions[prop] > version}
+            return (self.state_epoch, self.state_version, changes)
+
+    def subscribe_states(self, props, callback):
+        # The callback is called with the current values of the
+        # subscribed state properties, and then again with the
+        # changed properties every time any of them change. In
+        # client mode, changes are pushed by the service.
+        if not RNS.vendor.platformutils.is_android() or self.is_service:
+            with self.state_notify_lock:
+                current = self.__add_state_subscription(set(props), callback)
+                RPCClient.notify(callback, current)
+            return True
+        else:
+            try:
+                self.rpc_client.subscribe(props, callback)
+                return True
+            except Exception as e:
+                RNS.log("Could not subscribe to state changes over RPC: "+str(e), RNS.LOG_DEBUG)
+                return False
 
-                if not RNS.vendor.platformutils.is_android():
-                    if prop in self.state_db:
-                        return self.state_db[prop]
-                    else:
-                        return None
-                else:
-                    if self.is_service:
-                        if prop in self.state_db:
-                            return self.state_db[prop]
-                        else:
-                            return None
-                    else:
-                        try:
-                            if self.rpc_connection == None:
-                                self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, authkey=self.rpc_key)
-                            self.rpc_connection.send({"getstate": prop})
-                            response = self.rpc_connection.recv()
-                            # TODO: Remove
-                            # RNS.log("RPC getstate result for "+str(prop)+"="+str(response)+" in "+RNS.prettytime(time.time()-us), RNS.LOG_WARNING)
-                            return response
+    def unsubscribe_states(self, callback):
+        if not RNS.vendor.platformutils.is_android() or self.is_service:
+            with self.state_lock:
+                self.state_subscriptions = [s for s in self.state_subscriptions if s[1] != callback]
+        else:
+            self.rpc_client.unsubscribe(callback)
 
-                        except Exception as e:
-                            RNS.log("Error while retrieving state "+str(prop)+" over RPC: "+str(e), RNS.LOG_DEBUG)
-                            self.rpc_connection = None
-                            return None
+    def __add_state_subscription(self, props, callback):
+        with self.state_lock:
+            self.state_subscriptions.append((props, callback))
+            return {prop: self.state_db.get(prop) for prop in props}
+
+    def __notify_state_changes(self, changes):
+        for props, callback in self.state_subscriptions:
+            subscribed = {prop: changes[prop] for prop in changes if prop in props}
+            if len(subscribed) > 0:
+                RPCClient.notify(callback, subscribed)
+
+    def __rpc_call(self, opcode, payload=None, timeout=None, retry=False):
+        if retry:
+            return self.rpc_client.call_retrying(opcode, payload, timeout=timeout)
+        else:
+            return self.rpc_client.call(opcode, payload, timeout=timeout)
+
+    def __rpc_disconnected(self, connection):
+        if connection.subscription != None:
+            self.unsubscribe_states(connection.subscription[1])
 
     def _get_plugins_info(self):
         np = 0
@@ -1404,11 +1624,7 @@ class SidebandCore():
                 return self._get_plugins_info()
             else:
                 try:
-                    if self.rpc_connection == None:
-                        self.rpc_connection = multiprocessing.connection.Client(self.rpc_addr, authkey=self.rpc_key)
-                    self.rpc_connection.send({"get_plugins_info": True})
-                    response = self.rpc_connection.recv()
-                    return response
+                    return self.__rpc_call(RPCProtocol.GET_PLUGINS_INFO)
                 except Exception as e:
                     ed = "Error while getting plugins info over RPC: "+str(e)
                     RNS.log(ed, RNS.LOG_DEBUG)
@@ -1418,65 +1634,58 @@ class SidebandCore():
     def __start_rpc_listener(self):
         try:
             RNS.log("Starting RPC listener", RNS.LOG_DEBUG)
-            self.rpc_listener = multiprocessing.connection.Listener(self.rpc_addr, authkey=self.rpc_key)
-            thread = threading.Thread(target=self.__rpc_loop)
-            thread.daemon = True
-            thread.start()
+            self.rpc_handlers = {
+                RPCProtocol.GET_CHANGES:      lambda payload, connection: self.__state_changes(*payload),
+                RPCProtocol.SET_STATES:       lambda payload, connection: self.setstates(payload),
+                RPCProtocol.SUBSCRIBE:        self.__rpc_subscribe,
+                RPCProtocol.LATEST_TELEMETRY: self.__rpc_set_latest_telemetry,
+                RPCProtocol.SET_DEBUG:        self.__rpc_set_debug,
+                RPCProtocol.GET_PLUGINS_INFO: lambda payload, connection: self._get_plugins_info(),
+                RPCProtocol.GET_METRICS:      lambda payload, connection: self.get_metrics(reset=payload),
+            }
+            self.rpc_server = RPCServer(self.rpc_addr, self.rpc_key, self.__rpc_dispatch, disconnect_handler=self.__rpc_disconnected, metrics=self.metrics)
+            self.rpc_server.start()
         except Exception as e:
             RNS.log("Could not start RPC listener on "+str(self.rpc_addr)+". Terminating now. Clear up anything using the port and try again.", RNS.LOG_ERROR)
             RNS.panic()
 
-    def __rpc_loop(self):
-        while True:
-            try:
-                RNS.log("Ready for next RPC client", RNS.LOG_DEBUG)
-                rpc_connection = self.rpc_listener.accept()
-                RNS.log("Accepted RPC client", RNS.LOG_DEBUG)
-                
-                def job_factory(connection):
-                    def rpc_client_job():
-                        try:
-                            while connection:
-                                call = connection.recv()
-                                if "getstate" in call:
-                                    prop = call["getstate"]
-                                    connection.send(self.getstate(prop))
-                                elif "setstate" in call:
-                                    prop, val = call["setstate"]
-                                    connection.send(self.setstate(prop, val))
-                                elif "latest_telemetry" in call:
-                                    t,p = call["latest_telemetry"]
-                                    self.latest_telemetry = t
-                                    self.latest_packed_telemetry = p
-                                    connection.send(True)
-                                elif "set_debug" in call:
-                                    self.service_rpc_set_debug(call["set_debug"])
-                                    connection.send(True)
-                                elif "get_plugins_info" in call:
-                                    connection.send(self._get_plugins_info())
-                                else:
-                                    return None
+    def __rpc_dispatch(self, opcode, payload, connection):
+        if not opcode in self.rpc_handlers:
+            raise ValueError("Unknown RPC opcode "+str(opcode))
 
-                        except Exception as e:
-                            RNS.log("Error on client RPC connection: "+str(e), RNS.LOG_ERROR)
-                            try:
-                                connection.close()
-                            except:
-                                pass
+        return self.rpc_handlers[opcode](payload, connection)
 
-                    return rpc_client_job
+    def __rpc_set_latest_telemetry(self, payload, connection):
+        self.latest_telemetry, self.latest_packed_telemetry = payload
+        return True
 
-                threading.Thread(target=job_factory(rpc_connection), daemon=True).start()
+    def __rpc_set_debug(self, payload, connection):
+        self.service_rpc_set_debug(payload)
+        return True
 
-            except Exception as e:
-                RNS.log("An error ocurred while handling RPC call from local client: "+str(e), RNS.LOG_ERROR)
+    def __rpc_subscribe(self, props, connection):
+        # Each client connection has a single subscription, which
+        # is extended with the properties of any later requests.
+        # Changes are sent to the client as events on the same
+        # connection as the RPC responses. The current values are
+        # sent as an event too, so they can never arrive after a
+        # change that happened later.
+        with self.state_notify_lock:
+            if connection.subscription == None:
+                def states_changed(changes):
+                    connection.send_event(RPCProtocol.EVENT_STATES, changes)
+                connection.subscription = (set(props), states_changed)
+                self.__add_state_subscription(*connection.subscription)
+            else:
+                with self.state_lock:
+                    connection.subscription[0].update(props)
+
+            connection.send_event(RPCProtocol.EVENT_STATES, self.getstates(props))
+            return True
 
 
-    def setpersistent(self, prop, val):
-        self._db_setpersistent(prop, val)
-        # def cb():
-        #     self._db_setpersistent(prop, val)
-        # threading.Thread(target=cb, daemon=True).start()
+    def setpersistent(self, prop, val, ttl=None):
+        self._db_setpersistent(prop, val, ttl=ttl)
 
     def getpersistent(self, prop):
         return self._db_getpersistent(prop)
@@ -1485,62 +1694,695 @@ class SidebandCore():
         pass
 
     def __event_conversation_changed(self, context_dest):
-        pass
+        # Lets subscribed UI clients know that messages were added
+        # or changed, so open message views can update.
+        self.setstate("app.flags.last_message", time.time())
 
     def __db_connect(self):
-        if self.db == None:
-            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        if self.db_readers == None:
+            self.__db_writer()
+            self.db_readers = DatabaseReaders(self.db_path)
 
-        return self.db
+        return self.db_readers.connection()
 
-    def __db_init(self):
-        db = self.__db_connect()
-        dbc = db.cursor()
+    def __db_reset(self):
+        if self.db_readers != None:
+            self.db_readers.reset()
 
-        dbc.execute("DROP TABLE IF EXISTS lxm")
-        dbc.execute("CREATE TABLE lxm (lxm_hash BLOB PRIMARY KEY, dest BLOB, source BLOB, title BLOB, tx_ts INTEGER, rx_ts INTEGER, state INTEGER, method INTEGER, t_encrypted INTEGER, t_encryption INTEGER, data BLOB, extra BLOB)")
+    def __db_writer(self):
+        if self.db_writer == None:
+            self.db_writer = DatabaseWriter(self.db_path)
+            self.db_writer.start()
 
-        dbc.execute("DROP TABLE IF EXISTS conv")
-        dbc.execute("CREATE TABLE conv (dest_context BLOB PRIMARY KEY, last_tx INTEGER, last_rx INTEGER, unread INTEGER, type INTEGER, trust INTEGER, name BLOB, data BLOB)")
+        return self.db_writer
 
-        dbc.execute("DROP TABLE IF EXISTS announce")
-        dbc.execute("CREATE TABLE announce (id PRIMARY KEY, received INTEGER, source BLOB, data BLOB, dest_type BLOB)")
+    def __db_write(self, query, data=(), wait=True):
+        return self.__db_writer().execute(query, data, wait=wait)
 
-        dbc.execute("DROP TABLE IF EXISTS telemetry")
-        dbc.execute("CREATE TABLE IF NOT EXISTS telemetry (id INTEGER PRIMARY KEY, dest_context BLOB, ts INTEGER, data BLOB)")
+    def __db_transaction(self, function, wait=True, on_commit=None):
+        return self.__db_writer().transaction(function, wait=wait, on_commit=on_commit)
+
+    def db_flush(self, sync=False):
+        if self.db_writer != None:
+            self.db_writer.flush(sync=sync)
+
+    def db_writer_stats(self):
+        if self.db_writer != None:
+            return self.db_writer.stats()
+        else:
+            return None
+
+    def __db_maintainer(self):
+        if self.db_maintenance == None:
+            self.__db_connect()
+            self.db_maintenance = DatabaseMaintenance(self.__db_writer(), self.db_readers, self.db_path)
+
+        return self.db_maintenance
+
+    def run_db_maintenance(self):
+        try:
+            RNS.log("Running database maintenance", RNS.LOG_DEBUG)
+            self._db_sweep_attachments()
+            self.db_flush()
+            result = self.__db_maintainer().run(vacuum_threshold=self.config["db_vacuum_threshold"])
+            if result == None:
+                RNS.log("Database maintenance is already running", RNS.LOG_DEBUG)
+                return None
 
-        dbc.execute("DROP TABLE IF EXISTS state")
-        dbc.execute("CREATE TABLE state (property BLOB PRIMARY KEY, value BLOB)")
+            RNS.log("Database maintenance completed in "+RNS.prettytime(result["duration"])+", database size is "+RNS.prettysize(result["db_size"]), RNS.LOG_DEBUG)
+            self.setpersistent("db.maintenance.last_run", result["time"])
+            self.setpersistent("db.maintenance.last_result", result)
+            return result
 
-        dbc.execute("DROP TABLE IF EXISTS persistent")
-        dbc.execute("CREATE TABLE persistent (property BLOB PRIMARY KEY, value BLOB)")
+        except Exception as e:
+            RNS.log("An error occurred during database maintenance: "+str(e), RNS.LOG_ERROR)
+            self.setpersistent("db.maintenance.last_run", time.time())
+            return None
 
-        db.commit()
+    def get_metrics(self, reset=False):
+        # Call counts and latencies are collected for RPC calls, state
+        # access and database operations while debug logging is on. On
+        # Android, the metrics of the service process are included.
+        metrics = self.metrics.snapshot()
+        if reset:
+            self.metrics.reset()
+
+        if RNS.vendor.platformutils.is_android() and self.is_client:
+            try:
+                metrics["service"] = self.__rpc_call(RPCProtocol.GET_METRICS, reset)
+            except Exception as e:
+                RNS.log("Error while getting service metrics over RPC: "+str(e), RNS.LOG_DEBUG)
+                metrics["service"] = None
+
+        return metrics
+
+    def get_db_stats(self):
+        # Sizes and page statistics are read live, while row counts
+        # and the integrity check result are those recorded by the
+        # last maintenance run, since they are expensive to produce.
+        maintainer = self.__db_maintainer()
+        last_result = self.getpersistent("db.maintenance.last_result")
+        stats = {
+            "last_maintenance": self.getpersistent("db.maintenance.last_run"),
+            "integrity_ok": last_result["integrity_ok"] if last_result != None else None,
+            "tables": last_result["tables"] if last_result != None else None,
+            "writer": self.db_writer_stats(),
+            "readers": self.db_readers.stats() if self.db_readers != None else None,
+            "conversation_cache": self.conversation_cache_stats(),
+            "persistent_cache": self.persistent_cache_stats(),
+        }
+        stats.update(maintainer.sizes())
+        stats.update(maintainer.pages())
+        return stats
+
+    def __db_maintenance_due(self):
+        now = time.time()
+        last_run = self.getpersistent("db.maintenance.last_run") or 0
+        if now < last_run+self.config["db_maintenance_interval"]:
+            return False
+
+        # Maintenance is deferred while the device runs on battery
+        # and is being used, unless it has been put off for too long.
+        if now > last_run+SidebandCore.DB_MAINTENANCE_OVERDUE:
+            return True
+
+        power = self.__power_state()
+        if power == None or power["charging"]:
+            return True
+        elif power["charge_percent"] != None and power["charge_percent"] < SidebandCore.DB_MAINTENANCE_MIN_CHARGE:
+            return False
+        else:
+            return not self.gui_foreground()
+
+    def __power_state(self):
+        # Returns None on systems without a battery
+        try:
+            battery = Battery()
+            battery.update_data()
+            return battery.data
+        except Exception as e:
+            RNS.log("Could not get battery state: "+str(e), RNS.LOG_DEBUG)
+            return None
+
+    def export_archive(self, path, progress=None):
+        # Exports conversations, messages and telemetry to an archive.
+        # All tables are read within a single read transaction, which
+        # gives a consistent snapshot without blocking the writer, and
+        # rows are streamed into the archive in chunks. Attachments held
+        # in the attachment store are included inline in their messages.
+        self.db_flush()
+        started = time.time()
+        db = sqlite3.connect(self.db_path, timeout=DatabaseReaders.BUSY_TIMEOUT, isolation_level=None)
+        archive = None
+        try:
+            db.execute("PRAGMA query_only=1")
+            db.execute("BEGIN")
+            dbc = db.cursor()
+
+            tables = {}
+            for table in SidebandCore.ARCHIVE_TABLES:
+                columns = [c[1] for c in dbc.execute("PRAGMA table_info("+table+")").fetchall()]
+                columns = [c for c in columns if not (table == "telemetry" and c == "id")]
+                rows = dbc.execute("select count(*) from "+table).fetchone()[0]
+                tables[table] = {"columns": [c for c in columns if c != "spilled"], "rows": rows}
+
+            total = sum([tables[t]["rows"] for t in tables])
+            archive = ArchiveWriter(path)
+            archive.write({
+                "type": "manifest",
+                "version": SidebandCore.ARCHIVE_VERSION,
+                "id": RNS.Identity.get_random_hash(),
+                "created": time.time(),
+                "schema": dbc.execute("PRAGMA user_version").fetchone()[0],
+                "tables": tables,
+            })
+
+            done = 0; seq = 0
+            for table in SidebandCore.ARCHIVE_TABLES:
+                columns = tables[table]["columns"]
+                selected = list(columns)
+                if table == "lxm":
+                    selected.append("spilled")
+
+                dbc.execute("select "+", ".join(selected)+" from "+table)
+                while True:
+                    rows = dbc.fetchmany(SidebandCore.ARCHIVE_CHUNK_SIZE)
+                    if len(rows) == 0:
+                        break
+
+                    if table == "lxm":
+                        rows = [self.__archive_message_row(row, columns) for row in rows]
+                    else:
+                        rows = [list(row) for row in rows]
+
+                    archive.write({"type": "rows", "table": table, "seq": seq, "rows": rows})
+                    seq += 1; done += len(rows)
+                    if progress != None:
+                        progress(done, total)
+
+            archive.write({"type": "end", "frames": seq})
+            archive.close()
+            archive = None
+
+            size = os.path.getsize(path)
+            RNS.log("Exported "+str(done)+" rows to "+str(path)+" ("+RNS.prettysize(size)+") in "+RNS.prettytime(time.time()-started), RNS.LOG_DEBUG)
+            return {"path": path, "rows": done, "size": size}
+
+        finally:
+            if archive != None:
+                archive.abort()
+            try:
+                db.execute("COMMIT")
+            except Exception:
+                pass
+            db.close()
+
+    def __archive_message_row(self, row, columns):
+        row = list(row)
+        spilled = row.pop()
+        if spilled:
+            data_index = columns.index("data")
+            stripped, segments = msgpack.unpackb(row[data_index])
+            row[data_index] = self.attachment_store.join(stripped, segments)
+        return row
+
+    def import_archive(self, path, progress=None):
+        # Merges the contents of an archive into the database. Rows that
+        # already exist are skipped, conversations and latest telemetry
+        # are merged with the local ones, and messages are indexed for
+        # search. Each chunk is merged in its own transaction, which also
+        # records it as the last merged chunk, so an interrupted import
+        # can be resumed by importing the same archive again.
+        started = time.time()
+        reader = ArchiveReader(path)
+        try:
+            manifest = next(reader, None)
+            if manifest == None or manifest.get("type") != "manifest":
+                raise ValueError("The archive "+str(path)+" has no manifest")
+            if manifest["version"] > SidebandCore.ARCHIVE_VERSION:
+                raise ValueError("The archive "+str(path)+" was created by a newer version of Sideband")
+
+            resume_key = "db.import."+RNS.hexrep(manifest["id"], delimit=False)
+            resume_seq = self.getpersistent(resume_key)
+            if resume_seq != None:
+                RNS.log("Resuming import of "+str(path)+" after chunk "+str(resume_seq), RNS.LOG_DEBUG)
+            else:
+                resume_seq = -1
+
+            db = self.__db_connect()
+            local_columns = {}
+            for table in SidebandCore.ARCHIVE_TABLES:
+                local_columns[table] = [c[1] for c in db.execute("PRAGMA table_info("+table+")").fetchall()]
+
+            total = sum([manifest["tables"][t]["rows"] for t in manifest["tables"]])
+            done = 0; imported = {}; complete = False
+            for record in reader:
+                if record["type"] == "rows":
+                    table = record["table"]
+                    if not table in local_columns:
+                        raise ValueError("Unknown table "+str(table)+" in archive "+str(path))
+
+                    if record["seq"] > resume_seq:
+                        columns = manifest["tables"][table]["columns"]
+                        merged = self.__db_import_rows(table, columns, local_columns[table], record["rows"], resume=(resume_key, record["seq"]))
+                        imported[table] = imported.get(table, 0)+merged
+
+                    done += len(record["rows"])
+                    if progress != None:
+                        progress(done, total)
+
+                elif record["type"] == "end":
+                    complete = True
+                    break
+
+            if not complete:
+                raise ValueError("The archive "+str(path)+" is incomplete")
+
+            # Messages in imported conversations that were already read
+            # should not show up as unread.
+            self.__db_write("UPDATE conv_summary SET unread=0, read_ts=max(read_ts, coalesce(last_ts, 0)) WHERE dest_context IN (SELECT dest_context FROM conv WHERE unread=0)")
+            self.setpersistent(resume_key, None)
+            self.conversation_cache.invalidate()
+            self.setstate("app.flags.new_conversations", True)
+            self.setstate("app.flags.last_telemetry", time.time())
+
+            RNS.log("Imported "+str(sum(imported.values()))+" of "+str(total)+" rows from "+str(path)+" in "+RNS.prettytime(time.time()-started), RNS.LOG_DEBUG)
+            return {"rows": total, "imported": imported}
+
+        finally:
+            reader.close()
+
+    def __db_import_rows(self, table, columns, local_columns, rows, resume=None):
+        indices = [i for i, c in enumerate(columns) if c in local_columns]
+        names = [columns[i] for i in indices]
+        placeholders = ", ".join(["?"]*len(names))
+        query = "INSERT INTO "+table+" ("+", ".join(names)+") values ("+placeholders+")"
+
+        if table == "conv":
+            query += " ON CONFLICT(dest_context) DO UPDATE SET last_rx=max(last_rx, excluded.last_rx), last_tx=max(last_tx, excluded.last_tx)"
+        elif table == "telemetry_latest":
+            newer = "excluded.ts>=ts"
+            located = "excluded.loc_ts IS NOT NULL and (loc_ts IS NULL or excluded.loc_ts>=loc_ts)"
+            updates = []
+            for column in names:
+                if column in ["ts", "data", "sensors"]:
+                    updates.append(column+"=(CASE WHEN "+newer+" THEN excluded."+column+" ELSE "+column+" END)")
+                elif column in ["loc_ts", "lat", "lon", "alt", "accuracy"]:
+                    updates.append(column+"=(CASE WHEN "+located+" THEN excluded."+column+" ELSE "+column+" END)")
+            query += " ON CONFLICT(dest_context) DO UPDATE SET "+", ".join(updates)
+        else:
+            query += " ON CONFLICT DO NOTHING"
+
+        def job(dbc):
+            merged = 0
+            for row in rows:
+                dbc.execute(query, [row[i] for i in indices])
+                if dbc.rowcount > 0:
+                    merged += 1
+                    if table == "lxm" and self.message_search_available:
+                        try:
+                            record = dict(zip(columns, row))
+                            lxm = MessageRecord.unpack_lxm(record["method"], record["data"])
+                            self.__db_index_message(dbc, record["lxm_hash"], lxm)
+                        except Exception as e:
+                            RNS.log("Could not index imported message for search: "+str(e), RNS.LOG_ERROR)
+
+            # The resume pointer is written as part of this transaction,
+            # so it can never disagree with the merged rows, and is only
+            # passed on to the persistent value cache once committed.
+            version = None
+            if resume != None:
+                version = self.__db_write_persistent(dbc, resume_key, resume_entry)
+
+            return merged, version
+
+        def committed(result):
+            if resume != None:
+                self.persistent_cache.update(resume_key, resume_entry, result[1])
+
+        if resume != None:
+            resume_key, seq = resume
+            resume_entry = (seq, time.time()+SidebandCore.ARCHIVE_RESUME_TTL)
+
+        merged, version = self.__db_transaction(job, on_commit=committed)
+        return merged
+
+    def conversation_cache_stats(self):
+        return self.conversation_cache.stats()
+
+    def persistent_cache_stats(self):
+        return self.persistent_cache.stats()
+
+    def compact_telemetry(self, tiers=None, vacuum=None):
+        if tiers == None:
+            tiers = self.config["telemetry_compaction_tiers"]
+        if vacuum == None:
+            vacuum = self.config["telemetry_compaction_vacuum"]
+
+        started = time.time()
+        reclaimed = 0
+        try:
+            now = time.time()
+            newer_than = 0
+            for max_age, resolution in sorted(tiers, key=lambda t: float("inf") if t[0] == None else t[0]):
+                end = now-newer_than
+                start = 0 if max_age == None else now-max_age
+                if resolution != None and resolution > 0 and end > start:
+                    cursor = start
+                    while cursor != None:
+                        deleted, cursor = self._db_compact_telemetry(cursor, end, resolution)
+                        reclaimed += deleted
+
+                if max_age == None:
+                    break
+                newer_than = max_age
+
+            if reclaimed > 0:
+                self.__db_writer().analyze()
+                if vacuum:
+                    self.__db_writer().vacuum()
+
+            remaining = self._db_telemetry_count()
+            RNS.log("Telemetry compaction reclaimed "+str(reclaimed)+" entries in "+RNS.prettytime(time.time()-started)+", "+str(remaining)+" entries remain", RNS.LOG_DEBUG)
+            self.setpersistent("telemetry.compaction.last_run", time.time())
+            self.setpersistent("telemetry.compaction.last_reclaimed", reclaimed)
+
+            return {"reclaimed": reclaimed, "remaining": remaining, "duration": time.time()-started}
+
+        except Exception as e:
+            RNS.log("An error occurred while compacting telemetry: "+str(e), RNS.LOG_ERROR)
+            return None
+
+    def __db_migrations(self):
+        # Schema migrations, keyed by the database user_version they
+        # produce. Migrations are never edited once released, schema
+        # changes are always added as a new migration at the end.
+        return [
+            (1, "Create base tables and indices", self.__db_migration_base),
+            (2, "Add decoded location columns to telemetry", self.__db_migration_telemetry_columns),
+            (3, "Decode locations of stored telemetry", self.__db_migration_telemetry_backfill),
+            (4, "Create latest telemetry table", self.__db_migration_telemetry_latest),
+            (5, "Add telemetry timestamp index", self.__db_migration_telemetry_ts_index),
+            (6, "Add conversation change versioning", self.__db_migration_conv_version),
+            (7, "Make telemetry entries unique per source and timestamp", self.__db_migration_telemetry_unique),
+            (8, "Key announces by source", self.__db_migration_announce_source),
+            (9, "Create message search index", self.__db_migration_message_search),
+            (10, "Index stored messages for search", self.__db_migration_message_search_backfill),
+            (11, "Add attachment store references", self.__db_migration_attachments),
+            (12, "Add persistent value expiry and versioning", self.__db_migration_persistent),
+            (13, "Create conversation summaries", self.__db_migration_conv_summary),
+        ]
+
+    def __db_migrate(self):
+        migrator = DatabaseMigrator(self.__db_writer(), self.__db_migrations())
+        try:
+            migrator.migrate(progress=self.__db_migration_progress)
+        except Exception as e:
+            RNS.log("An error occurred while migrating the database: "+str(e), RNS.LOG_ERROR)
+            raise e
 
-    def __db_indices(self):
         db = self.__db_connect()
         dbc = db.cursor()
+        dbc.execute("select count(*) from sqlite_master where type='table' and name='lxm_fts'")
+        self.message_search_available = dbc.fetchone()[0] > 0
+
+    def __db_migration_progress(self, version, description, step, steps, progress):
+        if description == None:
+            RNS.log("Database schema is now at version "+str(version), RNS.LOG_NOTICE)
+        elif progress == None:
+            RNS.log("Applying database migration "+str(step+1)+" of "+str(steps)+": "+str(description), RNS.LOG_NOTICE)
+        else:
+            done, total = progress
+            pct = round((done/total)*100, 1) if total > 0 else 100.0
+            RNS.log("Database migration "+str(step+1)+" of "+str(steps)+" progress: "+str(done)+"/"+str(total)+" ("+str(pct)+"%)", RNS.LOG_NOTICE)
+
+    def __db_migration_base(self, dbc):
+        # Brings both new databases and databases created before schema
+        # versioning was introduced to the same base schema.
+        dbc.execute("CREATE TABLE IF NOT EXISTS lxm (lxm_hash BLOB PRIMARY KEY, dest BLOB, source BLOB, title BLOB, tx_ts INTEGER, rx_ts INTEGER, state INTEGER, method INTEGER, t_encrypted INTEGER, t_encryption INTEGER, data BLOB, extra BLOB)")
+        dbc.execute("CREATE TABLE IF NOT EXISTS conv (dest_context BLOB PRIMARY KEY, last_tx INTEGER, last_rx INTEGER, unread INTEGER, type INTEGER, trust INTEGER, name BLOB, data BLOB)")
+        dbc.execute("CREATE TABLE IF NOT EXISTS announce (id PRIMARY KEY, received INTEGER, source BLOB, data BLOB, dest_type BLOB)")
+        dbc.execute("CREATE TABLE IF NOT EXISTS telemetry (id INTEGER PRIMARY KEY, dest_context BLOB, ts INTEGER, data BLOB)")
+        dbc.execute("CREATE TABLE IF NOT EXISTS state (property BLOB PRIMARY KEY, value BLOB)")
+        dbc.execute("CREATE TABLE IF NOT EXISTS persistent (property BLOB PRIMARY KEY, value BLOB)")
+
+        columns = [c[1] for c in dbc.execute("PRAGMA table_info(lxm)").fetchall()]
+        if not "extra" in columns:
+            dbc.execute("ALTER TABLE lxm ADD COLUMN extra BLOB")
+
         dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_persistent_property ON persistent(property)")
         dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_state_property ON state(property)")
         dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_conv_dest_context ON conv(dest_context)")
-        db.commit()
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_lxm_dest_rx_ts ON lxm(dest, rx_ts)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_lxm_source_rx_ts ON lxm(source, rx_ts)")
+
+    def __db_migration_telemetry_columns(self, dbc):
+        columns = [c[1] for c in dbc.execute("PRAGMA table_info(telemetry)").fetchall()]
+        for column, column_type in [("lat", "REAL"), ("lon", "REAL"), ("alt", "REAL"), ("accuracy", "REAL"), ("sensors", "INTEGER")]:
+            if not column in columns:
+                dbc.execute("ALTER TABLE telemetry ADD COLUMN "+column+" "+column_type)
+
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_dest_context_ts ON telemetry(dest_context, ts)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_located ON telemetry(dest_context, ts) WHERE lat IS NOT NULL")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_located_ts ON telemetry(ts) WHERE lat IS NOT NULL")
+
+    def __db_migration_telemetry_backfill(self, dbc):
+        # Rows that have not been decoded yet have no sensor mask, and
+        # are found through a temporary partial index, so this can be
+        # resumed from any point if interrupted.
+        chunk_size = 1000
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_undecoded ON telemetry(id) WHERE sensors IS NULL")
+        dbc.execute("select id, data from telemetry where sensors is null order by id limit ?", (chunk_size,))
+        rows = dbc.fetchall()
+        if len(rows) == 0:
+            dbc.execute("DROP INDEX IF EXISTS idx_telemetry_undecoded")
+            return None
 
-    def _db_inittelemetry(self):
-        db = self.__db_connect()
-        dbc = db.cursor()
+        updates = []
+        for row in rows:
+            updates.append(self.__telemetry_columns(Telemeter.from_packed(row[1]))+(row[0],))
+        dbc.executemany("UPDATE telemetry set lat=?, lon=?, alt=?, accuracy=?, sensors=? where id=?", updates)
+
+        remaining = dbc.execute("select count(*) from telemetry where sensors is null").fetchone()[0]
+        total = dbc.execute("select count(*) from telemetry").fetchone()[0]
+        return (total-remaining, total)
+
+    def __db_migration_telemetry_latest(self, dbc):
+        # Holds the latest telemetry of each source, along with the
+        # latest known location, which may come from an older entry.
+        dbc.execute("CREATE TABLE IF NOT EXISTS telemetry_latest (dest_context BLOB PRIMARY KEY, ts INTEGER, data BLOB, sensors INTEGER, loc_ts INTEGER, lat REAL, lon REAL, alt REAL, accuracy REAL)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_latest_ts ON telemetry_latest(ts)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_latest_loc_ts ON telemetry_latest(loc_ts)")
+
+        dbc.execute("DELETE FROM telemetry_latest")
+        dbc.execute("INSERT INTO telemetry_latest (dest_context, ts, data, sensors) SELECT dest_context, max(ts), data, sensors FROM telemetry GROUP BY dest_context")
+        dbc.execute("UPDATE telemetry_latest SET (loc_ts, lat, lon, alt, accuracy) = (SELECT ts, lat, lon, alt, accuracy FROM telemetry WHERE telemetry.dest_context=telemetry_latest.dest_context AND lat IS NOT NULL ORDER BY ts DESC LIMIT 1)")
+
+    def __db_migration_telemetry_ts_index(self, dbc):
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_ts ON telemetry(ts)")
+
+    def __db_migration_conv_version(self, dbc):
+        # Every change to the conversation table increments the conv
+        # version, no matter which process or connection made it.
+        dbc.execute("CREATE TABLE IF NOT EXISTS cache_version (name TEXT PRIMARY KEY, version INTEGER)")
+        dbc.execute("INSERT OR IGNORE INTO cache_version (name, version) values ('conv', 0)")
+        for event in ["INSERT", "UPDATE", "DELETE"]:
+            trigger = "CREATE TRIGGER IF NOT EXISTS conv_version_"+event.lower()+" AFTER "+event+" ON conv "
+            trigger += "BEGIN UPDATE cache_version SET version=version+1 WHERE name='conv'; END"
+            dbc.execute(trigger)
+
+    def __db_migration_telemetry_unique(self, dbc):
+        dbc.execute("DELETE FROM telemetry WHERE id NOT IN (SELECT min(id) FROM telemetry GROUP BY dest_context, ts)")
+        dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_telemetry_dest_context_ts_unique ON telemetry(dest_context, ts)")
+        dbc.execute("DROP INDEX IF EXISTS idx_telemetry_dest_context_ts")
+
+    def __db_migration_announce_source(self, dbc):
+        # Keeps only the latest announce from each source, in a table
+        # where new announces are upserted by source.
+        dbc.execute("CREATE TABLE announce_new (source BLOB PRIMARY KEY, received INTEGER, data BLOB, dest_type BLOB)")
+        dbc.execute("INSERT OR REPLACE INTO announce_new (source, received, data, dest_type) SELECT source, received, data, dest_type FROM announce WHERE source IS NOT NULL ORDER BY received ASC")
+        dbc.execute("DROP TABLE announce")
+        dbc.execute("ALTER TABLE announce_new RENAME TO announce")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_announce_received ON announce(received)")
+
+    def __db_migration_message_search(self, dbc):
+        # Message titles and contents are indexed with FTS5. Since the
+        # rowids of the lxm table are not stable across VACUUM, each
+        # indexed message is assigned a permanent id in lxm_search,
+        # which is used as the rowid of its entry in the FTS index.
+        # Triggers remove index entries whenever messages are deleted.
+        try:
+            dbc.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lxm_fts USING fts5(title, content, tokenize='unicode61 remove_diacritics 2')")
+        except Exception as e:
+            RNS.log("Message search is not available, since SQLite on this system has no FTS5 support: "+str(e), RNS.LOG_WARNING)
+            return None
 
-        dbc.execute("CREATE TABLE IF NOT EXISTS telemetry (id INTEGER PRIMARY KEY, dest_context BLOB, ts INTEGER, data BLOB)")
-        db.commit()
+        dbc.execute("CREATE TABLE IF NOT EXISTS lxm_search (id INTEGER PRIMARY KEY, lxm_hash BLOB UNIQUE)")
+        dbc.execute("CREATE TABLE IF NOT EXISTS lxm_search_backfill (id INTEGER PRIMARY KEY, cursor BLOB)")
+        dbc.execute("INSERT OR IGNORE INTO lxm_search_backfill (id, cursor) values (0, x'')")
+        trigger = "CREATE TRIGGER IF NOT EXISTS lxm_search_delete AFTER DELETE ON lxm BEGIN "
+        trigger += "DELETE FROM lxm_fts WHERE rowid IN (SELECT id FROM lxm_search WHERE lxm_hash=old.lxm_hash); "
+        trigger += "DELETE FROM lxm_search WHERE lxm_hash=old.lxm_hash; END"
+        dbc.execute(trigger)
+
+    def __db_migration_message_search_backfill(self, dbc):
+        # Indexes stored messages in order of their hash, keeping
+        # the position reached in lxm_search_backfill, so this can
+        # be resumed from any point if interrupted.
+        if dbc.execute("select count(*) from sqlite_master where type='table' and name='lxm_search_backfill'").fetchone()[0] == 0:
+            return None
 
-    def _db_upgradetables(self):
-        # TODO: Remove this again at some point in the future
-        db = self.__db_connect()
-        dbc = db.cursor()
-        dbc.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'lxm' AND sql LIKE '%extra%'")
-        result = dbc.fetchall()
-        if len(result) == 0:
-            dbc.execute("ALTER TABLE lxm ADD COLUMN extra BLOB")
-        db.commit()
+        chunk_size = 250
+        cursor = dbc.execute("select cursor from lxm_search_backfill where id=0").fetchone()[0]
+        dbc.execute("select lxm_hash, method, data from lxm where lxm_hash>? order by lxm_hash limit ?", (cursor, chunk_size))
+        rows = dbc.fetchall()
+        if len(rows) == 0:
+            dbc.execute("DROP TABLE lxm_search_backfill")
+            return None
+
+        for row in rows:
+            try:
+                lxm = MessageRecord.unpack_lxm(row[1], row[2])
+                self.__db_index_message(dbc, row[0], lxm)
+            except Exception as e:
+                RNS.log("Could not index message "+RNS.prettyhexrep(row[0])+" for search: "+str(e), RNS.LOG_ERROR)
+
+        dbc.execute("UPDATE lxm_search_backfill set cursor=? where id=0", (rows[-1][0],))
+        done = dbc.execute("select count(*) from lxm where lxm_hash<=?", (rows[-1][0],)).fetchone()[0]
+        total = dbc.execute("select count(*) from lxm").fetchone()[0]
+        return (done, total)
+
+    def __db_migration_attachments(self, dbc):
+        # Payloads in the attachment store are reference counted
+        # through lxm_attachments. Deleting a message releases its
+        # references, and payloads left without any are removed by
+        # _db_collect_attachments.
+        columns = [c[1] for c in dbc.execute("PRAGMA table_info(lxm)").fetchall()]
+        if not "spilled" in columns:
+            dbc.execute("ALTER TABLE lxm ADD COLUMN spilled INTEGER DEFAULT 0")
+
+        dbc.execute("CREATE TABLE IF NOT EXISTS attachment (hash BLOB PRIMARY KEY, size INTEGER, refs INTEGER)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_attachment_unreferenced ON attachment(hash) WHERE refs<=0")
+        dbc.execute("CREATE TABLE IF NOT EXISTS lxm_attachments (lxm_hash BLOB, hash BLOB)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_lxm_attachments_lxm_hash ON lxm_attachments(lxm_hash)")
+        dbc.execute("CREATE TRIGGER IF NOT EXISTS lxm_attachments_release AFTER DELETE ON lxm BEGIN DELETE FROM lxm_attachments WHERE lxm_hash=old.lxm_hash; END")
+        dbc.execute("CREATE TRIGGER IF NOT EXISTS attachment_unref AFTER DELETE ON lxm_attachments BEGIN UPDATE attachment SET refs=refs-1 WHERE hash=old.hash; END")
+
+    def __db_migration_persistent(self, dbc):
+        columns = [c[1] for c in dbc.execute("PRAGMA table_info(persistent)").fetchall()]
+        if not "expires" in columns:
+            dbc.execute("ALTER TABLE persistent ADD COLUMN expires REAL")
+        dbc.execute("CREATE INDEX IF NOT EXISTS idx_persistent_expires ON persistent(expires) WHERE expires IS NOT NULL")
+
+        dbc.execute("INSERT OR IGNORE INTO cache_version (name, version) values ('persistent', 0)")
+        for event in ["INSERT", "UPDATE", "DELETE"]:
+            trigger = "CREATE TRIGGER IF NOT EXISTS persistent_version_"+event.lower()+" AFTER "+event+" ON persistent "
+            trigger += "BEGIN UPDATE cache_version SET version=version+1 WHERE name='persistent'; END"
+            dbc.execute(trigger)
+
+    def __db_migration_conv_summary(self, dbc):
+        # Keeps a summary row for every conversation, which is maintained
+        # by triggers in the same transaction as the change to the message
+        # or conversation tables. Message previews can not be produced by
+        # SQLite, and are filled in by the application, with preview_hash
+        # indicating which message the stored preview belongs to.
+        dbc.execute("CREATE TABLE IF NOT EXISTS conv_summary (dest_context BLOB PRIMARY KEY, messages INTEGER DEFAULT 0, unread INTEGER DEFAULT 0, read_ts REAL DEFAULT 0, last_hash BLOB, last_ts REAL, preview TEXT, preview_hash BLOB)")
+
+        def latest(ctx, column):
+            query  = "(select "+column+" from ("
+            query += "select * from (select lxm_hash, rx_ts from lxm where dest="+ctx+" order by rx_ts DESC, lxm_hash DESC limit 1) union all "
+            query += "select * from (select lxm_hash, rx_ts from lxm where source="+ctx+" and dest!="+ctx+" order by rx_ts DESC, lxm_hash DESC limit 1)"
+            query += ") order by rx_ts DESC, lxm_hash DESC limit 1)"
+            return query
+
+        def counted(ctx):
+            query  = "(select count(*) from lxm where dest="+ctx+")+(select count(*) from lxm where source="+ctx+" and dest!="+ctx+")"
+            return query
+
+        # Messages count as unread when they are received from the peer
+        # after the conversation was last read. A conversation is read
+        # up to its latest message when it is marked as read, and when
+        # it is updated while being viewed.
+        trigger  = "CREATE TRIGGER IF NOT EXISTS conv_summary_lxm_insert AFTER INSERT ON lxm BEGIN "
+        trigger += "UPDATE conv_summary SET messages=messages+1, "
+        trigger += "unread=unread+(CASE WHEN new.source=dest_context and new.dest!=dest_context and new.rx_ts>read_ts THEN 1 ELSE 0 END), "
+        newer = "(last_ts IS NULL or new.rx_ts>last_ts or (new.rx_ts=last_ts and new.lxm_hash>last_hash))"
+        trigger += "last_hash=(CASE WHEN "+newer+" THEN new.lxm_hash ELSE last_hash END), "
+        trigger += "last_ts=(CASE WHEN "+newer+" THEN new.rx_ts ELSE last_ts END) "
+        trigger += "WHERE dest_context IN (new.dest, new.source); END"
+        dbc.execute(trigger)
+
+        trigger  = "CREATE TRIGGER IF NOT EXISTS conv_summary_lxm_delete AFTER DELETE ON lxm BEGIN "
+        trigger += "UPDATE conv_summary SET messages=messages-1, "
+        trigger += "unread=unread-(CASE WHEN old.source=dest_context and old.dest!=dest_context and old.rx_ts>read_ts THEN 1 ELSE 0 END) "
+        trigger += "WHERE dest_context IN (old.dest, old.source); "
+        for ctx in ["old.dest", "old.source"]:
+            trigger += "UPDATE conv_summary SET last_hash="+latest(ctx, "lxm_hash")+", last_ts="+latest(ctx, "rx_ts")+" "
+            trigger += "WHERE dest_context="+ctx+" and last_hash=old.lxm_hash; "
+        trigger += "END"
+        dbc.execute(trigger)
+
+        trigger  = "CREATE TRIGGER IF NOT EXISTS conv_summary_conv_insert AFTER INSERT ON conv BEGIN "
+        trigger += "INSERT OR REPLACE INTO conv_summary (dest_context, messages, unread, read_ts, last_hash, last_ts) values "
+        trigger += "(new.dest_context, "+counted("new.dest_context")+", "
+        trigger += "(select count(*) from lxm where source=new.dest_context and dest!=new.dest_context), 0, "
+        trigger += latest("new.dest_context", "lxm_hash")+", "+latest("new.dest_context", "rx_ts")+"); END"
+        dbc.execute(trigger)
+
+        trigger  = "CREATE TRIGGER IF NOT EXISTS conv_summary_conv_read AFTER UPDATE OF unread, last_tx ON conv WHEN new.unread=0 BEGIN "
+        trigger += "UPDATE conv_summary SET unread=0, read_ts=max(read_ts, coalesce(last_ts, 0)) WHERE dest_context=new.dest_context; END"
+        dbc.execute(trigger)
+
+        dbc.execute("CREATE TRIGGER IF NOT EXISTS conv_summary_conv_delete AFTER DELETE ON conv BEGIN DELETE FROM conv_summary WHERE dest_context=old.dest_context; END")
+
+        # For existing conversations, it is not known when they were last
+        # read. Unread conversations are assumed to have been read when a
+        # message was last sent or viewed in them.
+        query  = "INSERT OR IGNORE INTO conv_summary (dest_context, messages, last_hash, last_ts) "
+        query += "SELECT dest_context, "+counted("conv.dest_context")+", "+latest("conv.dest_context", "lxm_hash")+", "+latest("conv.dest_context", "rx_ts")+" FROM conv"
+        dbc.execute(query)
+        dbc.execute("UPDATE conv_summary SET read_ts=coalesce(last_ts, 0) WHERE dest_context IN (SELECT dest_context FROM conv WHERE unread=0)")
+        query  = "UPDATE conv_summary SET read_ts=coalesce((SELECT last_tx FROM conv WHERE conv.dest_context=conv_summary.dest_context), 0), "
+        query += "unread=(SELECT count(*) FROM lxm WHERE source=conv_summary.dest_context and dest!=conv_summary.dest_context "
+        query += "and rx_ts>coalesce((SELECT last_tx FROM conv WHERE conv.dest_context=conv_summary.dest_context), 0)) "
+        query += "WHERE dest_context IN (SELECT dest_context FROM conv WHERE unread!=0)"
+        dbc.execute(query)
+
+    def __db_index_message(self, dbc, lxm_hash, lxm):
+        dbc.execute("INSERT OR IGNORE INTO lxm_search (lxm_hash) values (?)", (lxm_hash,))
+        if dbc.rowcount > 0:
+            title = lxm.title.decode("utf-8", errors="replace") if isinstance(lxm.title, bytes) else str(lxm.title)
+            content = lxm.content.decode("utf-8", errors="replace") if isinstance(lxm.content, bytes) else str(lxm.content)
+            dbc.execute("INSERT INTO lxm_fts (rowid, title, content) values (?, ?, ?)", (dbc.lastrowid, title, content))
+
+    def __db_update_telemetry_latest(self, dbc, context_dest, timestamp, telemetry, columns):
+        lat, lon, alt, accuracy, sensors = columns
+        query = "INSERT INTO telemetry_latest (dest_context, ts, data, sensors) values (:ctx, :ts, :data, :sensors) "
+        query += "ON CONFLICT(dest_context) DO UPDATE SET ts=excluded.ts, data=excluded.data, sensors=excluded.sensors WHERE excluded.ts>=telemetry_latest.ts"
+        dbc.execute(query, {"ctx": context_dest, "ts": timestamp, "data": telemetry, "sensors": sensors})
+
+        if lat != None and lon != None:
+            query = "UPDATE telemetry_latest SET loc_ts=:ts, lat=:lat, lon=:lon, alt=:alt, accuracy=:accuracy where dest_context=:ctx and (loc_ts is null or loc_ts<=:ts)"
+            dbc.execute(query, {"ctx": context_dest, "ts": timestamp, "lat": lat, "lon": lon, "alt": alt, "accuracy": accuracy})
+
+    def __telemetry_columns(self, telemeter):
+        # Returns the values for the decoded location and sensor mask
+        # columns of a telemetry row. The sensor mask has a bit set for
+        # the SID of every sensor present in the telemetry.
+        lat = None; lon = None; alt = None; accuracy = None; sensors = 0
+        if telemeter != None:
+            for sensor in telemeter.sensors:
+                if sensor in telemeter.available:
+                    sensors |= 1 << telemeter.available[sensor]
+
+            l = telemeter.read("location")
+            if l != None and "latitude" in l and "longitude" in l:
+                if l["latitude"] != None and l["longitude"] != None:
+                    lat = l["latitude"]; lon = l["longitude"]
+                    if "altitude" in l: alt = l["altitude"]
+                    if "accuracy" in l: accuracy = l["accuracy"]
+
+        return (lat, lon, alt, accuracy, sensors)
 
     def _db_initstate(self):
         # db = self.__db_connect()
@@ -1612,87 +2454,104 @@ class SidebandCore():
     #         RNS.log("An error occurred during setstate database operation: "+str(e), RNS.LOG_ERROR)
     #         self.db = None
 
-    def _db_initpersistent(self):
-        db = self.__db_connect()
-        dbc = db.cursor()
-
-        dbc.execute("CREATE TABLE IF NOT EXISTS persistent (property BLOB PRIMARY KEY, value BLOB)")
-        db.commit()
-
     def _db_getpersistent(self, prop):
         try:
-            db = self.__db_connect()
-            dbc = db.cursor()
-            
-            query = "select * from persistent where property=:uprop"
-            dbc.execute(query, {"uprop": prop.encode("utf-8")})
-            result = dbc.fetchall()
+            entry = self.persistent_cache.get(prop, self.__db_load_persistent, self.__db_persistent_version)
+            if entry == None:
+                return None
 
-            if len(result) < 1:
+            val, expires = entry
+            if expires != None and expires < time.time():
                 return None
-            else:
-                try:
-                    entry = result[0]
-                    val = msgpack.unpackb(entry[1])
-                    if val == None:
-                        query = "delete from persistent where (property=:uprop);"
-                        dbc.execute(query, {"uprop": prop.encode("utf-8")})
-                        db.commit()
-
-                    return val
-                except Exception as e:
-                    RNS.log("Could not unpack persistent value from database for property \""+str(prop)+"\". The contained exception was: "+str(e), RNS.LOG_ERROR)
-                    return None
-        
+
+            return val
+
         except Exception as e:
             RNS.log("An error occurred during persistent getstate database operation: "+str(e), RNS.LOG_ERROR)
-            self.db = None
+            self.__db_reset()
 
-    def _db_setpersistent(self, prop, val):
+    def _db_setpersistent(self, prop, val, ttl=None):
+        # Values are cached immediately, and written to the database
+        # asynchronously, so frequent updates are grouped into shared
+        # transactions. Setting a value to None removes it.
         try:
-            db = self.__db_connect()
-            dbc = db.cursor()
-            uprop = prop.encode("utf-8")
-            bval = msgpack.packb(val)
+            expires = time.time()+ttl if ttl != None else None
+            entry = (val, expires) if val != None else None
+            sequence = self.persistent_cache.set(prop, entry)
 
-            if self._db_getpersistent(prop) == None:
-                try:
-                    query = "INSERT INTO persistent (property, value) values (?, ?)"
-                    data = (uprop, bval)
-                    dbc.execute(query, data)
-                    db.commit()
-        
-                except Exception as e:
-                    RNS.log("Error while setting persistent state property "+str(prop)+" in DB: "+str(e), RNS.LOG_ERROR)
-                    RNS.log("Retrying as update query...")
-                    query = "UPDATE state set value=:bval where property=:uprop;"
-                    dbc.execute(query, {"bval": bval, "uprop": uprop})
-                    db.commit()
+            def job(dbc):
+                return self.__db_write_persistent(dbc, prop, entry)
+
+            def committed(version):
+                self.persistent_cache.committed(prop, sequence, version)
+
+            self.__db_transaction(job, wait=False, on_commit=committed)
 
-            else:
-                query = "UPDATE persistent set value=:bval where property=:uprop;"
-                dbc.execute(query, {"bval": bval, "uprop": uprop})
-                db.commit()
-        
         except Exception as e:
             RNS.log("An error occurred during persistent setstate database operation: "+str(e), RNS.LOG_ERROR)
-            self.db = None
 
-    def _db_conversation_update_txtime(self, context_dest):
+    def __db_write_persistent(self, dbc, prop, entry):
+        # Writes a persistent value as part of a running transaction,
+        # and returns the resulting table version for the cache.
+        uprop = prop.encode("utf-8")
+        if entry == None:
+            dbc.execute("delete from persistent where property=?", (uprop,))
+        else:
+            val, expires = entry
+            query = "INSERT INTO persistent (property, value, expires) values (:uprop, :bval, :expires) "
+            query += "ON CONFLICT(property) DO UPDATE SET value=excluded.value, expires=excluded.expires"
+            dbc.execute(query, {"uprop": uprop, "bval": msgpack.packb(val), "expires": expires})
+        return dbc.execute("select version from cache_version where name='persistent'").fetchone()[0]
+
+    def __db_persistent_version(self):
         db = self.__db_connect()
         dbc = db.cursor()
+        dbc.execute("select version from cache_version where name='persistent'")
+        return dbc.fetchone()[0]
+
+    def __db_load_persistent(self):
+        version = self.__db_persistent_version()
+        db = self.__db_connect()
+        dbc = db.cursor()
+        dbc.execute("select property, value, expires from persistent")
+
+        entries = {}
+        for row in dbc.fetchall():
+            try:
+                prop = row[0].decode("utf-8") if isinstance(row[0], bytes) else row[0]
+                entries[prop] = (msgpack.unpackb(row[1]), row[2])
+            except Exception as e:
+                RNS.log("Could not unpack persistent value from database for property \""+str(row[0])+"\". The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+        return version, entries
+
+    def _db_expire_persistent(self):
+        query = "delete from persistent where expires is not null and expires<?"
+        expired = self.__db_write(query, (time.time(),))
+        if expired > 0:
+            self.persistent_cache.invalidate()
+        return expired
+
+    def __db_conversation_write(self, context_dest, query, data):
+        # Writes to the conversation table, and passes the resulting
+        # row and table version on to the conversation cache.
+        def job(dbc):
+            dbc.execute(query, data)
+            dbc.execute("select * from conv where dest_context=?", (context_dest,))
+            row = dbc.fetchone()
+            version = dbc.execute("select version from cache_version where name='conv'").fetchone()[0]
+            return row, version
 
+        row, version = self.__db_transaction(job)
+        conv = self.__conversation_from_row(row) if row != None else None
+        self.conversation_cache.update(context_dest, conv, version)
+
+    def _db_conversation_update_txtime(self, context_dest):
         query = "UPDATE conv set last_tx = ? where dest_context = ?"
         data = (time.time(), context_dest)
-
-        dbc.execute(query, data)
-        result = dbc.fetchall()
-        db.commit()
+        self.__db_conversation_write(context_dest, query, data)
 
     def _db_conversation_set_unread(self, context_dest, unread, tx = False):
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         if unread:
             if tx:
                 query = "UPDATE conv set unread = ?, last_tx = ? where dest_context = ?"
@@ -1704,9 +2563,7 @@ class SidebandCore():
             query = "UPDATE conv set unread = ? where dest_context = ?"
             data = (unread, context_dest)
 
-        dbc.execute(query, data)
-        result = dbc.fetchall()
-        db.commit()
+        self.__db_conversation_write(context_dest, query, data)
 
     def _db_telemetry(self, context_dest = None, after = None, before = None, limit = None):
         db = self.__db_connect()
@@ -1762,71 +2619,74 @@ class SidebandCore():
             
             return results
 
+    def _db_telemetry_locations(self, context_dest = None, after = None):
+        # Returns the latest known location of each telemetry source,
+        # using only the decoded location columns.
+        db = self.__db_connect()
+        dbc = db.cursor()
+
+        params = {"after_ts": after if after != None else 0}
+        query = "select dest_context, loc_ts, lat, lon, alt, accuracy from telemetry_latest where loc_ts>:after_ts"
+        if context_dest != None:
+            query += " and dest_context=:context_dest"
+            params["context_dest"] = context_dest
+
+        dbc.execute(query, params)
+        result = dbc.fetchall()
+
+        locations = {}
+        for entry in result:
+            locations[entry[0]] = {
+                "latitude": entry[2],
+                "longitude": entry[3],
+                "altitude": entry[4],
+                "accuracy": entry[5],
+                "last_update": entry[1],
+            }
+
+        return locations
+
+    def _db_latest_telemetry(self, after = None):
+        db = self.__db_connect()
+        dbc = db.cursor()
+
+        query = "select dest_context, ts, data, loc_ts, lat, lon, alt, accuracy from telemetry_latest where ts>:after_ts order by ts DESC"
+        dbc.execute(query, {"after_ts": after if after != None else 0})
+        result = dbc.fetchall()
+
+        results = {}
+        for entry in result:
+            location = None
+            if entry[4] != None and entry[5] != None:
+                location = {
+                    "latitude": entry[4],
+                    "longitude": entry[5],
+                    "altitude": entry[6],
+                    "accuracy": entry[7],
+                    "last_update": entry[3],
+                }
+
+            results[entry[0]] = [entry[1], entry[2], location]
+
+        return results
+
     def _db_save_telemetry(self, context_dest, telemetry, physical_link = None, source_dest = None, via = None):
         try:
-            remote_telemeter = Telemeter.from_packed(telemetry)
-            read_telemetry = remote_telemeter.read_all()
-            telemetry_timestamp = read_telemetry["time"]["utc"]
-
-            db = self.__db_connect()
-            dbc = db.cursor()
+            telemetry_timestamp, telemetry, columns = self.__prepare_telemetry(telemetry, physical_link=physical_link, source_dest=source_dest, via=via)
+            def job(dbc):
+                query = "INSERT OR IGNORE INTO telemetry (dest_context, ts, data, lat, lon, alt, accuracy, sensors) values (?, ?, ?, ?, ?, ?, ?, ?)"
+                data = (context_dest, telemetry_timestamp, telemetry)+columns
+                dbc.execute(query, data)
+                if dbc.rowcount == 0:
+                    return False
 
-            query = "select * from telemetry where dest_context=:ctx and ts=:tts"
-            dbc.execute(query, {"ctx": context_dest, "tts": telemetry_timestamp})
-            result = dbc.fetchall()
+                self.__db_update_telemetry_latest(dbc, context_dest, telemetry_timestamp, telemetry, columns)
+                return True
 
-            if len(result) != 0:
+            if not self.__db_transaction(job):
                 RNS.log("Telemetry entry with source "+RNS.prettyhexrep(context_dest)+" and timestamp "+str(telemetry_timestamp)+" already exists, skipping save", RNS.LOG_DEBUG)
                 return None
 
-            if physical_link != None and len(physical_link) != 0:
-                remote_telemeter.synthesize("physical_link")
-                if "rssi" in physical_link: remote_telemeter.sensors["physical_link"].rssi = physical_link["rssi"]
-                if "snr" in physical_link: remote_telemeter.sensors["physical_link"].snr = physical_link["snr"]
-                if "q" in physical_link: remote_telemeter.sensors["physical_link"].q = physical_link["q"]
-                remote_telemeter.sensors["physical_link"].update_data()
-                telemetry = remote_telemeter.packed()
-
-            if source_dest != None:
-                remote_telemeter.synthesize("received")
-                remote_telemeter.sensors["received"].by = self.lxmf_destination.hash
-                remote_telemeter.sensors["received"].via = source_dest
-
-                rl = remote_telemeter.read("location")
-                if rl and "latitude" in rl and "longitude" in rl and "altitude" in rl:
-                    if self.latest_telemetry != None and "location" in self.latest_telemetry:
-                        ol = self.latest_telemetry["location"]
-                        if ol != None:
-                            if "latitude" in ol and "longitude" in ol and "altitude" in ol:
-                                olat = ol["latitude"]; olon = ol["longitude"]; oalt = ol["altitude"]
-                                rlat = rl["latitude"]; rlon = rl["longitude"]; ralt = rl["altitude"]
-                                if olat != None and olon != None and oalt != None:
-                                    if rlat != None and rlon != None and ralt != None:
-                                        remote_telemeter.sensors["received"].set_distance(
-                                            (olat, olon, oalt), (rlat, rlon, ralt)
-                                        )
-
-                remote_telemeter.sensors["received"].update_data()
-                telemetry = remote_telemeter.packed()
-
-            if via != None:
-                if not "received" in remote_telemeter.sensors:
-                    remote_telemeter.synthesize("received")
-
-                if "by" in remote_telemeter.sensors["received"].data:
-                    remote_telemeter.sensors["received"].by = remote_telemeter.sensors["received"].data["by"]
-                if "distance" in remote_telemeter.sensors["received"].data:
-                    remote_telemeter.sensors["received"].geodesic_distance = remote_telemeter.sensors["received"].data["distance"]["geodesic"]
-                    remote_telemeter.sensors["received"].euclidian_distance = remote_telemeter.sensors["received"].data["distance"]["euclidian"]
-
-                remote_telemeter.sensors["received"].via = via
-                remote_telemeter.sensors["received"].update_data()
-                telemetry = remote_telemeter.packed()
-                
-            query = "INSERT INTO telemetry (dest_context, ts, data) values (?, ?, ?)"
-            data = (context_dest, telemetry_timestamp, telemetry)
-            dbc.execute(query, data)
-            db.commit()
             self.setstate("app.flags.last_telemetry", time.time())
 
             return telemetry
@@ -1836,16 +2696,137 @@ class SidebandCore():
             exception_info = "".join(traceback.TracebackException.from_exception(e).format())
             RNS.log(f"A {str(type(e))} occurred while saving telemetry to database: {str(e)}", RNS.LOG_ERROR)
             RNS.log(exception_info, RNS.LOG_ERROR)
-            self.db = None
+            self.__db_reset()
+
+    def _db_save_telemetry_stream(self, stream, via = None):
+        # Saves all entries of a telemetry stream in a single write
+        # transaction. Entries that already exist are skipped by the
+        # unique index on source and timestamp. The latest telemetry
+        # and appearance are only updated for sources that had new
+        # entries saved, and appearance updates are coalesced to one
+        # per source, using the newest new entry that carries one.
+        # Returns the number of new entries saved.
+        entries = []
+        for telemetry_entry in stream:
+            try:
+                tsource = telemetry_entry[0]
+                ttstamp = telemetry_entry[1]
+                tpacked = telemetry_entry[2]
+                appearance = telemetry_entry[3]
+
+                telemetry_timestamp, telemetry, columns = self.__prepare_telemetry(tpacked, via=via)
+                entries.append((tsource, ttstamp, appearance, telemetry_timestamp, telemetry, columns))
+
+            except Exception as e:
+                RNS.log("Skipping invalid telemetry stream entry: "+str(e), RNS.LOG_ERROR)
+
+        if len(entries) == 0:
+            return 0
+
+        appearances = {}
+        def job(dbc):
+            latest = {}; latest_located = {}
+            query = "INSERT OR IGNORE INTO telemetry (dest_context, ts, data, lat, lon, alt, accuracy, sensors) values (?, ?, ?, ?, ?, ?, ?, ?)"
+            inserted = 0
+            for tsource, ttstamp, appearance, telemetry_timestamp, telemetry, columns in entries:
+                dbc.execute(query, (tsource, telemetry_timestamp, telemetry)+columns)
+                if dbc.rowcount < 1:
+                    continue
+
+                inserted += 1
+                entry = (telemetry_timestamp, telemetry, columns)
+                if not tsource in latest or latest[tsource][0] <= telemetry_timestamp:
+                    latest[tsource] = entry
+                if columns[0] != None and (not tsource in latest_located or latest_located[tsource][0] <= telemetry_timestamp):
+                    latest_located[tsource] = entry
+                if appearance != None and (not tsource in appearances or appearances[tsource][0] <= ttstamp):
+                    appearances[tsource] = (ttstamp, appearance)
+
+            # The newest located entry is applied first, so the newest
+            # entry overall always ends up as the latest.
+            for changed in [latest_located, latest]:
+                for tsource in changed:
+                    timestamp, telemetry, columns = changed[tsource]
+                    self.__db_update_telemetry_latest(dbc, tsource, timestamp, telemetry, columns)
+
+            return inserted
+
+        try:
+            inserted = self.__db_transaction(job)
+        except Exception as e:
+            RNS.log("An error occurred while saving telemetry stream to database: "+str(e), RNS.LOG_ERROR)
+            return 0
+
+        RNS.log("Saved "+str(inserted)+" of "+str(len(entries))+" telemetry stream entries", RNS.LOG_DEBUG)
+        if inserted > 0:
+            for tsource in appearances:
+                ttstamp, appearance = appearances[tsource]
+                self._db_update_appearance(tsource, ttstamp, appearance, from_bulk_telemetry=True)
+
+            self.setstate("app.flags.last_telemetry", time.time())
+
+        return inserted
+
+    def __prepare_telemetry(self, telemetry, physical_link = None, source_dest = None, via = None):
+        # Adds any reception details to the telemetry, and returns its
+        # timestamp, the resulting packed telemetry and the values for
+        # the decoded telemetry columns.
+        remote_telemeter = Telemeter.from_packed(telemetry)
+        read_telemetry = remote_telemeter.read_all()
+        telemetry_timestamp = read_telemetry["time"]["utc"]
+
+        if physical_link != None and len(physical_link) != 0:
+            remote_telemeter.synthesize("physical_link")
+            if "rssi" in physical_link: remote_telemeter.sensors["physical_link"].rssi = physical_link["rssi"]
+            if "snr" in physical_link: remote_telemeter.sensors["physical_link"].snr = physical_link["snr"]
+            if "q" in physical_link: remote_telemeter.sensors["physical_link"].q = physical_link["q"]
+            remote_telemeter.sensors["physical_link"].update_data()
+            telemetry = remote_telemeter.packed()
+
+        if source_dest != None:
+            remote_telemeter.synthesize("received")
+            remote_telemeter.sensors["received"].by = self.lxmf_destination.hash
+            remote_telemeter.sensors["received"].via = source_dest
+
+            rl = remote_telemeter.read("location")
+            if rl and "latitude" in rl and "longitude" in rl and "altitude" in rl:
+                if self.latest_telemetry != None and "location" in self.latest_telemetry:
+                    ol = self.latest_telemetry["location"]
+                    if ol != None:
+                        if "latitude" in ol and "longitude" in ol and "altitude" in ol:
+                            olat = ol["latitude"]; olon = ol["longitude"]; oalt = ol["altitude"]
+                            rlat = rl["latitude"]; rlon = rl["longitude"]; ralt = rl["altitude"]
+                            if olat != None and olon != None and oalt != None:
+                                if rlat != None and rlon != None and ralt != None:
+                                    remote_telemeter.sensors["received"].set_distance(
+                                        (olat, olon, oalt), (rlat, rlon, ralt)
+                                    )
+
+            remote_telemeter.sensors["received"].update_data()
+            telemetry = remote_telemeter.packed()
+
+        if via != None:
+            if not "received" in remote_telemeter.sensors:
+                remote_telemeter.synthesize("received")
+
+            if "by" in remote_telemeter.sensors["received"].data:
+                remote_telemeter.sensors["received"].by = remote_telemeter.sensors["received"].data["by"]
+            if "distance" in remote_telemeter.sensors["received"].data:
+                remote_telemeter.sensors["received"].geodesic_distance = remote_telemeter.sensors["received"].data["distance"]["geodesic"]
+                remote_telemeter.sensors["received"].euclidian_distance = remote_telemeter.sensors["received"].data["distance"]["euclidian"]
+
+            remote_telemeter.sensors["received"].via = via
+            remote_telemeter.sensors["received"].update_data()
+            telemetry = remote_telemeter.packed()
+
+        return telemetry_timestamp, telemetry, self.__telemetry_columns(remote_telemeter)
 
     def _db_update_appearance(self, context_dest, timestamp, appearance, from_bulk_telemetry=False):
         conv = self._db_conversation(context_dest)
 
         if conv == None:
             ae = [appearance, int(time.time())]
-            # TODO: Clean out these temporary values at some interval.
-            # Probably expire after 14 days or so.
-            self.setpersistent("temp.peer_appearance."+RNS.hexrep(context_dest, delimit=False), ae)
+            self.setpersistent("temp.peer_appearance."+RNS.hexrep(context_dest, delimit=False), ae, ttl=SidebandCore.TEMP_APPEARANCE_TTL)
         
         else:
             data_dict = conv["data"]
@@ -1863,14 +2844,9 @@ class SidebandCore():
                 data_dict["appearance"] = appearance
                 packed_dict = msgpack.packb(data_dict)
             
-                db = self.__db_connect()
-                dbc = db.cursor()
-            
                 query = "UPDATE conv set data = ? where dest_context = ?"
                 data = (packed_dict, context_dest)
-                dbc.execute(query, data)
-                result = dbc.fetchall()
-                db.commit()
+                self.__db_conversation_write(context_dest, query, data)
 
     def _db_get_appearance(self, context_dest, conv = None, raw=False):
         if context_dest == self.lxmf_destination.hash:
@@ -1927,14 +2903,9 @@ class SidebandCore():
         data_dict["telemetry"] = send_telemetry
         packed_dict = msgpack.packb(data_dict)
         
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         query = "UPDATE conv set data = ? where dest_context = ?"
         data = (packed_dict, context_dest)
-        dbc.execute(query, data)
-        result = dbc.fetchall()
-        db.commit()
+        self.__db_conversation_write(context_dest, query, data)
 
     def _db_conversation_set_requests(self, context_dest, allow_requests=False):
         conv = self._db_conversation(context_dest)
@@ -1945,39 +2916,30 @@ class SidebandCore():
         data_dict["allow_requests"] = allow_requests
         packed_dict = msgpack.packb(data_dict)
         
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         query = "UPDATE conv set data = ? where dest_context = ?"
         data = (packed_dict, context_dest)
-        dbc.execute(query, data)
-        result = dbc.fetchall()
-        db.commit()
+        self.__db_conversation_write(context_dest, query, data)
 
     def _db_conversation_set_trusted(self, context_dest, trusted):
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         query = "UPDATE conv set trust = ? where dest_context = ?"
         data = (trusted, context_dest)
-        dbc.execute(query, data)
-        result = dbc.fetchall()
-        db.commit()
+        self.__db_conversation_write(context_dest, query, data)
 
     def _db_conversation_set_name(self, context_dest, name):
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         query = "UPDATE conv set name=:name_data where dest_context=:ctx;"
-        dbc.execute(query, {"ctx": context_dest, "name_data": name.encode("utf-8")})
-        result = dbc.fetchall()
-        db.commit()
+        self.__db_conversation_write(context_dest, query, {"ctx": context_dest, "name_data": name.encode("utf-8")})
 
     def _db_conversations(self):
         db = self.__db_connect()
         dbc = db.cursor()
-        
-        dbc.execute("select * from conv")
+
+        # The conv table stores last_tx before last_rx, so columns are
+        # selected by name to keep the two timestamps apart.
+        query  = "select conv.dest_context, conv.last_rx, conv.last_tx, conv.unread, conv.trust, conv.data, "
+        query += "s.messages, s.unread, s.last_hash, s.last_ts, s.preview, s.preview_hash, tl.ts "
+        query += "from conv left join conv_summary s on s.dest_context=conv.dest_context "
+        query += "left join telemetry_latest tl on tl.dest_context=conv.dest_context"
+        dbc.execute(query)
         result = dbc.fetchall()
 
         if len(result) < 1:
@@ -1990,7 +2952,7 @@ class SidebandCore():
                 last_activity = max(last_rx, last_tx)
                 data = None
                 try:
-                    data = msgpack.unpackb(entry[7])
+                    data = msgpack.unpackb(entry[5])
                 except:
                     pass
 
@@ -2000,116 +2962,207 @@ class SidebandCore():
                     "last_rx": last_rx,
                     "last_tx": last_tx,
                     "last_activity": last_activity,
-                    "trust": entry[5],
+                    "trust": entry[4],
                     "data": data,
                 }
+                conv.update(self.__conversation_summary_from_row(entry[0], entry[6:]))
                 convs.append(conv)
 
             return sorted(convs, key=lambda c: c["last_activity"], reverse=True)
 
+    def _db_conversation_summary(self, context_dest):
+        db = self.__db_connect()
+        dbc = db.cursor()
+
+        query  = "select s.messages, s.unread, s.last_hash, s.last_ts, s.preview, s.preview_hash, "
+        query += "(select ts from telemetry_latest where dest_context=s.dest_context) from conv_summary s where s.dest_context=?"
+        dbc.execute(query, (context_dest,))
+        result = dbc.fetchone()
+
+        if result == None:
+            return None
+        else:
+            return self.__conversation_summary_from_row(context_dest, result)
+
+    def __conversation_summary_from_row(self, context_dest, row):
+        messages, unread_count, last_hash, last_ts, preview, preview_hash, last_telemetry = row
+        if messages == None:
+            return {"messages": None, "unread_count": None, "last_message": None, "last_message_cursor": None, "preview": None, "last_telemetry": last_telemetry}
+
+        # Previews are produced when messages are saved. If the latest
+        # message has changed in any other way, its preview is produced
+        # from the stored message once, and written back.
+        if last_hash != None and preview_hash != last_hash:
+            preview = None
+            try:
+                message = self._db_message(last_hash)
+                if message != None:
+                    preview = self.__message_preview(message["title"], message["content"])
+                    query = "UPDATE conv_summary set preview=?, preview_hash=? where dest_context=? and last_hash=?"
+                    self.__db_write(query, (preview, last_hash, context_dest, last_hash), wait=False)
+            except Exception as e:
+                RNS.log("Could not produce message preview for "+RNS.prettyhexrep(context_dest)+": "+str(e), RNS.LOG_ERROR)
+
+        elif last_hash == None:
+            preview = None
+
+        return {
+            "messages": messages,
+            "unread_count": unread_count,
+            "last_message": last_hash,
+            "last_message_cursor": (last_ts, last_hash) if last_hash != None else None,
+            "preview": preview,
+            "last_telemetry": last_telemetry,
+        }
+
+    def __message_preview(self, title, content):
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", errors="replace")
+        if isinstance(title, bytes):
+            title = title.decode("utf-8", errors="replace")
+
+        text = " ".join(str(content or "").split())
+        if len(text) == 0:
+            text = " ".join(str(title or "").split())
+
+        if len(text) > SidebandCore.PREVIEW_LENGTH:
+            text = text[:SidebandCore.PREVIEW_LENGTH-1]+"\u2026"
+
+        return text
+
     def _db_announces(self):
         db = self.__db_connect()
         dbc = db.cursor()
         
-        dbc.execute("select * from announce order by received desc")
+        # The announce log is only trimmed periodically, so
+        # the limit is applied here as well.
+        query = "select source, received, data, dest_type from announce order by received desc limit ?"
+        dbc.execute(query, (self.config["max_announces"],))
         result = dbc.fetchall()
 
         if len(result) < 1:
             return None
         else:
             announces = []
-            added_dests = []
             for entry in result:
                 try:
-                    if not entry[2] in added_dests:
-                        announce = {
-                            "dest": entry[2],
-                            "data": entry[3].decode("utf-8"),
-                            "time": entry[1],
-                            "type": entry[4]
-                        }
-                        added_dests.append(entry[2])
-                        announces.append(announce)
+                    announce = {
+                        "dest": entry[0],
+                        "data": entry[2].decode("utf-8"),
+                        "time": entry[1],
+                        "type": entry[3]
+                    }
+                    announces.append(announce)
                 except Exception as e:
                     RNS.log("Exception while fetching announce from DB: "+str(e), RNS.LOG_ERROR)
 
             announces.reverse()
             return announces
 
+    def _db_trim_announces(self):
+        # Removes everything but the most recently received
+        # announces. Returns the number of announces removed.
+        query = "delete from announce where received < (select received from announce order by received desc limit 1 offset ?)"
+        return self.__db_write(query, (self.config["max_announces"]-1,))
+
     def _db_conversation(self, context_dest):
+        return self.conversation_cache.get(context_dest, self.__db_load_conversations, self.__db_conversations_version)
+
+    def __db_conversations_version(self):
         db = self.__db_connect()
         dbc = db.cursor()
-        
-        query = "select * from conv where dest_context=:ctx"
-        dbc.execute(query, {"ctx": context_dest})
-        result = dbc.fetchall()
+        dbc.execute("select version from cache_version where name='conv'")
+        return dbc.fetchone()[0]
 
-        if len(result) < 1:
-            return None
-        else:
-            c = result[0]
-            conv = {}
-            conv["dest"] = c[0]
-            conv["last_tx"] = c[1]
-            conv["last_rx"] = c[2]
-            conv["unread"] = c[3]
-            conv["type"] = c[4]
-            conv["trust"] = c[5]
-            conv["name"] = c[6].decode("utf-8")
-            conv["data"] = msgpack.unpackb(c[7])
-            conv["last_activity"] = max(c[1], c[2])
-            return conv
+    def __db_load_conversations(self):
+        # The version is read before the rows, so a change made in
+        # between can only cause an unnecessary reload later on.
+        version = self.__db_conversations_version()
+        db = self.__db_connect()
+        dbc = db.cursor()
+        dbc.execute("select * from conv")
+
+        convs = {}
+        for row in dbc.fetchall():
+            convs[row[0]] = self.__conversation_from_row(row)
+
+        return version, convs
+
+    def __conversation_from_row(self, c):
+        conv = {}
+        conv["dest"] = c[0]
+        conv["last_tx"] = c[1]
+        conv["last_rx"] = c[2]
+        conv["unread"] = c[3]
+        conv["type"] = c[4]
+        conv["trust"] = c[5]
+        conv["name"] = c[6].decode("utf-8")
+        conv["data"] = msgpack.unpackb(c[7])
+        conv["last_activity"] = max(c[1], c[2])
+        return conv
 
     def _db_clear_conversation(self, context_dest):
         RNS.log("Clearing conversation with "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
+        query = "delete from lxm where (dest=:ctx_dst or source=:ctx_dst);"
+        self.__db_write(query, {"ctx_dst": context_dest})
+        self._db_collect_attachments()
+
+    def _db_compact_telemetry(self, start, end, resolution):
+        # Downsamples telemetry with timestamps in [start, end) to one
+        # entry per source for each resolution-aligned time bucket. The
+        # newest entry in a bucket is kept, so the newest entry of every
+        # source always survives. Each call runs in its own small write
+        # transaction, and starts scanning from the cursor returned by the
+        # previous call, so compaction never holds the writer for long.
+        # Returns (rows_deleted, cursor), with a cursor of None when done.
+        def job(dbc):
+            query = "select t.id, t.ts from telemetry t where t.ts>=:cursor and t.ts<:end and exists "
+            query += "(select 1 from telemetry n where n.dest_context=t.dest_context and n.ts>=t.ts and n.ts<:end "
+            query += "and n.ts<(cast(t.ts/:res as integer)+1)*:res and n.id!=t.id and (n.ts>t.ts or n.id>t.id)) "
+            query += "order by t.ts limit :limit"
+            dbc.execute(query, {"cursor": start, "end": end, "res": resolution, "limit": SidebandCore.COMPACTION_CHUNK_SIZE})
+            rows = dbc.fetchall()
+            if len(rows) == 0:
+                return (0, None)
+
+            dbc.executemany("delete from telemetry where id=?", [(row[0],) for row in rows])
+            return (len(rows), rows[-1][1])
+
+        return self.__db_transaction(job)
+
+    def _db_telemetry_count(self):
         db = self.__db_connect()
         dbc = db.cursor()
-
-        query = "delete from lxm where (dest=:ctx_dst or source=:ctx_dst);"
-        dbc.execute(query, {"ctx_dst": context_dest})
-        db.commit()
+        dbc.execute("select count(*) from telemetry")
+        return dbc.fetchone()[0]
 
     def _db_clear_telemetry(self, context_dest):
         RNS.log("Clearing telemetry for "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
-        db = self.__db_connect()
-        dbc = db.cursor()
+        def job(dbc):
+            dbc.execute("delete from telemetry where dest_context=:ctx_dst;", {"ctx_dst": context_dest})
+            dbc.execute("delete from telemetry_latest where dest_context=:ctx_dst;", {"ctx_dst": context_dest})
 
-        query = "delete from telemetry where dest_context=:ctx_dst;"
-        dbc.execute(query, {"ctx_dst": context_dest})
-        db.commit()
+        self.__db_transaction(job)
 
         self.setstate("app.flags.last_telemetry", time.time())
 
     def _db_delete_conversation(self, context_dest):
         RNS.log("Deleting conversation with "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
-        db = self.__db_connect()
-        dbc = db.cursor()
-
         query = "delete from conv where (dest_context=:ctx_dst);"
-        dbc.execute(query, {"ctx_dst": context_dest})
-        db.commit()
+        self.__db_conversation_write(context_dest, query, {"ctx_dst": context_dest})
 
 
     def _db_delete_announce(self, context_dest):
         RNS.log("Deleting announce with "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
-        db = self.__db_connect()
-        dbc = db.cursor()
-
         query = "delete from announce where (source=:ctx_dst);"
-        dbc.execute(query, {"ctx_dst": context_dest})
-        db.commit()
+        self.__db_write(query, {"ctx_dst": context_dest})
 
     def _db_create_conversation(self, context_dest, name = None, trust = False):
         RNS.log("Creating conversation for "+RNS.prettyhexrep(context_dest), RNS.LOG_DEBUG)
-        db = self.__db_connect()
-        dbc = db.cursor()
-
         def_name = "".encode("utf-8")
         query = "INSERT INTO conv (dest_context, last_tx, last_rx, unread, type, trust, name, data) values (?, ?, ?, ?, ?, ?, ?, ?)"
         data = (context_dest, 0, time.time(), 0, SidebandCore.CONV_P2P, 0, def_name, msgpack.packb(None))
-
-        dbc.execute(query, data)
-        db.commit()
+        self.__db_conversation_write(context_dest, query, data)
 
         if trust:
             self._db_conversation_set_trusted(context_dest, True)
@@ -2121,45 +3174,33 @@ class SidebandCore():
 
     def _db_delete_message(self, msg_hash):
         RNS.log("Deleting message "+RNS.prettyhexrep(msg_hash))
-        db = self.__db_connect()
-        dbc = db.cursor()
-
         query = "delete from lxm where (lxm_hash=:mhash);"
-        dbc.execute(query, {"mhash": msg_hash})
-        db.commit()
+        self.__db_write(query, {"mhash": msg_hash})
+        self._db_collect_attachments()
 
     def _db_clean_messages(self):
         RNS.log("Purging stale messages... "+str(self.db_path))
-        db = self.__db_connect()
-        dbc = db.cursor()
-
         query = "delete from lxm where (state=:outbound_state or state=:sending_state);"
-        dbc.execute(query, {"outbound_state": LXMF.LXMessage.OUTBOUND, "sending_state": LXMF.LXMessage.SENDING})
-        db.commit()
+        self.__db_write(query, {"outbound_state": LXMF.LXMessage.OUTBOUND, "sending_state": LXMF.LXMessage.SENDING})
+        self._db_collect_attachments()
 
     def _db_message_set_state(self, lxm_hash, state):
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         query = "UPDATE lxm set state = ? where lxm_hash = ?"
         data = (state, lxm_hash)
-        dbc.execute(query, data)
-        db.commit()
-        result = dbc.fetchall()
+        self.__db_write(query, data)
+        self.__event_conversation_changed(None)
 
     def _db_message_set_method(self, lxm_hash, method):
-        db = self.__db_connect()
-        dbc = db.cursor()
-        
         query = "UPDATE lxm set method = ? where lxm_hash = ?"
         data = (method, lxm_hash)
-        dbc.execute(query, data)
-        db.commit()
-        result = dbc.fetchall()
+        self.__db_write(query, data)
 
     def message(self, msg_hash):
         return self._db_message(msg_hash)
 
+    def message_state(self, msg_hash):
+        return self._db_message_state(msg_hash)
+
     def _db_message(self, msg_hash):
         db = self.__db_connect()
         dbc = db.cursor()
@@ -2171,34 +3212,93 @@ class SidebandCore():
         if len(result) < 1:
             return None
         else:
-            entry = result[0]
+            return MessageRecord(result[0], store=self.attachment_store)
+
+    def _db_collect_attachments(self):
+        # Payload files are only removed once the transaction that drops
+        # their rows has been committed, since a rollback would restore
+        # references to them. Messages are saved by both the UI and the
+        # service process, so each payload is checked again in a second
+        # write transaction, which keeps any writer from referencing it
+        # while the file is removed.
+        def collect(dbc):
+            dbc.execute("select hash from attachment where refs<=0")
+            unreferenced = [row[0] for row in dbc.fetchall()]
+            dbc.executemany("delete from attachment where hash=? and refs<=0", [(h,) for h in unreferenced])
+            return unreferenced
+
+        def remove(dbc):
+            removed = 0
+            for blob_hash in unreferenced:
+                if dbc.execute("select 1 from attachment where hash=?", (blob_hash,)).fetchone() == None:
+                    self.attachment_store.remove(blob_hash)
+                    removed += 1
+            return removed
 
-            lxm_method = entry[7]
-            if lxm_method == LXMF.LXMessage.PAPER:
-                lxm_data = msgpack.unpackb(entry[10])
-                packed_lxm = lxm_data[0]
-                paper_packed_lxm = lxm_data[1]
-            else:
-                packed_lxm = entry[10]
-
-            lxm = LXMF.LXMessage.unpack_from_bytes(packed_lxm, original_method = lxm_method)
-
-            if lxm.desired_method == LXMF.LXMessage.PAPER:
-                lxm.paper_packed = paper_packed_lxm
-
-            message = {
-                "hash": lxm.hash,
-                "dest": lxm.destination_hash,
-                "source": lxm.source_hash,
-                "title": lxm.title,
-                "content": lxm.content,
-                "received": entry[5],
-                "sent": lxm.timestamp,
-                "state": entry[6],
-                "method": entry[7],
-                "lxm": lxm
-            }
-            return message
+        try:
+            unreferenced = self.__db_transaction(collect)
+            if len(unreferenced) > 0:
+                removed = self.__db_transaction(remove)
+                if removed > 0:
+                    RNS.log("Removed "+str(removed)+" unreferenced attachments from storage", RNS.LOG_DEBUG)
+        except Exception as e:
+            RNS.log("An error occurred while collecting unreferenced attachments: "+str(e), RNS.LOG_ERROR)
+
+    def _db_sweep_attachments(self):
+        # Payload files are written before the message that references
+        # them is inserted, so a failed insert leaves files that nothing
+        # references. These are removed once they are older than any save
+        # could still be in progress. The sweep runs in a write transaction,
+        # so no message referencing a swept file can be saved meanwhile.
+        def job(dbc):
+            referenced = set(row[0] for row in dbc.execute("select hash from attachment").fetchall())
+            cutoff = time.time()-SidebandCore.ATTACHMENT_SWEEP_GRACE
+            removed = 0
+            for path, mtime, blob_hash in self.attachment_store.files():
+                if mtime < cutoff and not blob_hash in referenced:
+                    try:
+                        os.unlink(path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+            return removed
+
+        try:
+            removed = self.__db_transaction(job)
+            if removed > 0:
+                RNS.log("Removed "+str(removed)+" orphaned files from attachment storage", RNS.LOG_DEBUG)
+        except Exception as e:
+            RNS.log("An error occurred while sweeping attachment storage: "+str(e), RNS.LOG_ERROR)
+
+    def __attachment_payloads(self, lxm):
+        payloads = []
+        if lxm.fields != None:
+            if LXMF.FIELD_IMAGE in lxm.fields:
+                image_field = lxm.fields[LXMF.FIELD_IMAGE]
+                if isinstance(image_field, list) and len(image_field) > 1:
+                    payloads.append(image_field[1])
+
+            if LXMF.FIELD_FILE_ATTACHMENTS in lxm.fields:
+                attachments_field = lxm.fields[LXMF.FIELD_FILE_ATTACHMENTS]
+                if isinstance(attachments_field, list):
+                    for attachment in attachments_field:
+                        if isinstance(attachment, list) and len(attachment) > 1:
+                            payloads.append(attachment[1])
+
+        return [p for p in payloads if isinstance(p, bytes) and len(p) >= AttachmentStore.SPILL_THRESHOLD]
+
+    def _db_message_state(self, msg_hash):
+        db = self.__db_connect()
+        dbc = db.cursor()
+
+        query = "select state from lxm where lxm_hash=:mhash"
+        dbc.execute(query, {"mhash": msg_hash})
+        result = dbc.fetchone()
+
+        if result == None:
+            return None
+        else:
+            return result[0]
 
     def _db_message_count(self, context_dest):
         db = self.__db_connect()
@@ -2214,66 +3314,111 @@ class SidebandCore():
         else:
             return result[0][0]
 
-    def _db_messages(self, context_dest, after = None, before = None, limit = None):
+    def _db_search_messages(self, query, context_dest = None, limit = 50, cursor = None):
+        # Returns messages matching all words in the query, newest
+        # first, optionally limited to a single conversation. Each
+        # result carries a (rx_ts, lxm_hash) cursor, which can be
+        # passed back to retrieve the next page of results.
+        if not self.message_search_available:
+            RNS.log("Message search was requested, but is not available", RNS.LOG_DEBUG)
+            return []
+
+        # User input is never passed on as FTS query syntax. Every
+        # word is quoted, and matched as a prefix.
+        terms = ['"'+t.replace('"', '""')+'"*' for t in query.split()]
+        if len(terms) == 0:
+            return []
+
+        params = {"match": " ".join(terms), "limit": int(limit)}
+        conditions = ""
+        if context_dest != None:
+            conditions += " and (lxm.dest=:context_dest or lxm.source=:context_dest)"
+            params["context_dest"] = context_dest
+        if cursor != None:
+            conditions += " and lxm.rx_ts<=:c_ts and (lxm.rx_ts<:c_ts or lxm.lxm_hash<:c_hash)"
+            params["c_ts"] = cursor[0]; params["c_hash"] = cursor[1]
+
         db = self.__db_connect()
         dbc = db.cursor()
-        
-        if after != None and before == None:
-            query = "select * from lxm where (dest=:context_dest or source=:context_dest) and rx_ts>:after_ts"
-            dbc.execute(query, {"context_dest": context_dest, "after_ts": after})
-        elif after == None and before != None:
-            query = "select * from lxm where (dest=:context_dest or source=:context_dest) and rx_ts<:before_ts"
-            dbc.execute(query, {"context_dest": context_dest, "before_ts": before})
-        elif after != None and before != None:
-            query = "select * from lxm where (dest=:context_dest or source=:context_dest) and rx_ts<:before_ts and rx_ts>:after_ts"
-            dbc.execute(query, {"context_dest": context_dest, "before_ts": before, "after_ts": after})
+        # Snippets are only generated for the page of results that is
+        # returned, not for every message matching the query.
+        page  = "select lxm_search.id, lxm.lxm_hash, lxm.dest, lxm.source, lxm.rx_ts "
+        page += "from lxm_fts join lxm_search on lxm_search.id=lxm_fts.rowid join lxm on lxm.lxm_hash=lxm_search.lxm_hash "
+        page += "where lxm_fts match :match"+conditions+" order by lxm.rx_ts DESC, lxm.lxm_hash DESC limit :limit"
+        sql  = "select r.lxm_hash, r.dest, r.source, r.rx_ts, snippet(lxm_fts, -1, '[b]', '[/b]', '...', 16) "
+        sql += "from lxm_fts join ("+page+") r on lxm_fts.rowid=r.id where lxm_fts match :match order by r.rx_ts DESC, r.lxm_hash DESC"
+        dbc.execute(sql, params)
+
+        results = []
+        for entry in dbc.fetchall():
+            results.append({
+                "hash": entry[0],
+                "dest": entry[1],
+                "source": entry[2],
+                "received": entry[3],
+                "snippet": entry[4],
+                "cursor": (entry[3], entry[0]),
+            })
+
+        return results
+
+    def _db_messages(self, context_dest, after = None, before = None, limit = None, before_cursor = None, after_cursor = None):
+        # Messages are paged with keyset cursors of the form
+        # (rx_ts, lxm_hash), which stay stable even when several
+        # messages share the same receive timestamp. Conversation
+        # membership is resolved as two index range scans, one on
+        # (dest, rx_ts) and one on (source, rx_ts), so both the
+        # ordering and the limit are handled by SQLite.
+        db = self.__db_connect()
+        dbc = db.cursor()
+
+        conditions = ""
+        params = {"context_dest": context_dest}
+        if after != None:
+            conditions += " and rx_ts>:after_ts"
+            params["after_ts"] = after
+        if before != None:
+            conditions += " and rx_ts<:before_ts"
+            params["before_ts"] = before
+        if after_cursor != None:
+            conditions += " and rx_ts>=:ac_ts and (rx_ts>:ac_ts or lxm_hash>:ac_hash)"
+            params["ac_ts"] = after_cursor[0]; params["ac_hash"] = after_cursor[1]
+        if before_cursor != None:
+            conditions += " and rx_ts<=:bc_ts and (rx_ts<:bc_ts or lxm_hash<:bc_hash)"
+            params["bc_ts"] = before_cursor[0]; params["bc_hash"] = before_cursor[1]
+
+        # When paging forward from a cursor, return the oldest messages
+        # after it, so consecutive pages never skip any messages. In all
+        # other cases, the newest messages in the range are returned.
+        if after_cursor != None and before_cursor == None:
+            order = "ASC"
         else:
-            query = "select * from lxm where dest=:context_dest or source=:context_dest"
-            dbc.execute(query, {"context_dest": context_dest})
+            order = "DESC"
+
+        order_part = " order by rx_ts "+order+", lxm_hash "+order
+        limit_part = ""
+        if limit != None:
+            limit_part = " limit "+str(int(limit))
+
+        query  = "select * from ("
+        query += "select * from (select * from lxm where dest=:context_dest"+conditions+order_part+limit_part+")"
+        query += " union all "
+        query += "select * from (select * from lxm where source=:context_dest and dest!=:context_dest"+conditions+order_part+limit_part+")"
+        query += ")"+order_part+limit_part
+        dbc.execute(query, params)
 
         result = dbc.fetchall()
 
         if len(result) < 1:
             return None
         else:
+            if order == "DESC":
+                result.reverse()
+
             messages = []
             for entry in result:
-                lxm_method = entry[7]
-                if lxm_method == LXMF.LXMessage.PAPER:
-                    lxm_data = msgpack.unpackb(entry[10])
-                    packed_lxm = lxm_data[0]
-                    paper_packed_lxm = lxm_data[1]
-                else:
-                    packed_lxm = entry[10]
-
-                lxm = LXMF.LXMessage.unpack_from_bytes(packed_lxm, original_method = lxm_method)
-                
-                if lxm.desired_method == LXMF.LXMessage.PAPER:
-                    lxm.paper_packed = paper_packed_lxm
+                messages.append(MessageRecord(entry, store=self.attachment_store))
 
-                extras = None
-                try:
-                    extras = msgpack.unpackb(entry[11])
-                except:
-                    pass
-                
-                message = {
-                    "hash": lxm.hash,
-                    "dest": lxm.destination_hash,
-                    "source": lxm.source_hash,
-                    "title": lxm.title,
-                    "content": lxm.content,
-                    "received": entry[5],
-                    "sent": lxm.timestamp,
-                    "state": entry[6],
-                    "method": entry[7],
-                    "lxm": lxm,
-                    "extras": extras,
-                }
-
-                messages.append(message)
-            if len(messages) > limit:
-                messages = messages[-limit:]
             return messages
 
     def _db_save_lxm(self, lxm, context_dest, originator = False, own_command = False):
@@ -2299,26 +3444,15 @@ class SidebandCore():
                     max_timebase = self.getpersistent(f"telemetry.{RNS.hexrep(context_dest, delimit=False)}.timebase") or 0
                     if lxm.fields[LXMF.FIELD_TELEMETRY_STREAM] != None and len(lxm.fields[LXMF.FIELD_TELEMETRY_STREAM]) > 0:
                         for telemetry_entry in lxm.fields[LXMF.FIELD_TELEMETRY_STREAM]:
-                            tsource = telemetry_entry[0]
-                            ttstamp = telemetry_entry[1]
-                            tpacked = telemetry_entry[2]
-                            appearance = telemetry_entry[3]
-                            max_timebase = max(max_timebase, ttstamp)
-                            if self._db_save_telemetry(tsource, tpacked, via = context_dest):
-                                RNS.log("Saved telemetry stream entry from "+RNS.prettyhexrep(tsource), RNS.LOG_DEBUG)
-                                if appearance != None:
-                                    self._db_update_appearance(tsource, ttstamp, appearance, from_bulk_telemetry=True)
-                                    RNS.log("Updated appearance entry from "+RNS.prettyhexrep(tsource), RNS.LOG_DEBUG)
+                            max_timebase = max(max_timebase, telemetry_entry[1])
 
+                        self._db_save_telemetry_stream(lxm.fields[LXMF.FIELD_TELEMETRY_STREAM], via = context_dest)
                         self.setpersistent(f"telemetry.{RNS.hexrep(context_dest, delimit=False)}.timebase", max_timebase)
 
                     else:
                         RNS.log("Received telemetry stream field with no data: "+str(lxm.fields[LXMF.FIELD_TELEMETRY_STREAM]), RNS.LOG_DEBUG)
 
         if own_command or len(lxm.content) != 0 or len(lxm.title) != 0:
-            db = self.__db_connect()
-            dbc = db.cursor()
-
             if not lxm.packed:
                 lxm.pack()
 
@@ -2338,7 +3472,19 @@ class SidebandCore():
 
             extras = msgpack.packb(extras)
 
-            query = "INSERT INTO lxm (lxm_hash, dest, source, title, tx_ts, rx_ts, state, method, t_encrypted, t_encryption, data, extra) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            # Large attachment payloads are written to the attachment
+            # store, and only referenced from the stored message.
+            spilled = []
+            payloads = self.__attachment_payloads(lxm) if lxm.method != LXMF.LXMessage.PAPER else []
+            if len(payloads) > 0:
+                stripped, segments = self.attachment_store.split(packed_lxm, payloads)
+                if len(segments) > 0:
+                    for offset, length, blob_hash in segments:
+                        self.attachment_store.put(packed_lxm[offset:offset+length], blob_hash=blob_hash)
+                        spilled.append((blob_hash, packed_lxm[offset:offset+length]))
+                    packed_lxm = msgpack.packb([stripped, segments])
+
+            query = "INSERT INTO lxm (lxm_hash, dest, source, title, tx_ts, rx_ts, state, method, t_encrypted, t_encryption, data, extra, spilled) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
             data = (
                 lxm.hash,
                 lxm.destination_hash,
@@ -2351,39 +3497,42 @@ class SidebandCore():
                 lxm.transport_encrypted,
                 lxm.transport_encryption,
                 packed_lxm,
-                extras
+                extras,
+                1 if len(spilled) > 0 else 0,
             )
 
-            dbc.execute(query, data)
-            db.commit()
-
+            def job(dbc):
+                dbc.execute(query, data)
+                for blob_hash, payload in spilled:
+                    # Rewrites the payload if it was removed by garbage
+                    # collection since it was stored above.
+                    if not self.attachment_store.has(blob_hash):
+                        self.attachment_store.put(payload, blob_hash=blob_hash)
+                    dbc.execute("INSERT INTO lxm_attachments (lxm_hash, hash) values (?, ?)", (lxm.hash, blob_hash))
+                    dbc.execute("INSERT INTO attachment (hash, size, refs) values (?, ?, 1) ON CONFLICT(hash) DO UPDATE SET refs=refs+1", (blob_hash, len(payload)))
+                if self.message_search_available:
+                    self.__db_index_message(dbc, lxm.hash, lxm)
+                dbc.execute("UPDATE conv_summary set preview=?, preview_hash=? where last_hash=?", (preview, lxm.hash, lxm.hash))
+
+            preview = self.__message_preview(lxm.title, lxm.content)
+            self.__db_transaction(job)
             self.__event_conversation_changed(context_dest)
 
     def _db_save_announce(self, destination_hash, app_data, dest_type="lxmf.delivery"):
-        db = self.__db_connect()
-        dbc = db.cursor()
-
-        query = "delete from announce where id is NULL or id not in (select id from announce order by received desc limit "+str(self.MAX_ANNOUNCES)+")"
-        dbc.execute(query)
-
-        query = "delete from announce where (source=:source);"
-        dbc.execute(query, {"source": destination_hash})
-
-        now = time.time()
-        hash_material = str(time).encode("utf-8")+destination_hash+app_data+dest_type.encode("utf-8")
-        announce_hash = RNS.Identity.full_hash(hash_material)
-
-        query = "INSERT INTO announce (id, received, source, data, dest_type) values (?, ?, ?, ?, ?)"
-        data = (
-            announce_hash,
-            now,
-            destination_hash,
-            app_data,
-            dest_type,
-        )
-
-        dbc.execute(query, data)
-        db.commit()
+        query = "INSERT INTO announce (source, received, data, dest_type) values (:source, :received, :data, :dest_type) "
+        query += "ON CONFLICT(source) DO UPDATE SET received=excluded.received, data=excluded.data, dest_type=excluded.dest_type"
+        data = {
+            "source": destination_hash,
+            "received": time.time(),
+            "data": app_data,
+            "dest_type": dest_type,
+        }
+
+        # Announces can arrive at a high rate on busy networks, and
+        # nothing reads them back immediately, so they are written
+        # asynchronously and grouped into shared transactions. The
+        # log is trimmed by the periodic jobs.
+        self.__db_write(query, data, wait=False)
 
     def lxmf_announce(self, attached_interface=None):
         if self.is_standalone or self.is_service:
@@ -2765,6 +3914,16 @@ class SidebandCore():
                 if self.owner_service != None:
                     self.owner_service.update_location_provider()
 
+                try:
+                    self._db_trim_announces()
+                except Exception as e:
+                    RNS.log("An error occurred while trimming the announce log: "+str(e), RNS.LOG_ERROR)
+
+                try:
+                    self._db_expire_persistent()
+                except Exception as e:
+                    RNS.log("An error occurred while removing expired persistent values: "+str(e), RNS.LOG_ERROR)
+
                 if self.config["lxmf_periodic_sync"] == True:
                     if self.getpersistent("lxmf.lastsync") == None:
                         self.setpersistent("lxmf.lastsync", time.time())
@@ -2849,6 +4008,17 @@ class SidebandCore():
                             except Exception as e:
                                 RNS.log("An error occurred while requesting scheduled telemetry from collector: "+str(e), RNS.LOG_ERROR)
 
+                if self.config["telemetry_compaction_enabled"]:
+                    now = time.time()
+                    last_compaction = self.getpersistent("telemetry.compaction.last_run") or 0
+                    if now > last_compaction+self.config["telemetry_compaction_interval"]:
+                        RNS.log("Running scheduled telemetry compaction", RNS.LOG_DEBUG)
+                        self.compact_telemetry()
+
+                if self.config["db_maintenance_enabled"]:
+                    if self.__db_maintenance_due():
+                        self.run_db_maintenance()
+
     def __start_jobs_deferred(self):
         if self.is_service:
             self.service_thread = threading.Thread(target=self._service_jobs, daemon=True)
@@ -2924,6 +4094,7 @@ class SidebandCore():
 
     def _reticulum_log_debug(self, debug=False):
         self.log_verbose = debug
+        self.metrics.set_enabled(debug)
         if self.log_verbose:
             selected_level = 6
         else:
@@ -3577,7 +4748,7 @@ class SidebandCore():
         if originator and LXMF.FIELD_COMMANDS in message.fields:
             own_command = True
 
-        if self._db_message(message.hash):
+        if self._db_message_state(message.hash) != None:
             RNS.log("Message exists, setting state to: "+str(message.state), RNS.LOG_DEBUG)
             self._db_message_set_state(message.hash, message.state)
         else:
@@ -3597,14 +4768,15 @@ class SidebandCore():
                 self._db_create_conversation(context_dest)
                 self.setstate("app.flags.new_conversations", True)
 
-            if self.gui_display() == "messages_screen":
-                if self.gui_conversation() != context_dest:
+            gui = self.getstates(["app.displaying", "app.active_conversation", "app.foreground"])
+            if gui["app.displaying"] == "messages_screen":
+                if gui["app.active_conversation"] != context_dest:
                     self.unread_conversation(context_dest, tx=unread_reason_tx)
                     self.setstate("app.flags.unread_conversations", True)
                 else:
                     self.txtime_conversation(context_dest)
                     self.setstate("wants.viewupdate.conversations", True)
-                    if self.gui_foreground():
+                    if gui["app.foreground"]:
                         RNS.log("Squelching notification since GUI is in foreground", RNS.LOG_DEBUG)
                         should_notify = False
             else:
@@ -3612,7 +4784,7 @@ class SidebandCore():
                 self.setstate("app.flags.unread_conversations", True)
 
                 if RNS.vendor.platformutils.is_android():
-                    if self.gui_display() == "conversations_screen" and self.gui_foreground():
+                    if gui["app.displaying"] == "conversations_screen" and gui["app.foreground"]:
                         should_notify = False
 
         if self.is_client:
@@ -3825,36 +4997,39 @@ class SidebandCore():
             RNS.log("Error while handling commands: "+str(e), RNS.LOG_ERROR)
 
     def create_telemetry_collector_response(self, to_addr, timebase, is_authorized_telemetry_request=False):
-        added_sources = {}
-        sources = self.list_telemetry(after=timebase)
+        telemetry_stream = self.telemetry_collector_stream(to_addr, timebase)
+        if len(telemetry_stream) == 0:
+            RNS.log(f"No new telemetry for request with timebase {timebase}", RNS.LOG_DEBUG)
+
+        return self.send_latest_telemetry(
+            to_addr=to_addr,
+            stream=telemetry_stream,
+            is_authorized_telemetry_request=is_authorized_telemetry_request
+        )
+
+    def telemetry_collector_stream(self, to_addr, timebase):
         only_latest = self.config["telemetry_requests_only_send_latest"]
+        if only_latest:
+            latest = self.list_latest_telemetry(after=timebase)
+            sources = {}
+            for source in latest:
+                sources[source] = [latest[source][:2]]
+        else:
+            sources = self.list_telemetry(after=timebase)
 
         elements = 0; added = 0
         telemetry_stream = []
         for source in sources:
             if source != to_addr:
+                appearance = self._db_get_appearance(source, raw=True)
                 for entry in sources[source]:
                     elements += 1
                     timestamp = entry[0]; packed_telemetry = entry[1]
-                    appearance = self._db_get_appearance(source, raw=True)
                     te = [source, timestamp, packed_telemetry, appearance]
-                    if only_latest:
-                        if not source in added_sources:
-                            added_sources[source] = True
-                            telemetry_stream.append(te)
-                            added += 1
-                    else:
-                        telemetry_stream.append(te)
-                        added += 1
+                    telemetry_stream.append(te)
+                    added += 1
 
-        if len(telemetry_stream) == 0:
-            RNS.log(f"No new telemetry for request with timebase {timebase}", RNS.LOG_DEBUG)
-
-        return self.send_latest_telemetry(
-            to_addr=to_addr,
-            stream=telemetry_stream,
-            is_authorized_telemetry_request=is_authorized_telemetry_request
-        )
+        return telemetry_stream
 
 
     def get_display_name_bytes(self):
@@ -3897,6 +5072,7 @@ class SidebandCore():
             return "Unknown"
 
     def cleanup(self):
+        self.db_flush(sync=True)
         if RNS.vendor.platformutils.get_platform() == "android":
             if not self.reticulum.is_connected_to_shared_instance:
                 RNS.Transport.detach_interfaces()
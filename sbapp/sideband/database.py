@@ -0,0 +1,950 @@
+import os
+import RNS
+import LXMF
+import mmap
+import time
+import queue
+import sqlite3
+import threading
+import RNS.vendor.umsgpack as msgpack
+
+class DatabaseWriteJob():
+    __slots__ = ("function", "event", "result", "exception", "outside_transaction", "on_commit", "nested_commits")
+
+    def __init__(self, function, wait=True, outside_transaction=False, on_commit=None):
+        self.function = function
+        self.on_commit = on_commit
+        self.nested_commits = []
+        self.event = threading.Event() if wait else None
+        self.result = None
+        self.exception = None
+        self.outside_transaction = outside_transaction
+
+class DatabaseWriter():
+    QUEUE_SIZE     = 4096
+    BATCH_MAX      = 512
+    BATCH_INTERVAL = 0.005
+    BUSY_TIMEOUT   = 15
+
+    # All writes to the database are funnelled through a single
+    # connection owned by a dedicated writer thread. Jobs are queued
+    # and committed in groups, so that any number of writes arriving
+    # within a few milliseconds of each other share one transaction,
+    # and therefore one fsync. Each job runs inside its own savepoint,
+    # so a failing job only rolls back its own changes.
+    #
+    # Durability semantics:
+    #   - A job submitted with wait=True has been committed when the
+    #     call returns, and is visible to all other connections.
+    #   - A job submitted with wait=False is committed at the latest
+    #     with the next batch. Call flush() to wait until everything
+    #     queued before the call has been committed.
+    #   - A job can carry an on_commit callback, which is called on
+    #     the writer thread with the job's result, once the job has
+    #     been committed. This also holds for jobs submitted from
+    #     within a running job, whose callbacks are deferred until
+    #     the enclosing transaction has been committed.
+    #   - Commits are durable against application crashes. Calling
+    #     flush(sync=True) also checkpoints the WAL into the main
+    #     database file, for durability against power loss.
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=DatabaseWriter.QUEUE_SIZE)
+        self.thread = None
+        self.running = False
+        self.db = None
+        self.current_job = None
+
+        self.jobs = 0
+        self.async_jobs = 0
+        self.failed_jobs = 0
+        self.commits = 0
+        self.max_queue_depth = 0
+        self.max_batch_size = 0
+        self.last_commit_latency = 0.0
+        self.max_commit_latency = 0.0
+        self.total_commit_latency = 0.0
+
+    def start(self):
+        if not self.running:
+            ready = threading.Event()
+            startup = {"exception": None}
+            def job():
+                try:
+                    self.__connect()
+                except Exception as e:
+                    startup["exception"] = e
+                    ready.set()
+                    return
+
+                ready.set()
+                self.__job_loop()
+
+            self.running = True
+            self.thread = threading.Thread(target=job, daemon=True)
+            self.thread.start()
+            ready.wait()
+
+            if startup["exception"] != None:
+                self.running = False
+                raise startup["exception"]
+
+    def stop(self):
+        if self.running:
+            self.flush()
+            self.running = False
+            self.queue.put(None)
+
+    def __connect(self):
+        self.db = sqlite3.connect(self.db_path, timeout=DatabaseWriter.BUSY_TIMEOUT, isolation_level=None)
+        journal_mode = self.db.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if journal_mode.lower() != "wal":
+            RNS.log("Could not enable WAL journaling for database, journal mode is "+str(journal_mode), RNS.LOG_WARNING)
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+    def in_writer_thread(self):
+        return threading.current_thread() == self.thread
+
+    def submit(self, function, wait=True, on_commit=None):
+        # Jobs submitted from within a running job are simply
+        # executed inline as part of the current transaction.
+        # Outside of a job, such as in a commit callback, there is no
+        # transaction to wait for, and the write is already committed.
+        if self.in_writer_thread():
+            result = function(self.db.cursor())
+            if on_commit != None:
+                if self.current_job != None:
+                    self.current_job.nested_commits.append((on_commit, result))
+                else:
+                    on_commit(result)
+            return result
+
+        if not self.running:
+            raise IOError("The database writer is not running")
+
+        job = DatabaseWriteJob(function, wait=wait, on_commit=on_commit)
+        self.queue.put(job)
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+        if wait:
+            job.event.wait()
+            if job.exception != None:
+                raise job.exception
+            return job.result
+        else:
+            self.async_jobs += 1
+            return None
+
+    def execute(self, query, params=(), wait=True):
+        def job(dbc):
+            dbc.execute(query, params)
+            return dbc.rowcount
+        return self.submit(job, wait=wait)
+
+    def executemany(self, query, params_seq, wait=True):
+        def job(dbc):
+            dbc.executemany(query, params_seq)
+            return dbc.rowcount
+        return self.submit(job, wait=wait)
+
+    def transaction(self, function, wait=True, on_commit=None):
+        return self.submit(function, wait=wait, on_commit=on_commit)
+
+    def flush(self, sync=False):
+        if self.running and not self.in_writer_thread():
+            self.submit(lambda dbc: None, wait=True)
+            if sync:
+                self.checkpoint(mode="FULL")
+
+    def checkpoint(self, mode="PASSIVE"):
+        if mode not in ["PASSIVE", "FULL", "RESTART", "TRUNCATE"]:
+            raise ValueError("Invalid WAL checkpoint mode "+str(mode))
+        def job():
+            return self.db.execute("PRAGMA wal_checkpoint("+mode+")").fetchone()
+        return self.outside_transaction(job)
+
+    def vacuum(self):
+        return self.outside_transaction(lambda: self.db.execute("VACUUM"))
+
+    def analyze(self, limit=None):
+        def job(dbc):
+            if limit != None:
+                dbc.execute("PRAGMA analysis_limit="+str(int(limit)))
+            dbc.execute("ANALYZE")
+        return self.transaction(job)
+
+    def optimize(self):
+        return self.transaction(lambda dbc: dbc.execute("PRAGMA optimize"))
+
+    def outside_transaction(self, function):
+        # Some operations, such as checkpoints and VACUUM, can't run
+        # inside a transaction. These are queued as special jobs that
+        # the writer runs between batches.
+        if self.in_writer_thread():
+            raise IOError("Operation can't be run from within a database write transaction")
+
+        job = DatabaseWriteJob(function, wait=True, outside_transaction=True)
+        self.queue.put(job)
+        job.event.wait()
+        if job.exception != None:
+            raise job.exception
+        return job.result
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "jobs": self.jobs,
+            "async_jobs": self.async_jobs,
+            "failed_jobs": self.failed_jobs,
+            "commits": self.commits,
+            "max_batch_size": self.max_batch_size,
+            "last_commit_latency": self.last_commit_latency,
+            "max_commit_latency": self.max_commit_latency,
+            "avg_commit_latency": self.total_commit_latency/self.commits if self.commits > 0 else 0.0,
+        }
+
+    def __collect_batch(self, first_job):
+        batch = [first_job]
+        lingering = first_job.event == None
+        deadline = time.time()+DatabaseWriter.BATCH_INTERVAL
+        while len(batch) < DatabaseWriter.BATCH_MAX:
+            try:
+                # If nobody is waiting for the batch to commit, linger
+                # for a few milliseconds to coalesce more writes into
+                # the same transaction. Otherwise, just take whatever
+                # is already queued.
+                if lingering:
+                    remaining = deadline-time.time()
+                    if remaining <= 0:
+                        break
+                    job = self.queue.get(timeout=remaining)
+                else:
+                    job = self.queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if job == None or job.outside_transaction:
+                # Process the current batch first, then this job
+                return batch, job
+
+            batch.append(job)
+            if job.event != None:
+                lingering = False
+
+        return batch, None
+
+    def __run_outside_transaction(self, job):
+        try:
+            job.result = job.function()
+        except Exception as e:
+            job.result = None
+            job.exception = e
+            RNS.log("Error while running database maintenance operation: "+str(e), RNS.LOG_ERROR)
+        job.event.set()
+
+    def __job_loop(self):
+        pending = None
+        while self.running or pending != None:
+            if pending != None:
+                job = pending; pending = None
+            else:
+                job = self.queue.get()
+
+            if job == None:
+                continue
+
+            if job.outside_transaction:
+                self.__run_outside_transaction(job)
+                continue
+
+            batch, pending = self.__collect_batch(job)
+            self.__commit_batch(batch)
+
+    def __commit_batch(self, batch):
+        started = time.time()
+        dbc = self.db.cursor()
+        try:
+            dbc.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            RNS.log("Could not begin database write transaction: "+str(e), RNS.LOG_ERROR)
+            for job in batch:
+                self.failed_jobs += 1
+                job.exception = e
+                if job.event != None:
+                    job.event.set()
+            return
+
+        for job in batch:
+            self.jobs += 1
+            try:
+                self.current_job = job
+                dbc.execute("SAVEPOINT job")
+                job.result = job.function(dbc)
+                dbc.execute("RELEASE job")
+            except Exception as e:
+                self.failed_jobs += 1
+                job.exception = e
+                job.nested_commits = []
+                try:
+                    dbc.execute("ROLLBACK TO job")
+                    dbc.execute("RELEASE job")
+                except Exception as re:
+                    RNS.log("Error while rolling back failed database write: "+str(re), RNS.LOG_ERROR)
+
+                if job.event == None:
+                    RNS.log("An error occurred while executing queued database write: "+str(e), RNS.LOG_ERROR)
+
+        self.current_job = None
+        try:
+            dbc.execute("COMMIT")
+            self.commits += 1
+            for job in batch:
+                if job.exception == None:
+                    callbacks = job.nested_commits
+                    if job.on_commit != None:
+                        callbacks = callbacks+[(job.on_commit, job.result)]
+                    for on_commit, result in callbacks:
+                        try:
+                            on_commit(result)
+                        except Exception as e:
+                            RNS.log("Error in database commit callback: "+str(e), RNS.LOG_ERROR)
+        except Exception as e:
+            RNS.log("Could not commit database write transaction: "+str(e), RNS.LOG_ERROR)
+            try:
+                dbc.execute("ROLLBACK")
+            except:
+                pass
+            for job in batch:
+                if job.exception == None:
+                    self.failed_jobs += 1
+                    job.exception = e
+
+        latency = time.time()-started
+        self.last_commit_latency = latency
+        self.total_commit_latency += latency
+        if latency > self.max_commit_latency:
+            self.max_commit_latency = latency
+        if len(batch) > self.max_batch_size:
+            self.max_batch_size = len(batch)
+
+        for job in batch:
+            if job.event != None:
+                job.event.set()
+
+class DatabaseReaders():
+    BUSY_TIMEOUT = 15
+
+    # Reads are served by a set of read-only connections, one per
+    # thread. Under WAL journaling, readers never block each other or
+    # the writer, so UI queries, collector responses and RPC handlers
+    # can all read concurrently. Connections are created on demand,
+    # and are closed when their owning thread exits.
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.opened = 0
+        self.errors = 0
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db == None or self.local.generation != self.generation:
+            db = self.__connect()
+            self.local.db = db
+            self.local.generation = self.generation
+
+        return db
+
+    def cursor(self):
+        return self.connection().cursor()
+
+    def query(self, query, params=()):
+        dbc = self.cursor()
+        dbc.execute(query, params)
+        return dbc.fetchall()
+
+    def reset(self):
+        # Discards the connection of the calling thread only, so an
+        # error in one thread never affects queries running in others.
+        db = getattr(self.local, "db", None)
+        self.local.db = None
+        with self.lock:
+            self.errors += 1
+        if db != None:
+            try:
+                db.close()
+            except Exception as e:
+                RNS.log("Error while closing database read connection: "+str(e), RNS.LOG_DEBUG)
+
+    def invalidate(self):
+        # Makes every thread open a new connection on its next read,
+        # for example after the database file has been replaced.
+        with self.lock:
+            self.generation += 1
+
+    def stats(self):
+        return {
+            "opened": self.opened,
+            "errors": self.errors,
+            "generation": self.generation,
+        }
+
+    def __connect(self):
+        db = sqlite3.connect(self.db_path, timeout=DatabaseReaders.BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA query_only=1")
+        with self.lock:
+            self.opened += 1
+
+        return db
+
+class DatabaseMaintenance():
+    ANALYSIS_LIMIT   = 1000
+    VACUUM_THRESHOLD = 0.25
+
+    # Periodic upkeep of the database. Statistics are refreshed with
+    # PRAGMA optimize and an approximate ANALYZE, the database is
+    # checked for corruption, and it is only rebuilt with VACUUM once
+    # enough of its pages are free to make that worthwhile. Finally,
+    # the WAL is checkpointed and truncated. The integrity check and
+    # table counts run on a read connection, so they never block the
+    # writer.
+
+    def __init__(self, writer, readers, db_path):
+        self.writer = writer
+        self.readers = readers
+        self.db_path = db_path
+        self.running = False
+        self.lock = threading.Lock()
+
+    def run(self, vacuum_threshold=None, analysis_limit=None, quick=True):
+        if vacuum_threshold == None:
+            vacuum_threshold = DatabaseMaintenance.VACUUM_THRESHOLD
+        if analysis_limit == None:
+            analysis_limit = DatabaseMaintenance.ANALYSIS_LIMIT
+
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+
+        try:
+            started = time.time()
+            size_before = self.sizes()["db_size"]
+
+            self.writer.optimize()
+            self.writer.analyze(limit=analysis_limit)
+            problems = self.integrity_check(quick=quick)
+            if len(problems) > 0:
+                RNS.log("Database integrity check found "+str(len(problems))+" problems, first was: "+str(problems[0]), RNS.LOG_ERROR)
+
+            vacuumed = False
+            pages = self.pages()
+            if len(problems) == 0 and pages["fragmentation"] >= vacuum_threshold:
+                RNS.log("Rebuilding database, "+str(round(pages["fragmentation"]*100, 1))+"% of pages are free", RNS.LOG_DEBUG)
+                self.writer.vacuum()
+                vacuumed = True
+
+            self.writer.checkpoint(mode="TRUNCATE")
+            sizes = self.sizes()
+
+            return {
+                "time": time.time(),
+                "duration": time.time()-started,
+                "integrity_ok": len(problems) == 0,
+                "problems": problems[:8],
+                "vacuumed": vacuumed,
+                "reclaimed": max(0, size_before-sizes["db_size"]),
+                "tables": self.table_counts(),
+                "db_size": sizes["db_size"],
+                "wal_size": sizes["wal_size"],
+            }
+
+        finally:
+            with self.lock:
+                self.running = False
+
+    def integrity_check(self, quick=True):
+        pragma = "quick_check" if quick else "integrity_check"
+        result = [row[0] for row in self.readers.query("PRAGMA "+pragma)]
+        if result == ["ok"]:
+            return []
+        else:
+            return result
+
+    def table_counts(self):
+        # Virtual tables are skipped, since counting their rows can
+        # be far more expensive than counting ordinary tables.
+        query = "select name from sqlite_master where type='table' and name not like 'sqlite_%' and sql not like 'CREATE VIRTUAL TABLE%'"
+        counts = {}
+        for row in self.readers.query(query):
+            name = row[0]
+            counts[name] = self.readers.query("select count(*) from \""+name.replace('"', '""')+"\"")[0][0]
+
+        return counts
+
+    def pages(self):
+        page_size = self.readers.query("PRAGMA page_size")[0][0]
+        page_count = self.readers.query("PRAGMA page_count")[0][0]
+        freelist_count = self.readers.query("PRAGMA freelist_count")[0][0]
+        return {
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_count": freelist_count,
+            "fragmentation": freelist_count/page_count if page_count > 0 else 0.0,
+        }
+
+    def sizes(self):
+        sizes = {}
+        for key, path in [("db_size", self.db_path), ("wal_size", self.db_path+"-wal")]:
+            try:
+                sizes[key] = os.path.getsize(path)
+            except OSError:
+                sizes[key] = 0
+
+        return sizes
+
+class AttachmentStore():
+    SPILL_THRESHOLD = 32*1024
+
+    # Large image and file attachment payloads are kept outside of
+    # the database, in files named by the SHA-256 of their contents,
+    # so identical payloads are only stored once. Files are written
+    # to a temporary name and renamed into place, so a stored file is
+    # always complete. Reference counting and garbage collection are
+    # handled in the database, by the owner of the store.
+
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, blob_hash):
+        hexhash = blob_hash.hex()
+        return os.path.join(self.path, hexhash[:2], hexhash)
+
+    def has(self, blob_hash):
+        return os.path.isfile(self.blob_path(blob_hash))
+
+    def put(self, data, blob_hash=None):
+        if blob_hash == None:
+            blob_hash = RNS.Identity.full_hash(data)
+
+        if not self.has(blob_hash):
+            path = self.blob_path(blob_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path+".tmp."+str(threading.get_ident())
+            with open(tmp_path, "wb") as blob_file:
+                blob_file.write(data)
+                blob_file.flush()
+                os.fsync(blob_file.fileno())
+            os.replace(tmp_path, path)
+
+        return blob_hash
+
+    def open(self, blob_hash):
+        # Returns a read-only memory map of the stored payload, which
+        # can be sliced, written out or hashed without copying it.
+        with open(self.blob_path(blob_hash), "rb") as blob_file:
+            return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def remove(self, blob_hash):
+        try:
+            os.unlink(self.blob_path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    def files(self):
+        # Yields the path, modification time and hash of every file in
+        # the store. Leftover temporary files are yielded with a hash
+        # of None.
+        if not os.path.isdir(self.path):
+            return
+        for prefix in os.scandir(self.path):
+            if prefix.is_dir():
+                for entry in os.scandir(prefix.path):
+                    try:
+                        blob_hash = bytes.fromhex(entry.name) if not ".tmp." in entry.name else None
+                        yield entry.path, entry.stat().st_mtime, blob_hash
+                    except (ValueError, FileNotFoundError):
+                        continue
+
+    def split(self, packed, payloads):
+        # Cuts the given payloads out of a packed message. Returns the
+        # remaining bytes, along with a list of [offset, length, hash]
+        # references, ordered by offset, that allow the exact original
+        # bytes to be restored. Payloads that can't be located are
+        # left in place.
+        segments = []
+        for payload in payloads:
+            start = 0
+            while True:
+                offset = packed.find(payload, start)
+                if offset == -1:
+                    break
+                end = offset+len(payload)
+                if any(offset < s[0]+s[1] and s[0] < end for s in segments):
+                    start = offset+1
+                    continue
+                segments.append([offset, len(payload), RNS.Identity.full_hash(payload)])
+                break
+
+        segments.sort(key=lambda s: s[0])
+        stripped = bytearray(); position = 0
+        for offset, length, blob_hash in segments:
+            stripped += packed[position:offset]
+            position = offset+length
+        stripped += packed[position:]
+
+        return bytes(stripped), segments
+
+    def join(self, stripped, segments):
+        # Restores the original packed message. Unpacking an LXMessage
+        # requires the complete message as one bytes object, so this is
+        # the one place payloads are copied, directly from their memory
+        # maps into the result, without any intermediate buffers.
+        stripped = memoryview(stripped)
+        parts = []; blobs = []; position = 0; joined_length = 0
+        try:
+            for offset, length, blob_hash in segments:
+                chunk = offset-joined_length
+                parts.append(stripped[position:position+chunk])
+                position += chunk
+                blob = self.open(blob_hash)
+                blobs.append(blob)
+                if len(blob) != length:
+                    raise ValueError("Stored attachment "+blob_hash.hex()+" has invalid length")
+                parts.append(blob)
+                joined_length = offset+length
+            parts.append(stripped[position:])
+
+            return b"".join(parts)
+
+        finally:
+            for blob in blobs:
+                blob.close()
+
+class MessageRecord():
+    # A message as stored in the lxm table. Records can be read like
+    # the message dicts used throughout the application, but only the
+    # row columns are held. The LXMessage is unpacked from the stored
+    # data on first access to anything that needs it, which involves
+    # msgpack decoding and signature validation. Rows read without
+    # the data column can only provide the column values. For rows
+    # with spilled attachments, the data column holds the message
+    # with the attachment payloads cut out, and references to them
+    # in the attachment store.
+
+    __slots__ = ("lxm_hash", "dest", "source", "title", "tx_ts", "rx_ts", "state", "method", "data", "extra", "spilled", "store", "_lxm", "_extras")
+
+    KEYS = ["hash", "dest", "source", "title", "content", "received", "sent", "state", "method", "lxm", "extras", "cursor"]
+
+    def __init__(self, row, store=None):
+        self.lxm_hash = row[0]
+        self.dest = row[1]
+        self.source = row[2]
+        self.title = row[3]
+        self.tx_ts = row[4]
+        self.rx_ts = row[5]
+        self.state = row[6]
+        self.method = row[7]
+        self.data = row[10] if len(row) > 10 else None
+        self.extra = row[11] if len(row) > 11 else None
+        self.spilled = row[12] if len(row) > 12 else 0
+        self.store = store
+        self._lxm = None
+        self._extras = None
+
+    @staticmethod
+    def unpack_lxm(lxm_method, data, spilled=False, store=None):
+        if spilled:
+            stripped, segments = msgpack.unpackb(data)
+            data = store.join(stripped, segments)
+
+        if lxm_method == LXMF.LXMessage.PAPER:
+            lxm_data = msgpack.unpackb(data)
+            packed_lxm = lxm_data[0]
+            paper_packed_lxm = lxm_data[1]
+        else:
+            packed_lxm = data
+
+        lxm = LXMF.LXMessage.unpack_from_bytes(packed_lxm, original_method = lxm_method)
+
+        if lxm.desired_method == LXMF.LXMessage.PAPER:
+            lxm.paper_packed = paper_packed_lxm
+
+        return lxm
+
+    @property
+    def lxm(self):
+        if self._lxm == None and self.data != None:
+            self._lxm = MessageRecord.unpack_lxm(self.method, self.data, spilled=self.spilled, store=self.store)
+        return self._lxm
+
+    @property
+    def extras(self):
+        if self._extras == None and self.extra != None:
+            try:
+                self._extras = msgpack.unpackb(self.extra)
+            except:
+                pass
+        return self._extras
+
+    def __getitem__(self, key):
+        if key == "hash": return self.lxm_hash
+        elif key == "dest": return self.dest
+        elif key == "source": return self.source
+        elif key == "title": return self.title if self.title != None else self.lxm.title
+        elif key == "content": return self.lxm.content
+        elif key == "received": return self.rx_ts
+        elif key == "sent": return self.tx_ts if self.tx_ts != None else self.lxm.timestamp
+        elif key == "state": return self.state
+        elif key == "method": return self.method
+        elif key == "lxm": return self.lxm
+        elif key == "extras": return self.extras
+        elif key == "cursor": return (self.rx_ts, self.lxm_hash)
+        else: raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "state": self.state = value
+        elif key == "method": self.method = value
+        else: raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in MessageRecord.KEYS
+
+    def get(self, key, default=None):
+        if key in MessageRecord.KEYS:
+            return self[key]
+        else:
+            return default
+
+    def keys(self):
+        return list(MessageRecord.KEYS)
+
+class DatabaseMigrator():
+    # The database schema is versioned with PRAGMA user_version. Each
+    # migration is a tuple of (version, description, function), where
+    # function is called with a cursor inside a write transaction.
+    #
+    # Migrations that need to process a large number of rows can work
+    # in chunks, by returning a (done, total) progress tuple instead of
+    # None. The migration is then committed and called again in a new
+    # transaction, until it returns None. Since the user version is
+    # only updated in the transaction of the final call, chunked
+    # migrations must be able to resume from any point.
+    #
+    # On Android, the service and the UI process both migrate the
+    # database at startup. The user version is therefore checked again
+    # inside each migration transaction, which holds the database write
+    # lock, and steps already applied by the other process are skipped.
+
+    def __init__(self, writer, migrations):
+        self.writer = writer
+        self.migrations = sorted(migrations, key=lambda m: m[0])
+
+    def latest_version(self):
+        if len(self.migrations) == 0:
+            return 0
+        else:
+            return self.migrations[-1][0]
+
+    def version(self):
+        return self.writer.transaction(lambda dbc: dbc.execute("PRAGMA user_version").fetchone()[0])
+
+    def pending(self):
+        current = self.version()
+        return [m for m in self.migrations if m[0] > current]
+
+    def migrate(self, progress=None):
+        current = self.version()
+        latest = self.latest_version()
+        if current > latest:
+            RNS.log("Database schema version "+str(current)+" is newer than the latest known version "+str(latest)+", not migrating", RNS.LOG_WARNING)
+            return current
+
+        pending = [m for m in self.migrations if m[0] > current]
+        for step, migration in enumerate(pending):
+            version, description, function = migration
+            RNS.log("Migrating database to schema version "+str(version)+": "+str(description), RNS.LOG_DEBUG)
+            if progress != None:
+                progress(version, description, step, len(pending), None)
+
+            started = time.time()
+            while True:
+                def job(dbc):
+                    if dbc.execute("PRAGMA user_version").fetchone()[0] >= version:
+                        return None
+                    result = function(dbc)
+                    if result == None:
+                        dbc.execute("PRAGMA user_version="+str(int(version)))
+                    return result
+
+                result = self.writer.transaction(job)
+                if result == None:
+                    break
+                elif progress != None:
+                    progress(version, description, step, len(pending), result)
+
+            RNS.log("Database migrated to schema version "+str(version)+" in "+RNS.prettytime(time.time()-started), RNS.LOG_DEBUG)
+
+        if progress != None and len(pending) > 0:
+            progress(latest, None, len(pending), len(pending), None)
+
+        return latest
+
+class VersionedCache():
+    CHECK_INTERVAL = 1.0
+
+    # Holds a complete copy of a database table, so lookups for both
+    # present and missing keys are answered without touching the
+    # database. The cache is loaded as a whole, and kept current by
+    # writers passing in updated entries after each write.
+    #
+    # Every change to the table increments a version number in the
+    # database, which writers pass along with their updates. If an
+    # update skips a version, or the stored version differs when
+    # checked, some other connection, such as the service or UI
+    # process, has changed the table, and the cache is reloaded.
+
+    def __init__(self, check_interval=None):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = None
+        self.version = None
+        self.last_check = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def get(self, key, loader, version_loader):
+        # Returns the entry for key, or None if it does not exist.
+        # The loader must return a tuple of (version, entries), and
+        # version_loader the current version stored in the database.
+        with self.lock:
+            if self.entries != None and self.check_interval != None:
+                now = time.time()
+                if now > self.last_check+self.check_interval:
+                    self.last_check = now
+                    if version_loader() != self.version:
+                        self._invalidate()
+
+            if self.entries == None:
+                self.misses += 1
+                self.loads += 1
+                self.version, self.entries = loader()
+                self.last_check = time.time()
+                self._loaded()
+            else:
+                self.hits += 1
+
+            return self._copy(self.entries.get(key))
+
+    def update(self, key, entry, version):
+        with self.lock:
+            self._update(key, entry, version)
+
+    def invalidate(self):
+        with self.lock:
+            self._invalidate()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries) if self.entries != None else 0,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+        }
+
+    def _update(self, key, entry, version):
+        if self.entries != None:
+            if version == self.version+1:
+                self.version = version
+                if entry == None:
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = entry
+            elif version == self.version:
+                # The write did not change any rows, such as when
+                # removing a key that does not exist, so the cache
+                # already matches the table.
+                pass
+            else:
+                self._invalidate()
+
+    def _invalidate(self):
+        if self.entries != None:
+            self.invalidations += 1
+        self.entries = None
+        self.version = None
+
+    def _loaded(self):
+        pass
+
+    def _copy(self, entry):
+        return entry
+
+class ConversationCache(VersionedCache):
+    # Caches the conversation table, keyed by dest_context.
+
+    def _copy(self, conv):
+        # Callers are free to modify the returned conversation and its
+        # data dict, so neither is shared with the cache.
+        if conv == None:
+            return None
+        conv = dict(conv)
+        if isinstance(conv["data"], dict):
+            conv["data"] = dict(conv["data"])
+        return conv
+
+class PersistentCache(VersionedCache):
+    # Caches the persistent key/value table, with entries of the form
+    # (value, expires). Writes are applied to the cache immediately,
+    # and written to the database behind the caller's back. Until a
+    # write has been committed, its value is kept in a pending set,
+    # which is reapplied whenever the cache is reloaded, so a reload
+    # never brings back a value that is about to be overwritten.
+
+    def __init__(self, check_interval=None):
+        super().__init__(check_interval=check_interval)
+        self.pending = {}
+        self.sequence = 0
+
+    def set(self, key, entry):
+        # Returns a sequence number for the write, that must be passed
+        # to committed() along with the resulting table version.
+        with self.lock:
+            self.sequence += 1
+            self.pending[key] = (self.sequence, entry)
+            if self.entries != None:
+                if entry == None:
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = entry
+            return self.sequence
+
+    def committed(self, key, sequence, version):
+        with self.lock:
+            if key in self.pending and self.pending[key][0] == sequence:
+                entry = self.pending.pop(key)[1]
+            else:
+                # A newer write to the same key is still pending, and
+                # already applied to the cache.
+                entry = self.entries.get(key) if self.entries != None else None
+            self._update(key, entry, version)
+
+    def _loaded(self):
+        for key in self.pending:
+            entry = self.pending[key][1]
+            if entry == None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = entry
@@ -0,0 +1,156 @@
+import time
+import threading
+
+class Histogram():
+    # Upper bounds of the latency buckets, in seconds. The
+    # last bucket holds everything slower than 5 seconds.
+    BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf")]
+
+    def __init__(self):
+        self.buckets = [0]*len(Histogram.BOUNDS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration, error=False):
+        for n, bound in enumerate(Histogram.BOUNDS):
+            if duration <= bound:
+                self.buckets[n] += 1
+                break
+
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        # Estimated as the upper bound of the bucket holding the
+        # requested fraction of samples, capped at the slowest one
+        target = self.count*fraction
+        seen = 0
+        for n, bound in enumerate(Histogram.BOUNDS):
+            seen += self.buckets[n]
+            if seen >= target and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": self.total*1000,
+            "mean_ms": self.total/self.count*1000 if self.count > 0 else 0.0,
+            "p50_ms": self.percentile(0.5)*1000,
+            "p95_ms": self.percentile(0.95)*1000,
+            "p99_ms": self.percentile(0.99)*1000,
+            "max_ms": self.max*1000,
+            "buckets": list(self.buckets),
+        }
+
+class Metrics():
+    # Collects call counts and latency histograms per operation.
+    # Instrumented code checks the enabled flag before taking any
+    # timings, and methods wrapped by instrument() are only wrapped
+    # while metrics are enabled, so disabled metrics cost nothing
+    # but that check.
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.since = time.time()
+        self.instrumented = []
+
+    def record(self, name, duration, error=False):
+        with self.lock:
+            if not name in self.operations:
+                self.operations[name] = Histogram()
+            self.operations[name].add(duration, error)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "since": self.since,
+                "operations": {name: self.operations[name].summary() for name in self.operations},
+            }
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.since = time.time()
+
+    def set_enabled(self, enabled):
+        if enabled != self.enabled:
+            self.enabled = enabled
+            for owner, operations in self.instrumented:
+                if enabled:
+                    self.__wrap(owner, operations)
+                else:
+                    self.__unwrap(owner, operations)
+
+    def instrument(self, owner, operations):
+        # Times calls to methods of the owner object, given as a
+        # dictionary of method names and the operations to record
+        # them as, by replacing them with wrappers on the instance
+        # while metrics are enabled. When the methods call each
+        # other, only the outermost call is recorded, so the time
+        # spent in nested calls is not counted twice.
+        self.instrumented.append((owner, operations))
+        if self.enabled:
+            self.__wrap(owner, operations)
+
+    def __wrap(self, owner, operations):
+        nesting = threading.local()
+        for name in operations:
+            method = getattr(type(owner), name).__get__(owner)
+            setattr(owner, name, self.timed(operations[name], method, nesting=nesting))
+
+    def __unwrap(self, owner, operations):
+        for name in operations:
+            if name in owner.__dict__:
+                delattr(owner, name)
+
+    def timed(self, operation, function, nesting=None):
+        # Calls made while another call sharing the same nesting
+        # state is running on the same thread are not recorded
+        def timed_call(*args, **kwargs):
+            if nesting != None:
+                if getattr(nesting, "depth", 0) > 0:
+                    return function(*args, **kwargs)
+                nesting.depth = 1
+
+            started = time.perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self.record(operation, time.perf_counter()-started, error)
+                if nesting != None:
+                    nesting.depth = 0
+
+        return timed_call
+
+    @staticmethod
+    def format(snapshot, limit=None):
+        # Lists operations by total time spent in them, as lines
+        # suitable for logs and for display in the UI
+        operations = snapshot["operations"]
+        names = sorted(operations, key=lambda name: operations[name]["total_ms"], reverse=True)
+        if limit != None:
+            names = names[:limit]
+
+        lines = []
+        for name in names:
+            o = operations[name]
+            line = "%s: %d calls, mean %.2fms, p95 %.2fms, max %.2fms" % (name, o["count"], o["mean_ms"], o["p95_ms"], o["max_ms"])
+            if o["errors"] > 0:
+                line += ", "+str(o["errors"])+" errors"
+            lines.append(line)
+
+        return lines
@@ -0,0 +1,482 @@
+import os
+import RNS
+import time
+import queue
+import socket
+import threading
+import multiprocessing.connection
+import RNS.vendor.umsgpack as msgpack
+
+from concurrent.futures import ThreadPoolExecutor
+
+class RPCError(Exception):
+    pass
+
+class RPCProtocol():
+    VERSIONS         = [1]
+    MAX_MESSAGE_SIZE = 16*1024*1024
+
+    HELLO            = 0x00
+    RESULT           = 0x01
+    ERROR            = 0x02
+
+    GET_CHANGES      = 0x10
+    SET_STATES       = 0x11
+    SUBSCRIBE        = 0x12
+    LATEST_TELEMETRY = 0x20
+    SET_DEBUG        = 0x21
+    GET_PLUGINS_INFO = 0x22
+    GET_METRICS      = 0x23
+
+    EVENT_STATES     = 0x80
+
+    NAMES = {HELLO: "hello", GET_CHANGES: "get_changes", SET_STATES: "set_states", SUBSCRIBE: "subscribe",
+             LATEST_TELEMETRY: "latest_telemetry", SET_DEBUG: "set_debug", GET_PLUGINS_INFO: "get_plugins_info",
+             GET_METRICS: "get_metrics", EVENT_STATES: "event_states"}
+
+    # Connections are established and authenticated by the
+    # multiprocessing module, which also delimits messages, but
+    # messages are never pickled. Each one is a msgpack encoded
+    # list of an opcode, a request id and a payload. Events sent
+    # by the service carry no request id. The first message on a
+    # connection is a HELLO listing the protocol versions that the
+    # client supports, to which the service responds with the
+    # version that will be used.
+
+    @staticmethod
+    def name(opcode):
+        return RPCProtocol.NAMES.get(opcode, hex(opcode))
+
+    @staticmethod
+    def pack(opcode, request_id, payload):
+        return msgpack.packb([opcode, request_id, payload])
+
+    @staticmethod
+    def unpack(message):
+        opcode, request_id, payload = msgpack.unpackb(message)
+        return opcode, request_id, payload
+
+class RPCCall():
+    def __init__(self, request_id):
+        self.id = request_id
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def resolve(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.event.set()
+
+class RPCConnection():
+    # Every request sent on the connection carries an id, which the
+    # service returns with the response. Since the connection is only
+    # locked while a request is being written, any number of threads
+    # can have calls in flight at the same time, and a reader thread
+    # hands each response to the caller waiting for it. Messages sent
+    # by the service without a request id are events, and are passed
+    # to the event handler.
+
+    HELLO_TIMEOUT = 5
+
+    def __init__(self, address, authkey, event_handler=None):
+        self.connection = multiprocessing.connection.Client(address, authkey=authkey)
+        self.event_handler = event_handler
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.subscribed = set()
+
+        try:
+            self.version = self.__hello()
+        except Exception as e:
+            self.connection.close()
+            raise e
+
+        self.reader = threading.Thread(target=self.__read_responses, daemon=True)
+        self.reader.start()
+
+    def __hello(self):
+        self.connection.send_bytes(RPCProtocol.pack(RPCProtocol.HELLO, None, RPCProtocol.VERSIONS))
+        if not self.connection.poll(RPCConnection.HELLO_TIMEOUT):
+            raise RPCError("No protocol version received from service")
+
+        opcode, request_id, payload = RPCProtocol.unpack(self.connection.recv_bytes(RPCProtocol.MAX_MESSAGE_SIZE))
+        if opcode != RPCProtocol.RESULT:
+            raise RPCError("Service does not support this protocol version: "+str(payload))
+
+        return payload
+
+    def call(self, opcode, payload, timeout):
+        with self.pending_lock:
+            if self.closed:
+                raise RPCError("Connection is closed")
+            self.next_id += 1
+            call = RPCCall(self.next_id)
+            self.pending[call.id] = call
+
+        try:
+            message = RPCProtocol.pack(opcode, call.id, payload)
+            with self.send_lock:
+                self.connection.send_bytes(message)
+        except Exception as e:
+            self.close(e)
+
+        if not call.event.wait(timeout):
+            with self.pending_lock:
+                self.pending.pop(call.id, None)
+            raise RPCError("No response within "+str(timeout)+" seconds")
+
+        if call.error != None:
+            raise RPCError(call.error)
+
+        return call.result
+
+    def load(self):
+        return len(self.pending)
+
+    def close(self, reason=None):
+        with self.pending_lock:
+            self.closed = True
+            pending = self.pending
+            self.pending = {}
+
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+        for request_id in pending:
+            pending[request_id].resolve(error="Connection lost: "+str(reason))
+
+    def __read_responses(self):
+        try:
+            while True:
+                opcode, request_id, payload = RPCProtocol.unpack(self.connection.recv_bytes(RPCProtocol.MAX_MESSAGE_SIZE))
+                if request_id == None:
+                    if self.event_handler != None:
+                        self.event_handler(opcode, payload)
+                    continue
+
+                with self.pending_lock:
+                    call = self.pending.pop(request_id, None)
+
+                if call != None:
+                    if opcode == RPCProtocol.ERROR:
+                        call.resolve(error=payload)
+                    else:
+                        call.resolve(result=payload)
+
+        except Exception as e:
+            if not self.closed:
+                RNS.log("RPC connection to service closed: "+str(e), RNS.LOG_DEBUG)
+            self.close(e)
+
+class RPCClient():
+    TIMEOUT     = 10
+    POOL_SIZE   = 3
+    BACKOFF_MIN = 0.1
+    BACKOFF_MAX = 2.0
+
+    # Calls are spread over a small pool of connections to the
+    # service. A call is sent on the least loaded connection, and
+    # new connections are only opened when all existing ones have
+    # calls in flight, so a slow call never delays the ones behind
+    # it. When the service can not be reached, connection attempts
+    # are spaced out with an exponential backoff, and calls made in
+    # the meantime fail immediately.
+    #
+    # State subscriptions are kept by the client, and sent again
+    # to the service whenever the connection carrying them is
+    # replaced, so they survive the service or the connection being
+    # restarted. The service answers a subscription by sending the
+    # current values of its properties, followed by any later
+    # changes.
+
+    def __init__(self, address, authkey, timeout=TIMEOUT, pool_size=POOL_SIZE, metrics=None):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.connections = []
+        self.connect_lock = threading.Lock()
+        self.backoff = 0
+        self.next_attempt = 0
+        self.subscriber = None
+        self.subscribe_lock = threading.Lock()
+        self.subscriptions = {}
+        self.next_subscription = 0
+        self.metrics = metrics
+
+    def call(self, opcode, payload=None, timeout=None):
+        if timeout == None:
+            timeout = self.timeout
+
+        if self.metrics != None and self.metrics.enabled:
+            return self.metrics.timed("rpc.client."+RPCProtocol.name(opcode), self.__call)(opcode, payload, timeout)
+        else:
+            return self.__call(opcode, payload, timeout)
+
+    def __call(self, opcode, payload, timeout):
+        return self.__connection().call(opcode, payload, timeout)
+
+    def call_retrying(self, opcode, payload=None, timeout=None):
+        # Retries the call until it succeeds or the timeout
+        # expires, waiting for the connection backoff between
+        # attempts.
+        if timeout == None:
+            timeout = self.timeout
+
+        deadline = time.time()+timeout
+        while True:
+            try:
+                return self.call(opcode, payload, timeout=max(0.1, deadline-time.time()))
+            except Exception as e:
+                wait = max(self.next_attempt-time.time(), RPCClient.BACKOFF_MIN)
+                if time.time()+wait >= deadline:
+                    raise e
+                RNS.log("RPC call failed: "+str(e)+". Retrying in "+RNS.prettytime(wait), RNS.LOG_DEBUG)
+                time.sleep(wait)
+
+    def subscribe(self, props, callback):
+        with self.subscribe_lock:
+            self.next_subscription += 1
+            self.subscriptions[self.next_subscription] = (set(props), callback)
+
+        self.__connection()
+
+    def unsubscribe(self, callback):
+        with self.subscribe_lock:
+            for subscription_id in list(self.subscriptions):
+                if self.subscriptions[subscription_id][1] == callback:
+                    self.subscriptions.pop(subscription_id)
+
+    def close(self):
+        with self.connect_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            self.subscriber = None
+
+    def __connection(self):
+        with self.connect_lock:
+            self.connections = [c for c in self.connections if not c.closed]
+            connection = min(self.connections, key=lambda c: c.load(), default=None)
+            if connection == None or (connection.load() > 0 and len(self.connections) < self.pool_size):
+                try:
+                    connection = self.__connect()
+                    self.connections.append(connection)
+                except Exception as e:
+                    if connection == None:
+                        raise e
+
+            if self.subscriber == None or self.subscriber.closed:
+                self.subscriber = connection
+            subscriber = self.subscriber
+
+        if not subscriber.subscribed.issuperset(self.subscriptions):
+            self.__apply_subscriptions(subscriber)
+
+        return connection
+
+    def __connect(self):
+        now = time.time()
+        if now < self.next_attempt:
+            raise RPCError("Service unreachable, next connection attempt in "+RNS.prettytime(self.next_attempt-now))
+
+        try:
+            connection = RPCConnection(self.address, self.authkey, event_handler=self.__event)
+            self.backoff = 0
+            self.next_attempt = 0
+            return connection
+
+        except Exception as e:
+            self.backoff = min(max(self.backoff*2, RPCClient.BACKOFF_MIN), RPCClient.BACKOFF_MAX)
+            self.next_attempt = now+self.backoff
+            raise RPCError("Could not connect to service: "+str(e))
+
+    def __apply_subscriptions(self, connection):
+        with self.subscribe_lock:
+            for subscription_id in self.subscriptions:
+                if not subscription_id in connection.subscribed:
+                    props, callback = self.subscriptions[subscription_id]
+                    connection.call(RPCProtocol.SUBSCRIBE, list(props), self.timeout)
+                    connection.subscribed.add(subscription_id)
+
+    def __event(self, opcode, data):
+        if opcode == RPCProtocol.EVENT_STATES:
+            for props, callback in list(self.subscriptions.values()):
+                changes = {prop: data[prop] for prop in data if prop in props}
+                if len(changes) > 0:
+                    RPCClient.notify(callback, changes)
+
+    @staticmethod
+    def notify(callback, states):
+        try:
+            callback(states)
+        except Exception as e:
+            RNS.log("Error in state subscription callback "+str(callback)+": "+str(e), RNS.LOG_ERROR)
+
+class RPCServerConnection():
+    EVENT_QUEUE_SIZE = 256
+
+    # Events are queued and sent by a thread of their own, so
+    # that producing them never blocks on a slow client, while
+    # they are still delivered in the order they were produced.
+    # A client that falls so far behind that its queue fills up
+    # is disconnected. It will then reconnect and subscribe again,
+    # receiving the current state values.
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.subscription = None
+        self.version = None
+        self.events = queue.Queue(maxsize=RPCServerConnection.EVENT_QUEUE_SIZE)
+        self.event_sender = None
+        self.event_lock = threading.Lock()
+        self.closed = False
+
+    def recv(self):
+        return RPCProtocol.unpack(self.connection.recv_bytes(RPCProtocol.MAX_MESSAGE_SIZE))
+
+    def send(self, opcode, request_id, payload):
+        message = RPCProtocol.pack(opcode, request_id, payload)
+        with self.send_lock:
+            self.connection.send_bytes(message)
+
+    def send_event(self, opcode, data):
+        with self.event_lock:
+            if self.closed:
+                return
+            if self.event_sender == None:
+                self.event_sender = threading.Thread(target=self.__send_events, daemon=True)
+                self.event_sender.start()
+
+        try:
+            self.events.put_nowait((opcode, data))
+        except queue.Full:
+            RNS.log("RPC client is not receiving events, disconnecting it", RNS.LOG_WARNING)
+            self.close()
+
+    def __send_events(self):
+        while True:
+            event = self.events.get()
+            if event == None or self.closed:
+                break
+
+            try:
+                self.send(event[0], None, event[1])
+            except Exception as e:
+                RNS.log("Could not send RPC event: "+str(e), RNS.LOG_DEBUG)
+                self.close()
+                break
+
+    def close(self):
+        with self.event_lock:
+            self.closed = True
+
+        try:
+            self.events.put_nowait(None)
+        except queue.Full:
+            pass
+
+        # Shutting the socket down wakes up the thread reading
+        # calls from it, which then releases the connection.
+        try:
+            client_socket = socket.socket(fileno=os.dup(self.connection.fileno()))
+            client_socket.shutdown(socket.SHUT_RDWR)
+            client_socket.close()
+        except Exception:
+            pass
+
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+class RPCServer():
+    WORKERS     = 4
+    MAX_CLIENTS = 8
+
+    # Each client connection has a thread reading calls from it,
+    # but the calls themselves are handled by a fixed pool of
+    # workers shared by all clients. Calls from one connection can
+    # be handled concurrently, and their responses are sent back as
+    # they complete, tagged with the id of the request.
+
+    def __init__(self, address, authkey, handler, disconnect_handler=None, metrics=None):
+        self.address = address
+        self.authkey = authkey
+        self.handler = handler
+        self.disconnect_handler = disconnect_handler
+        self.metrics = metrics
+        self.clients = 0
+        self.clients_lock = threading.Lock()
+        self.listener = None
+        self.workers = ThreadPoolExecutor(max_workers=RPCServer.WORKERS, thread_name_prefix="rpc")
+
+    def start(self):
+        self.listener = multiprocessing.connection.Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self.__accept_clients, daemon=True).start()
+
+    def __accept_clients(self):
+        while True:
+            try:
+                RNS.log("Ready for next RPC client", RNS.LOG_DEBUG)
+                connection = RPCServerConnection(self.listener.accept())
+                with self.clients_lock:
+                    if self.clients >= RPCServer.MAX_CLIENTS:
+                        RNS.log("Rejecting RPC client, since "+str(self.clients)+" clients are already connected", RNS.LOG_ERROR)
+                        connection.close()
+                        continue
+                    self.clients += 1
+
+                RNS.log("Accepted RPC client", RNS.LOG_DEBUG)
+                threading.Thread(target=self.__read_calls, args=(connection,), daemon=True).start()
+
+            except Exception as e:
+                RNS.log("An error ocurred while handling RPC call from local client: "+str(e), RNS.LOG_ERROR)
+
+    def __read_calls(self, connection):
+        try:
+            opcode, request_id, versions = connection.recv()
+            supported = [v for v in versions if v in RPCProtocol.VERSIONS] if opcode == RPCProtocol.HELLO else []
+            if len(supported) == 0:
+                connection.send(RPCProtocol.ERROR, request_id, RPCProtocol.VERSIONS)
+                raise RPCError("No common protocol version with client")
+
+            connection.version = max(supported)
+            connection.send(RPCProtocol.RESULT, request_id, connection.version)
+
+            while True:
+                opcode, request_id, payload = connection.recv()
+                self.workers.submit(self.__handle_call, connection, opcode, request_id, payload)
+
+        except Exception as e:
+            RNS.log("RPC client connection closed: "+str(e), RNS.LOG_DEBUG)
+
+        finally:
+            with self.clients_lock:
+                self.clients -= 1
+            if self.disconnect_handler != None:
+                self.disconnect_handler(connection)
+            connection.close()
+
+    def __handle_call(self, connection, opcode, request_id, payload):
+        handler = self.handler
+        if self.metrics != None and self.metrics.enabled:
+            handler = self.metrics.timed("rpc.service."+RPCProtocol.name(opcode), handler)
+
+        try:
+            response = (RPCProtocol.RESULT, request_id, handler(opcode, payload, connection))
+        except Exception as e:
+            RNS.log("Error while handling RPC call "+str(opcode)+": "+str(e), RNS.LOG_ERROR)
+            response = (RPCProtocol.ERROR, request_id, str(e))
+
+        try:
+            connection.send(*response)
+        except Exception as e:
+            RNS.log("Could not send RPC response: "+str(e), RNS.LOG_DEBUG)
@@ -0,0 +1,147 @@
+import os
+import RNS
+import mmap
+import zlib
+import struct
+
+class StatusBlock():
+    MAGIC         = b"SBST"
+    VERSION       = 1
+    READ_ATTEMPTS = 16
+
+    HEARTBEAT = "service.heartbeat"
+    FLAGS     = ["app.foreground", "app.running", "app.loaded", "wants.announce", "wants.service_stop",
+                 "app.flags.unread_conversations", "app.flags.new_conversations", "app.flags.new_announces",
+                 "app.flags.lxmf_sync_dialog_open", "wants.viewupdate.conversations"]
+
+    PROPERTIES = [HEARTBEAT]+FLAGS
+
+    HEADER   = struct.Struct("<4sHH")
+    SEQUENCE = struct.Struct("<Q")
+    PAYLOAD  = struct.Struct("<8sQdQ")
+    CHECKSUM = struct.Struct("<I")
+
+    SEQUENCE_OFFSET = HEADER.size
+    PAYLOAD_OFFSET  = SEQUENCE_OFFSET+SEQUENCE.size
+    CHECKSUM_OFFSET = PAYLOAD_OFFSET+PAYLOAD.size
+    SIZE            = 64
+
+    # The status block is a small file in the app storage directory,
+    # which the service maps into memory and keeps updated with its
+    # heartbeat, a set of boolean state flags, and the state epoch and
+    # version. Clients map the same file, and read it without any
+    # locks or system calls.
+    #
+    # The service is the only writer. Before changing the payload, it
+    # makes the sequence number odd, and makes it even again once the
+    # payload is complete. Readers retry until they get the same even
+    # sequence number before and after reading the payload, and the
+    # payload matches its checksum, which also catches writes becoming
+    # visible out of order.
+    #
+    # Each flag takes two bits, one marking that the flag has been set
+    # at all, and one holding its value, so flags that were never set
+    # still read as None.
+
+    def __init__(self, path, writable):
+        self.path = path
+        self.writable = writable
+        self.sequence = 0
+        self.file = open(path, "r+b" if writable else "rb")
+        try:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.map = mmap.mmap(self.file.fileno(), StatusBlock.SIZE, access=access)
+        except Exception as e:
+            self.file.close()
+            raise e
+
+    @staticmethod
+    def create(path):
+        # An existing block is reused in place rather than replaced,
+        # since clients may still have it mapped
+        try:
+            if not os.path.isfile(path) or os.path.getsize(path) != StatusBlock.SIZE:
+                with open(path+".tmp", "wb") as block_file:
+                    block_file.write(bytes(StatusBlock.SIZE))
+                os.replace(path+".tmp", path)
+
+            block = StatusBlock(path, writable=True)
+            block.sequence = StatusBlock.SEQUENCE.unpack_from(block.map, StatusBlock.SEQUENCE_OFFSET)[0] & ~1
+            StatusBlock.HEADER.pack_into(block.map, 0, StatusBlock.MAGIC, StatusBlock.VERSION, 0)
+            return block
+
+        except Exception as e:
+            RNS.log("Could not create status block at "+str(path)+": "+str(e), RNS.LOG_ERROR)
+            return None
+
+    @staticmethod
+    def open(path):
+        try:
+            if not os.path.isfile(path):
+                return None
+
+            block = StatusBlock(path, writable=False)
+            magic, version, reserved = StatusBlock.HEADER.unpack_from(block.map, 0)
+            if magic != StatusBlock.MAGIC or version != StatusBlock.VERSION:
+                block.close()
+                return None
+
+            return block
+
+        except Exception as e:
+            RNS.log("Could not open status block at "+str(path)+": "+str(e), RNS.LOG_DEBUG)
+            return None
+
+    def write(self, epoch, version, states):
+        flags = 0
+        for n, prop in enumerate(StatusBlock.FLAGS):
+            if prop in states and states[prop] != None:
+                flags |= 1 << (n*2)
+                if states[prop]:
+                    flags |= 1 << (n*2+1)
+
+        heartbeat = states.get(StatusBlock.HEARTBEAT) or 0.0
+        payload = StatusBlock.PAYLOAD.pack(epoch, version, heartbeat, flags)
+
+        self.sequence += 1
+        StatusBlock.SEQUENCE.pack_into(self.map, StatusBlock.SEQUENCE_OFFSET, self.sequence)
+        self.map[StatusBlock.PAYLOAD_OFFSET:StatusBlock.CHECKSUM_OFFSET] = payload
+        StatusBlock.CHECKSUM.pack_into(self.map, StatusBlock.CHECKSUM_OFFSET, zlib.crc32(payload))
+        self.sequence += 1
+        StatusBlock.SEQUENCE.pack_into(self.map, StatusBlock.SEQUENCE_OFFSET, self.sequence)
+
+    def read(self):
+        # Returns the epoch, the version and a dictionary of the state
+        # values held in the block, or None if no consistent copy could
+        # be read, or nothing has been written yet
+        for attempt in range(StatusBlock.READ_ATTEMPTS):
+            before = StatusBlock.SEQUENCE.unpack_from(self.map, StatusBlock.SEQUENCE_OFFSET)[0]
+            if before == 0:
+                return None
+            if before & 1:
+                continue
+
+            payload = self.map[StatusBlock.PAYLOAD_OFFSET:StatusBlock.CHECKSUM_OFFSET]
+            checksum = StatusBlock.CHECKSUM.unpack_from(self.map, StatusBlock.CHECKSUM_OFFSET)[0]
+            after = StatusBlock.SEQUENCE.unpack_from(self.map, StatusBlock.SEQUENCE_OFFSET)[0]
+            if before != after or zlib.crc32(payload) != checksum:
+                continue
+
+            epoch, version, heartbeat, flags = StatusBlock.PAYLOAD.unpack(payload)
+            states = {StatusBlock.HEARTBEAT: heartbeat if heartbeat > 0 else None}
+            for n, prop in enumerate(StatusBlock.FLAGS):
+                if flags & (1 << (n*2)):
+                    states[prop] = bool(flags & (1 << (n*2+1)))
+                else:
+                    states[prop] = None
+
+            return epoch, version, states
+
+        return None
+
+    def close(self):
+        try:
+            self.map.close()
+            self.file.close()
+        except Exception:
+            pass
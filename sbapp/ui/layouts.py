@@ -1584,6 +1584,22 @@ MDScreen:
                         disabled: False
                         active: False
 
+                MDBoxLayout:
+                    orientation: "vertical"
+                    size_hint_y: None
+                    height: self.minimum_height
+                    padding: [0, 0, 0, dp(24)]
+
+                    MDRectangleFlatIconButton:
+                        id: settings_metrics_button
+                        icon: "timer-outline"
+                        text: "Show Performance Metrics"
+                        padding: [dp(0), dp(14), dp(0), dp(14)]
+                        icon_size: dp(24)
+                        font_size: dp(16)
+                        size_hint: [1.0, None]
+                        on_release: root.app.settings_metrics_action(self)
+
                 MDLabel:
                     text: "Input Options & Localisation"
                     font_style: "H6"
@@ -64,8 +64,8 @@ class Messages():
         self.new_messages = []
         self.added_item_hashes = []
         self.added_messages = 0
-        self.latest_message_timestamp = None
-        self.earliest_message_timestamp = time.time()
+        self.latest_message_cursor = None
+        self.earliest_message_cursor = None
         self.loading_earlier_messages = False
         self.list = None
         self.widgets = []
@@ -80,13 +80,14 @@ class Messages():
         self.new_messages = []
         self.added_item_hashes = []
         self.added_messages = 0
-        self.latest_message_timestamp = None
+        self.latest_message_cursor = None
+        self.earliest_message_cursor = None
         self.widgets = []
 
         self.update()
 
     def load_more(self, dt):
-        for new_message in self.app.sideband.list_messages(self.context_dest, before=self.earliest_message_timestamp,limit=5):
+        for new_message in self.app.sideband.list_messages(self.context_dest, before_cursor=self.earliest_message_cursor, limit=5):
             self.new_messages.append(new_message)
 
         if len(self.new_messages) > 0:
@@ -94,10 +95,17 @@ class Messages():
             self.list.remove_widget(self.load_more_button)
 
     def update(self, limit=8):
-        for new_message in self.app.sideband.list_messages(self.context_dest, after=self.latest_message_timestamp,limit=limit):
-            self.new_messages.append(new_message)
-
-        self.db_message_count = self.app.sideband.count_messages(self.context_dest)
+        # The conversation summary is checked first, so that messages
+        # are only queried when there is something new to load.
+        summary = self.app.sideband.conversation_summary(self.context_dest)
+        if summary == None or summary["last_message_cursor"] != self.latest_message_cursor:
+            for new_message in self.app.sideband.list_messages(self.context_dest, after_cursor=self.latest_message_cursor, limit=limit):
+                self.new_messages.append(new_message)
+
+        if summary != None and summary["messages"] != None:
+            self.db_message_count = summary["messages"]
+        else:
+            self.db_message_count = self.app.sideband.count_messages(self.context_dest)
 
         if self.load_more_button == None:
             self.load_more_button = MDRectangleFlatIconButton(
@@ -137,7 +145,14 @@ class Messages():
                 w.line_color = (1.0, 1.0, 1.0, 0.5)
 
             if m["state"] == LXMF.LXMessage.SENDING or m["state"] == LXMF.LXMessage.OUTBOUND:
-                msg = self.app.sideband.message(m["hash"])
+                # Only the state is queried while it is unchanged, the
+                # full message is only read once it has changed.
+                if self.app.sideband.message_state(m["hash"]) == m["state"]:
+                    msg = m
+                else:
+                    msg = self.app.sideband.message(m["hash"])
+                    if msg == None:
+                        continue
 
                 if msg["state"] == LXMF.LXMessage.OUTBOUND or msg["state"] == LXMF.LXMessage.SENDING:
                     w.md_bg_color = msg_color = mdc(color_unknown, intensity_msgs)
@@ -200,6 +215,12 @@ class Messages():
                     w.dmenu.items.append(w.dmenu.retry_item)
 
 
+    def has_pending(self):
+        # Outbound messages show their transfer progress, which is
+        # not pushed by the core, so the view must be refreshed
+        # periodically while any are in flight.
+        return any(w.m["state"] in [LXMF.LXMessage.SENDING, LXMF.LXMessage.OUTBOUND] for w in self.widgets)
+
     def update_widget(self):
         if self.app.sideband.config["dark_ui"]:
             intensity_msgs = intensity_msgs_dark
@@ -905,11 +926,11 @@ class Messages():
                 self.widgets.append(item)
                 self.list.add_widget(item, insert_pos)
 
-                if self.latest_message_timestamp == None or m["received"] > self.latest_message_timestamp:
-                    self.latest_message_timestamp = m["received"]
+                if self.latest_message_cursor == None or m["cursor"] > self.latest_message_cursor:
+                    self.latest_message_cursor = m["cursor"]
 
-                if self.earliest_message_timestamp == None or m["received"] < self.earliest_message_timestamp:
-                    self.earliest_message_timestamp = m["received"]
+                if self.earliest_message_cursor == None or m["cursor"] < self.earliest_message_cursor:
+                    self.earliest_message_cursor = m["cursor"]
 
         self.added_messages += len(self.new_messages)
         self.new_messages = []
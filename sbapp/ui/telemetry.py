@@ -54,6 +54,9 @@ class Telemetry():
         self.screen.ids.telemetry_collector_enabled.active = self.app.sideband.config["telemetry_collector_enabled"]
         self.screen.ids.telemetry_collector_enabled.bind(active=self.telemetry_save)
 
+        self.screen.ids.telemetry_compaction_enabled.active = self.app.sideband.config["telemetry_compaction_enabled"]
+        self.screen.ids.telemetry_compaction_enabled.bind(active=self.telemetry_save)
+
         self.screen.ids.telemetry_send_to_trusted.active = self.app.sideband.config["telemetry_send_to_trusted"]
         self.screen.ids.telemetry_send_to_trusted.bind(active=self.telemetry_save)
 
@@ -96,7 +99,10 @@ class Telemetry():
         info += "your own telemetry will be sent to the collector, but by enabling the [b]Send all known to collector[/b] option, you "
         info += "can forward all known telemetry to the collector. This can also be used to aggregate telemetry from multiple different "
         info += "collectors, or create chains of transmission.\n\nBy activating the [b]Enable collector[/b] option, this instance of "
-        info += "Sideband will become a Telemetry Collector, and other authorized peers will be able to query its collected data.\n"
+        info += "Sideband will become a Telemetry Collector, and other authorized peers will be able to query its collected data.\n\n"
+        info += "Since collected telemetry can grow very large over time, the [b]Compact telemetry history[/b] option will periodically thin "
+        info += "out older entries. The last day of telemetry is kept in full, older entries are reduced to one point every five minutes, and "
+        info += "entries older than 30 days to one point per hour. The newest entry for every source is always kept.\n"
 
         if self.app.theme_cls.theme_style == "Dark":
             info = "[color=#"+self.app.dark_theme_text_color+"]"+info+"[/color]"
@@ -259,6 +265,7 @@ class Telemetry():
         self.app.sideband.config["telemetry_allow_requests_from_trusted"] = self.screen.ids.telemetry_allow_requests_from_trusted.active
         self.app.sideband.config["telemetry_allow_requests_from_anyone"] = self.screen.ids.telemetry_allow_requests_from_anyone.active
         self.app.sideband.config["telemetry_collector_enabled"] = self.screen.ids.telemetry_collector_enabled.active
+        self.app.sideband.config["telemetry_compaction_enabled"] = self.screen.ids.telemetry_compaction_enabled.active
         
         self.app.sideband.save_configuration()
         if run_telemetry_update:
@@ -608,6 +615,21 @@ MDScreen:
                         pos_hint: {"center_y": 0.3}
                         active: False
 
+                MDBoxLayout:
+                    orientation: "horizontal"
+                    padding: [0,0,dp(24),0]
+                    size_hint_y: None
+                    height: dp(48)
+                    
+                    MDLabel:
+                        text: "Compact telemetry history"
+                        font_style: "H6"
+
+                    MDSwitch:
+                        id: telemetry_compaction_enabled
+                        pos_hint: {"center_y": 0.3}
+                        active: False
+
                 MDBoxLayout:
                     orientation: "horizontal"
                     size_hint_y: None
@@ -0,0 +1,24 @@
+import os
+import time
+
+import RNS
+
+from sbapp.sideband.core import SidebandCore
+
+def create_core(path):
+    # A new configuration is saved in the background while it is
+    # being loaded, so the configuration directory is created first,
+    # and then loaded again, as on any later start of the app.
+    if not os.path.isfile(os.path.join(path, "app_storage", "sideband_config")):
+        initial = SidebandCore(None, config_path=path, is_client=True)
+        while initial.saving_configuration or not os.path.isfile(initial.config_path):
+            time.sleep(0.1)
+        initial.db_writer.stop()
+
+    core = SidebandCore(None, config_path=path, is_client=False)
+    core.lxmf_destination = RNS.Destination(core.identity, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+    return core
+
+def stop_core(core):
+    if core.db_writer != None:
+        core.db_writer.stop()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sbapp.sideband.core import SidebandCore
+
+from helpers import create_core, stop_core
+
+class TestArchiveImport(unittest.TestCase):
+    CONVERSATIONS = 6
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = create_core(os.path.join(self.path, "source"))
+        self.target = create_core(os.path.join(self.path, "target"))
+        for n in range(TestArchiveImport.CONVERSATIONS):
+            self.source._db_create_conversation(os.urandom(16))
+
+        # One conversation per chunk, so the import is spread over
+        # several transactions.
+        self.archive = os.path.join(self.path, "archive.sba")
+        chunk_size = SidebandCore.ARCHIVE_CHUNK_SIZE
+        try:
+            SidebandCore.ARCHIVE_CHUNK_SIZE = 1
+            self.source.export_archive(self.archive)
+        finally:
+            SidebandCore.ARCHIVE_CHUNK_SIZE = chunk_size
+
+    def tearDown(self):
+        stop_core(self.source)
+        stop_core(self.target)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def resume_pointer(self):
+        keys = [key for key in self.target.persistent_cache.entries or {} if key.startswith("db.import.")]
+        self.assertLessEqual(len(keys), 1)
+        return self.target.getpersistent(keys[0]) if len(keys) > 0 else None
+
+    def stored_conversations(self):
+        db = sqlite3.connect(self.target.db_path)
+        try:
+            return db.execute("select count(*) from conv").fetchone()[0]
+        finally:
+            db.close()
+
+    def test_failed_commit_keeps_resume_pointer(self):
+        # Once two chunks are merged, commits on the writer connection
+        # are refused, so the third chunk is rolled back at COMMIT.
+        writer = self.target.db_writer
+        def deny_commit(action, arg1, arg2, database, source):
+            if action == sqlite3.SQLITE_TRANSACTION and arg1 == "COMMIT":
+                return sqlite3.SQLITE_DENY
+            return sqlite3.SQLITE_OK
+
+        def progress(done, total):
+            if done == 2:
+                writer.outside_transaction(lambda: writer.db.set_authorizer(deny_commit))
+
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.target.import_archive(self.archive, progress=progress)
+
+        writer.outside_transaction(lambda: writer.db.set_authorizer(None))
+        self.assertEqual(self.resume_pointer(), 1)
+        self.assertEqual(self.stored_conversations(), 2)
+
+        # A retry in the same process continues with the chunk that
+        # failed, and merges everything.
+        result = self.target.import_archive(self.archive)
+        self.assertEqual(result["imported"]["conv"], TestArchiveImport.CONVERSATIONS-2)
+        self.assertEqual(self.stored_conversations(), TestArchiveImport.CONVERSATIONS)
+        self.assertEqual(self.resume_pointer(), None)
+
+if __name__ == "__main__":
+    unittest.main()
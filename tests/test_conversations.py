@@ -0,0 +1,66 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from helpers import create_core, stop_core
+
+class TestConversationList(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.core = create_core(self.path)
+
+    def tearDown(self):
+        stop_core(self.core)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def listed(self, context_dest):
+        convs = [c for c in self.core.list_conversations() if c["dest"] == context_dest]
+        self.assertEqual(len(convs), 1)
+        return convs[0]
+
+    def test_timestamps(self):
+        # The conv table stores last_tx before last_rx, so the listed
+        # timestamps must be taken from the columns by name.
+        context_dest = os.urandom(16)
+        self.core._db_create_conversation(context_dest)
+        db = sqlite3.connect(self.core.db_path)
+        try:
+            db.execute("UPDATE conv SET last_rx=?, last_tx=? WHERE dest_context=?", (200, 100, context_dest))
+            db.commit()
+        finally:
+            db.close()
+
+        conv = self.listed(context_dest)
+        self.assertEqual(conv["last_rx"], 200)
+        self.assertEqual(conv["last_tx"], 100)
+        self.assertEqual(conv["last_activity"], 200)
+
+        before = time.time()
+        self.core._db_conversation_update_txtime(context_dest)
+        conv = self.listed(context_dest)
+        self.assertEqual(conv["last_rx"], 200)
+        self.assertGreaterEqual(conv["last_tx"], before)
+        self.assertEqual(conv["last_activity"], conv["last_tx"])
+
+    def test_conversation_order(self):
+        # Conversations are listed by their latest activity in either
+        # direction.
+        received, sent = os.urandom(16), os.urandom(16)
+        self.core._db_create_conversation(received)
+        self.core._db_create_conversation(sent)
+        db = sqlite3.connect(self.core.db_path)
+        try:
+            db.execute("UPDATE conv SET last_rx=?, last_tx=? WHERE dest_context=?", (300, 0, received))
+            db.execute("UPDATE conv SET last_rx=?, last_tx=? WHERE dest_context=?", (100, 400, sent))
+            db.commit()
+        finally:
+            db.close()
+
+        listed = [c["dest"] for c in self.core.list_conversations()]
+        self.assertEqual(listed, [sent, received])
+
+if __name__ == "__main__":
+    unittest.main()